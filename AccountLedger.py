@@ -0,0 +1,184 @@
+"""
+    This class keeps the broker account's cash for every strategy in a StrategyCollector, so sizing a buy doesn't need a get_account call
+    and two strategies can't both spend the same dollars.
+
+    The account is fetched at most once every ttl_seconds, and again as soon as an order that spent cash has filled.
+    The fetch is made outside the lock and its result swapped in under it, so reservations and releases on other threads never wait on the request;
+    a fill released while the account was in flight leaves it stale, and a reservation only checks against an account fetched after the last fill.
+    Between fetches, a strategy that wants to buy reserves the cost first. The reservation is checked and taken under one lock against
+    the strategy's money_allocated_to_this_strategy (its outstanding reservations plus the new one) and the account's minimum_reserve_balance
+    (the cash left once every strategy's reservations are taken out), so strategies running on different threads see each other's buys.
+    A reservation is released when its order is done; a released order that filled marks the account stale, so the next check sees the new cash.
+
+"""
+
+#basic libraries
+import time
+import itertools
+import threading
+
+from EventLog import EventLog
+
+
+event_log = EventLog('account')
+
+
+
+class CashReservation():
+
+    def __init__(self, new_reservation_id, new_strategy_name, new_symbol, new_amount):
+        self.reservation_id = new_reservation_id
+        self.strategy_name = new_strategy_name
+        self.symbol = new_symbol
+        self.amount = new_amount
+
+
+    def __repr__(self):
+        return f'CashReservation(reservation_id={self.reservation_id}, strategy={self.strategy_name}, symbol={self.symbol}, amount={self.amount})'
+
+
+
+class AccountLedger():
+
+    def __init__(self, new_trade_api_rest, new_ttl_seconds=60.0, new_monotonic_function=time.monotonic):
+        self.alpaca = new_trade_api_rest
+        self.ttl_seconds = new_ttl_seconds
+        self.monotonic = new_monotonic_function
+
+        self.account = None
+        self.cash = 0.0
+        self.buying_power = 0.0
+        self.refreshed_at = None
+        self.is_stale = True
+        self.refreshes = 0
+        #counts invalidate calls and spent releases, a fetch that started before the last one may not include that fill
+        self.invalidations = 0
+
+        self.reservations = {}
+        self.reserved_by_strategy = {}
+        self.reserved_total = 0.0
+        self.reservation_numbers = itertools.count(1)
+
+        #strategies reserve from the loop's thread while the order pipeline's workers release, only held for the bookkeeping, never for a request
+        self.lock = threading.RLock()
+        #one get_account in flight at a time, the other threads that need a fresh account wait for that one
+        self.refresh_lock = threading.Lock()
+
+
+    #----- broker account -----
+
+    def refresh(self):
+        with self.refresh_lock:
+            return self.fetch_account()
+
+
+    def fetch_account(self):
+        with self.lock:
+            invalidations = self.invalidations
+        account = self.alpaca.get_account()
+
+        with self.lock:
+            self.account = account
+            #alpaca returns all numbers as strings to not lose any precision, will have to cast to float
+            self.cash = float(account.cash)
+            self.buying_power = float(account.buying_power)
+            self.refreshed_at = self.monotonic()
+            self.is_stale = self.invalidations != invalidations
+            self.refreshes += 1
+            event_log.debug('account_refreshed', cash=self.cash, buying_power=self.buying_power, reserved=self.reserved_total)
+        return account
+
+
+    def needs_refresh(self):
+        with self.lock:
+            return self.is_stale or self.refreshed_at is None or self.monotonic() - self.refreshed_at >= self.ttl_seconds
+
+
+    def refresh_if_stale(self):
+        #never called with self.lock held, the request is made without it
+        if self.needs_refresh():
+            with self.refresh_lock:
+                #another thread may have refreshed it while this one waited
+                if self.needs_refresh():
+                    self.fetch_account()
+
+
+    def invalidate(self):
+        with self.lock:
+            self.is_stale = True
+            self.invalidations += 1
+
+
+    def get_account(self):
+        self.refresh_if_stale()
+        return self.account
+
+
+    def get_cash(self):
+        self.refresh_if_stale()
+        with self.lock:
+            return self.cash
+
+
+    def get_buying_power(self):
+        self.refresh_if_stale()
+        with self.lock:
+            return self.buying_power
+
+
+    def get_available_cash(self):
+        #the cash no strategy has reserved yet
+        self.refresh_if_stale()
+        with self.lock:
+            return self.cash - self.reserved_total
+
+
+    #----- reservations -----
+
+    def reserve(self, strategy_name, symbol, amount, allocated, minimum_reserve_balance):
+        #returns the CashReservation, or None when the strategy's allocation or the account's reserve balance doesn't allow it
+        amount = float(amount)
+        while True:
+            self.refresh_if_stale()
+            with self.lock:
+                #a fill released since the refresh isn't in this cash yet while its reservation is already gone, fetch again first
+                if self.is_stale:
+                    continue
+                strategy_reserved = self.reserved_by_strategy.get(strategy_name, 0.0)
+                new_balance = self.cash - self.reserved_total - amount
+                if new_balance <= minimum_reserve_balance or strategy_reserved + amount >= float(allocated):
+                    return None
+
+                reservation = CashReservation(next(self.reservation_numbers), strategy_name, symbol, amount)
+                self.reservations[reservation.reservation_id] = reservation
+                self.reserved_by_strategy[strategy_name] = strategy_reserved + amount
+                self.reserved_total += amount
+                break
+
+        event_log.debug('cash_reserved', strategy=strategy_name, symbol=symbol, amount=amount, new_balance=new_balance)
+        return reservation
+
+
+    def release(self, reservation, spent=True):
+        #spent is whether the order may have used the cash, if so the account is fetched again before the next reservation
+        with self.lock:
+            if self.reservations.pop(reservation.reservation_id, None) is None:
+                return
+            self.reserved_by_strategy[reservation.strategy_name] -= reservation.amount
+            self.reserved_total -= reservation.amount
+            if len(self.reservations) == 0:
+                #no drift left over from float sums once nothing is reserved
+                self.reserved_by_strategy = {}
+                self.reserved_total = 0.0
+            if spent:
+                self.is_stale = True
+                self.invalidations += 1
+
+        event_log.debug('cash_released', strategy=reservation.strategy_name, symbol=reservation.symbol, amount=reservation.amount, spent=spent)
+
+
+    def get_reserved(self, strategy_name=None):
+        with self.lock:
+            if strategy_name is None:
+                return self.reserved_total
+            return self.reserved_by_strategy.get(strategy_name, 0.0)
@@ -15,8 +15,10 @@ import pandas as pd
 import alpaca_trade_api as tradeapi
 
 from StrategyCollector import StrategyCollector
+from UniverseScreener import UniverseScreener, UniverseTier
 from StrategyBuyFiveMinuteSpikes import StrategyBuyFiveMinuteSpikes
 from BasicStrategy import BasicStrategy
+from EventLog import configure_event_log
 
 
 #overrides the print settings
@@ -24,6 +26,9 @@ pd.set_option('display.max_rows', 500)
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.width', 1000)
 
+#one JSON line per event on stdout, written from a background thread; 'DEBUG' adds the per-stock diagnostics
+configure_event_log('INFO')
+
 #replace these with your accounts values
 API_KEY = 12345678901234567890 
 API_SECRET = 98765432109876543210
@@ -32,7 +37,18 @@ APCA_API_BASE_URL = "https://paper-api.alpaca.markets"
 alpaca = tradeapi.REST(API_KEY, API_SECRET, APCA_API_BASE_URL, 'v2')
 
 
-my_strat_collector = StrategyCollector(alpaca)
+#optional collector features, all off so the bot trades only the lists below and makes the same requests as without them
+#'bar_store' keeps minute bars in bar_store/ between runs, so a restart only fetches the bars it missed
+BAR_STORE_DIRECTORY = None
+#True sends buys through the order pipeline, which only adds the trailing stop once the fill is confirmed
+USE_ORDER_PIPELINE = False
+#200 is alpaca's limit per account, orders get the requests first when the budget runs low
+REQUESTS_PER_MINUTE = None
+#True adds each tier's most traded stocks from the whole tradable universe to the lists below, screened again every hour
+SCREEN_UNIVERSE = False
+
+my_strat_collector = StrategyCollector(alpaca, new_bar_store_directory=BAR_STORE_DIRECTORY, new_use_order_pipeline=USE_ORDER_PIPELINE,
+                                       new_requests_per_minute=REQUESTS_PER_MINUTE)
 
 
 #highest tier, long
@@ -42,15 +58,26 @@ my_strat_collector.append_strat(strat1)
 
 #medium tier
 stocks_strat4 = ["BAC", "F","XOM","T"]
-strat4 = StrategyBuyFiveMinuteSpikes("Strat 2 - Medium Tier",alpaca,stocks_strat2,3000,20,4,2,1.0,2.0,5.0)
+strat4 = StrategyBuyFiveMinuteSpikes("Strat 2 - Medium Tier",alpaca,stocks_strat4,3000,20,4,2,1.0,2.0,5.0)
 my_strat_collector.append_strat(strat4)
 
 #low tier
 stocks_strat5 = ["DOOO", "QRTEB", "BBAR", "NTB","SPLP","CODI","IIIN","CAI","SCSC","VEC","LOMA","AZZ","LEE","PFBC","RM","RBKB","GAIN","CRAI","BANF","PZN","ITRN","UNTY","SPNS","TSBK","SQBG","CNOB","MGIC","EFSC","SRT","CTT","PLUS","SGRP","CECE","FRME","CCB","CPF","FBNC","UEIC","KELYB","GFN","CALB","MCB","INOD","RUSHB","FBK","ECOL","SBFG","ESXB","MPX","FWRD","MHO","EVBN","TOWN","APOG","SRCE","HLIO","HMTV","MBWM","PAM","QCRH","APWC","NVEC","CSTR","SASR","AMNB","STXB","LEGH","BANR","BUSE","UVSP","DSGX","OPY","NVMI","FN","VCTR","SFST","MSBI","SONA","FBIZ","HMST","CBTX","LMRK","UONE","RBNC","FONR","MLR","FBMS"]
-strat5 = StrategyBuyFiveMinuteSpikes("Strat 3 - Low Tier",alpaca,stocks_strat3,1000,20,4,2,1.0,2.0,5.0)
+strat5 = StrategyBuyFiveMinuteSpikes("Strat 3 - Low Tier",alpaca,stocks_strat5,1000,20,4,2,1.0,2.0,5.0)
 my_strat_collector.append_strat(strat5)
 
 
+#the lists above are always traded, each tier adds its most traded stocks inside its band to them, screened again every hour
+#average volume is shares per minute over the last 30 minutes, volatility is the percent standard deviation of the minute returns
+if SCREEN_UNIVERSE:
+    universe_screener = UniverseScreener(my_strat_collector.alpaca, new_number_of_data_points=30, new_refresh_seconds=3600)
+    universe_screener.add_tier(UniverseTier("High Tier", new_min_price=100.0, new_min_average_volume=5000, new_max_symbols=50), [strat1])
+    universe_screener.add_tier(UniverseTier("Medium Tier", new_min_price=10.0, new_max_price=100.0, new_min_average_volume=50000, new_max_symbols=50), [strat4])
+    universe_screener.add_tier(UniverseTier("Low Tier", new_min_price=5.0, new_max_price=100.0, new_min_average_volume=500, new_max_average_volume=50000,
+                                            new_min_volatility=0.05, new_max_symbols=200), [strat5])
+    my_strat_collector.set_universe_screener(universe_screener)
+
+
 
 my_strat_collector.awaitMarketOpen()
 my_strat_collector.run_strat_collector()
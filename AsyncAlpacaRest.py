@@ -0,0 +1,166 @@
+"""
+    This class is an asyncio version of the parts of alpaca_trade_api's REST object this project uses.
+
+    Every request goes through one pooled keep-alive aiohttp session, and a semaphore caps how many requests are in flight at once,
+    so independent requests (clock, chunks of bars, positions, orders) can be awaited together and a tick takes about as long as its slowest request.
+    It returns the same entity objects as tradeapi.REST, so the strategies can't tell the difference.
+
+    base_url and data_url can point at a local stand-in HTTP server for testing.
+
+"""
+
+#basic libraries
+import asyncio
+import aiohttp
+
+#algo brokerage api
+from alpaca_trade_api.entity import Account, AccountConfigurations, BarSet, Clock, Order, Position
+from alpaca_trade_api.rest import APIError
+
+
+class AsyncAlpacaRest():
+
+    def __init__(self, new_key_id, new_secret_key, new_base_url, new_data_url="https://data.alpaca.markets", new_max_concurrent_requests=10):
+        self.key_id = str(new_key_id)
+        self.secret_key = str(new_secret_key)
+        self.base_url = new_base_url.rstrip('/')
+        self.data_url = new_data_url.rstrip('/')
+        self.max_concurrent_requests = new_max_concurrent_requests
+
+        self.session = None
+        self.semaphore = None
+        self.requests_made = 0
+
+
+    async def open(self):
+        if self.session is None:
+            #one connection per allowed concurrent request, kept alive between ticks
+            connector = aiohttp.TCPConnector(limit=self.max_concurrent_requests, keepalive_timeout=60)
+            headers = {'APCA-API-KEY-ID': self.key_id, 'APCA-API-SECRET-KEY': self.secret_key}
+            self.session = aiohttp.ClientSession(connector=connector, headers=headers)
+            self.semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+    async def request(self, method, url, data=None):
+        await self.open()
+
+        options = {'allow_redirects': False}
+        if method in ('GET', 'DELETE'):
+            options['params'] = data
+        else:
+            options['json'] = data
+
+        async with self.semaphore:
+            self.requests_made += 1
+            async with self.session.request(method, url, **options) as response:
+                text = await response.text()
+                if response.status >= 400:
+                    #same error the synchronous REST object raises
+                    if 'code' in text:
+                        error = await response.json(content_type=None)
+                        raise APIError(error)
+                    response.raise_for_status()
+                if text != '':
+                    return await response.json(content_type=None)
+                return None
+
+
+    async def get(self, path, data=None):
+        return await self.request('GET', self.base_url + '/v2' + path, data)
+
+
+    async def post(self, path, data=None):
+        return await self.request('POST', self.base_url + '/v2' + path, data)
+
+
+    async def patch(self, path, data=None):
+        return await self.request('PATCH', self.base_url + '/v2' + path, data)
+
+
+    async def delete(self, path, data=None):
+        return await self.request('DELETE', self.base_url + '/v2' + path, data)
+
+
+    async def get_clock(self):
+        return Clock(await self.get('/clock'))
+
+
+    async def get_account(self):
+        return Account(await self.get('/account'))
+
+
+    async def get_account_configurations(self):
+        return AccountConfigurations(await self.get('/account/configurations'))
+
+
+    async def update_account_configurations(self, no_shorting=None, dtbp_check=None, trade_confirm_email=None, suspend_trade=None):
+        params = {}
+        if no_shorting is not None:
+            params['no_shorting'] = no_shorting
+        if dtbp_check is not None:
+            params['dtbp_check'] = dtbp_check
+        if trade_confirm_email is not None:
+            params['trade_confirm_email'] = trade_confirm_email
+        if suspend_trade is not None:
+            params['suspend_trade'] = suspend_trade
+        return AccountConfigurations(await self.patch('/account/configurations', params))
+
+
+    #based on the /v1 version of the API, like get_barset in BasicStrategy
+    async def get_barset(self, symbols, timeframe, limit=None, start=None, end=None, after=None, until=None):
+        if not isinstance(symbols, str):
+            symbols = ','.join(symbols)
+        params = {'symbols': symbols}
+        for key, value in (('limit', limit), ('start', start), ('end', end), ('after', after), ('until', until)):
+            if value is not None:
+                params[key] = value
+        return BarSet(await self.request('GET', self.data_url + '/v1/bars/' + timeframe, params))
+
+
+    async def list_positions(self):
+        return [Position(raw) for raw in await self.get('/positions')]
+
+
+    async def list_orders(self, status=None, limit=None):
+        params = {}
+        if status is not None:
+            params['status'] = status
+        if limit is not None:
+            params['limit'] = limit
+        return [Order(raw) for raw in await self.get('/orders', params)]
+
+
+    async def submit_order(self, symbol, qty=None, side=None, type=None, time_in_force=None, limit_price=None, stop_price=None,
+                           client_order_id=None, order_class=None, take_profit=None, stop_loss=None, trail_price=None, trail_percent=None):
+        params = {'symbol': symbol, 'side': side, 'type': type, 'time_in_force': time_in_force}
+        optional_params = (('qty', qty), ('limit_price', limit_price), ('stop_price', stop_price), ('client_order_id', client_order_id),
+                           ('order_class', order_class), ('take_profit', take_profit), ('stop_loss', stop_loss),
+                           ('trail_price', trail_price), ('trail_percent', trail_percent))
+        for key, value in optional_params:
+            if value is not None:
+                params[key] = value
+        return Order(await self.post('/orders', params))
+
+
+    async def cancel_order(self, order_id):
+        await self.delete('/orders/{}'.format(order_id))
+
+
+    async def close_position(self, symbol):
+        #alpaca answers with the market order that closes the position
+        return Order(await self.delete('/positions/{}'.format(symbol)))
@@ -0,0 +1,256 @@
+"""
+    This class replays stored minute bars through unmodified BasicStrategy subclasses, using a SimulatedBroker in place of alpaca.
+
+    Bars are read from columnar .npy files, one directory per stock with t (epoch seconds), o, h, l, c and v,
+    opened memory-mapped so years of data for hundreds of stocks never has to fit in memory.
+    The replay goes one day at a time: each stock's bars for that day (plus enough earlier bars for the longest window)
+    are aligned once, then every minute the last bars of every stock are gathered with a single numpy indexing step
+    and handed to the StrategyCollector's cache, so run_tick never builds a barset.
+
+    The StrategyCollector and the strategies run exactly as they do live, only without the clock checks and the wait.
+    The result is the SimulatedBroker's trade log plus a profit and loss summary.
+
+"""
+
+#basic libraries
+import os
+import time
+import logging
+import contextlib
+import numpy as np
+import pandas as pd
+
+from StrategyCollector import StrategyCollector
+from MarketDataCache import MarketDataCache
+from SimulatedBroker import SimulatedBroker
+from BarStore import BAR_COLUMNS
+from EventLog import EventLog, ROOT_LOGGER_NAME, set_event_log_level
+
+
+event_log = EventLog('backtest')
+
+
+def write_bar_files(directory, symbol, columns):
+    #one .npy file per column so the engine can memory map each one
+    symbol_directory = os.path.join(directory, symbol)
+    os.makedirs(symbol_directory, exist_ok=True)
+    for name in BAR_COLUMNS:
+        dtype = np.int64 if name == 't' else np.float64
+        np.save(os.path.join(symbol_directory, name + '.npy'), np.asarray(columns[name], dtype=dtype))
+
+
+def read_bar_files(directory, symbol):
+    symbol_directory = os.path.join(directory, symbol)
+    return {name: np.load(os.path.join(symbol_directory, name + '.npy'), mmap_mode='r') for name in BAR_COLUMNS}
+
+
+
+class BacktestMarketData(MarketDataCache):
+
+    #the collector calls refresh every tick, here it loads the window the engine already gathered instead of calling the broker
+    #the window is the engine's own arrays, so there is no BarValidator to empty rows of it, and a replay keeps every stock ParameterSweep would
+    def __init__(self, new_engine):
+        MarketDataCache.__init__(self, new_engine.broker)
+        self.engine = new_engine
+
+    def refresh(self, symbols, number_of_data_points, number_of_data_points_by_symbol=None):
+        close_matrix, volume_matrix, timestamp_matrix, bar_counts = self.engine.get_current_window(number_of_data_points)
+        self.load_matrices(self.engine.symbols, close_matrix, volume_matrix, timestamp_matrix, bar_counts)
+
+
+
+class BacktestEngine():
+
+    def __init__(self, new_bar_directory, new_starting_cash=100000.0, new_slippage_percent=0.0, new_quiet=True):
+        self.bar_directory = new_bar_directory
+        self.quiet = new_quiet
+
+        self.broker = SimulatedBroker(new_starting_cash, new_slippage_percent)
+        self.broker.bar_source = self
+
+        #the strategies' events are the slowest part of a replay, only warnings and errors are kept unless asked for
+        with self.get_output_context():
+            #the simulated account is in memory, the ledger reads it fresh on every check instead of on the wall clock's ttl
+            self.collector = StrategyCollector(self.broker, new_account_ttl_seconds=0.0)
+        self.collector.market_data = BacktestMarketData(self)
+
+        self.symbols = []
+        self.bars = {}
+        self.equity_curve = []
+        self.equity_times = []
+        self.ticks_processed = 0
+        self.seconds_elapsed = 0.0
+
+
+    @contextlib.contextmanager
+    def get_output_context(self):
+        if not self.quiet:
+            yield
+            return
+        #dropped by the level check before they are formatted or queued
+        level = logging.getLogger(ROOT_LOGGER_NAME).level
+        set_event_log_level(logging.WARNING)
+        try:
+            yield
+        finally:
+            set_event_log_level(level)
+
+
+    def append_strat(self, new_strat):
+        #strategies have to be built with engine.broker as their trade api
+        with self.get_output_context():
+            self.collector.append_strat(new_strat)
+
+
+    def load_symbols(self):
+        self.symbols = self.collector.market_data.gather_symbols_from_strategies(self.collector.strat_list)
+        self.bars = {symbol: read_bar_files(self.bar_directory, symbol) for symbol in self.symbols}
+        self.broker.set_symbols(self.symbols)
+        self.lookback = max(1, self.collector.market_data.get_number_of_data_points_for_strategies(self.collector.strat_list))
+
+
+    def get_days(self, start, end):
+        first = min((int(bars['t'][0]) for bars in self.bars.values() if len(bars['t']) > 0), default=None)
+        last = max((int(bars['t'][-1]) for bars in self.bars.values() if len(bars['t']) > 0), default=None)
+        if first is None:
+            return []
+        if start is not None:
+            first = max(first, int(pd.Timestamp(start, tz='UTC').timestamp()))
+        if end is not None:
+            last = min(last, int(pd.Timestamp(end, tz='UTC').timestamp()))
+        first_day = first - first % 86400
+        return [(day, day + 86400) for day in range(first_day, last + 1, 86400)]
+
+
+    def prepare_day(self, day_start, day_end):
+        #copies this day's bars plus lookback earlier bars of every stock into flat arrays, and counts for every minute of the day
+        #how many of each stock's bars have closed, that count is all a tick needs to gather its window
+        slices = {name: [] for name in BAR_COLUMNS}
+        self.day_first_index = np.zeros(len(self.symbols), dtype=np.int64)
+        offsets = np.zeros(len(self.symbols), dtype=np.int64)
+        day_timestamps = []
+
+        offset = 0
+        for row, symbol in enumerate(self.symbols):
+            timestamps = self.bars[symbol]['t']
+            first_of_day = int(np.searchsorted(timestamps, day_start, side='left'))
+            end_of_day = int(np.searchsorted(timestamps, day_end, side='left'))
+            first = max(0, first_of_day - self.lookback)
+
+            for name in BAR_COLUMNS:
+                slices[name].append(np.asarray(self.bars[symbol][name][first:end_of_day]))
+            day_timestamps.append(slices['t'][-1][first_of_day - first:])
+
+            self.day_first_index[row] = first
+            offsets[row] = offset
+            offset += end_of_day - first
+
+        self.day_columns = {name: np.concatenate(slices[name]) if offset > 0 else np.zeros(0) for name in BAR_COLUMNS}
+        self.day_offsets = offsets
+        self.day_timeline = np.unique(np.concatenate(day_timestamps)) if len(day_timestamps) > 0 else np.zeros(0, dtype=np.int64)
+
+        self.day_counts = np.zeros((len(self.symbols), len(self.day_timeline)), dtype=np.int64)
+        for row in range(len(self.symbols)):
+            start = offsets[row]
+            end = offsets[row + 1] if row + 1 < len(self.symbols) else offset
+            self.day_counts[row] = np.searchsorted(self.day_columns['t'][start:end], self.day_timeline, side='right')
+
+
+    def gather_tick(self, tick):
+        #every stock's last lookback bars at this minute, right aligned with nan padding, in one fancy indexing step
+        counts = self.day_counts[:, tick]
+        positions = counts[:, None] + np.arange(-self.lookback, 0)[None, :]
+        valid = positions >= 0
+        index = np.where(valid, self.day_offsets[:, None] + positions, 0)
+
+        if len(self.day_columns['t']) > 0:
+            self.window_close = np.where(valid, self.day_columns['c'][index], np.nan)
+            self.window_volume = np.where(valid, self.day_columns['v'][index], np.nan)
+            self.window_timestamp = np.where(valid, self.day_columns['t'][index], 0)
+        self.window_counts = np.minimum(counts, self.lookback)
+
+        self.window_global_end = self.day_first_index + counts
+        has_bars = counts > 0
+        last_index = np.minimum(self.day_offsets + np.maximum(counts - 1, 0), len(self.day_columns['t']) - 1)
+        now = int(self.day_timeline[tick])
+        has_new_bar = has_bars & (self.day_columns['t'][last_index] == now)
+
+        self.broker.set_last_bars(now, self.day_columns['o'][last_index], self.day_columns['h'][last_index],
+                                  self.day_columns['l'][last_index], np.where(has_bars, self.day_columns['c'][last_index], np.nan), has_new_bar)
+
+
+    def get_current_window(self, number_of_data_points):
+        columns = slice(self.lookback - number_of_data_points, self.lookback)
+        bar_counts = np.minimum(self.window_counts, number_of_data_points)
+        return self.window_close[:, columns], self.window_volume[:, columns], self.window_timestamp[:, columns], bar_counts
+
+
+    def get_minute_bars(self, symbol, count, until=None):
+        #for strategies that ask the broker for bars directly, read straight from the memory mapped files
+        row = self.broker.symbol_row[symbol]
+        end = int(self.window_global_end[row])
+        if until is not None:
+            end = min(end, int(np.searchsorted(self.bars[symbol]['t'], until, side='right')))
+        start = max(0, end - count)
+        return {name: np.asarray(self.bars[symbol][name][start:end]) for name in BAR_COLUMNS}
+
+
+    def run(self, start=None, end=None):
+
+        self.load_symbols()
+        started = time.time()
+
+        with self.get_output_context():
+            for day_start, day_end in self.get_days(start, end):
+                self.prepare_day(day_start, day_end)
+                if len(self.day_columns['t']) == 0:
+                    continue
+
+                for tick in range(len(self.day_timeline)):
+                    self.gather_tick(tick)
+                    self.collector.run_tick()
+
+                    self.equity_times.append(int(self.day_timeline[tick]))
+                    self.equity_curve.append(self.broker.get_equity())
+                    self.ticks_processed += 1
+
+            self.collector.close_process_pool()
+
+        self.seconds_elapsed = time.time() - started
+        return self.get_summary()
+
+
+    def get_trade_log(self):
+        trade_log = pd.DataFrame(self.broker.trade_log, columns=['time', 'symbol', 'side', 'qty', 'price', 'type', 'order_id', 'client_order_id', 'realized_pl'])
+        trade_log['time'] = pd.to_datetime(trade_log['time'], unit='s', utc=True)
+        return trade_log
+
+
+    def save_trade_log(self, path):
+        self.get_trade_log().to_csv(path, index=False)
+
+
+    def get_summary(self):
+        equity_curve = np.array(self.equity_curve) if len(self.equity_curve) > 0 else np.array([self.broker.starting_cash])
+        drawdowns = np.maximum.accumulate(equity_curve) - equity_curve
+        round_trips = [trade['realized_pl'] for trade in self.broker.trade_log if trade['realized_pl'] is not None]
+        winning_round_trips = sum(1 for realized_pl in round_trips if realized_pl > 0)
+
+        return {
+            'starting_cash': self.broker.starting_cash,
+            'ending_equity': float(equity_curve[-1]),
+            'total_return_percent': float((equity_curve[-1] / self.broker.starting_cash - 1) * 100),
+            'realized_pl': self.broker.realized_pl,
+            'max_drawdown': float(drawdowns.max()),
+            'number_of_fills': len(self.broker.trade_log),
+            'number_of_round_trips': len(round_trips),
+            'win_rate': winning_round_trips / len(round_trips) if len(round_trips) > 0 else 0.0,
+            'rejected_orders': self.broker.rejected_orders,
+            'opportunities_found': sum(strat.opportunities_found_this_run for strat in self.collector.strat_list),
+            'ticks_processed': self.ticks_processed,
+            'seconds_elapsed': self.seconds_elapsed,
+        }
+
+
+    def print_summary(self):
+        event_log.info('backtest_summary', **self.get_summary())
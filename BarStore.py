@@ -0,0 +1,322 @@
+"""
+    This class keeps every minute bar ever fetched on disk, so a tick or a restart only asks the broker for the bars it doesn't have yet.
+
+    The files use the BacktestEngine's layout, one directory per stock with one .npy file per column (t, o, h, l, c, v),
+    so the same directory can be backtested or swept later.
+    Each file is opened once as a writable memory map with spare room at the end: new bars are written into that room
+    and only the .npy header's length is rewritten (numpy pads the header so it never changes size), nothing is copied or reopened.
+    The last N bars of a stock are a slice of the memory map, no copy.
+
+    update splits the stocks into requests of symbols_per_request, oldest newest bar first, and asks each request for the bars after
+    the oldest newest bar in it, in windows of at most chunk_minutes so no window can hold more bars than one request returns.
+    append_bars drops the bars a stock already has, so a stock that trades every minute costs nothing extra for sharing a request with one that doesn't.
+    A stock is remembered as checked up to the minute before the newest bar its request got, even when it got no bar itself,
+    so a thin stock's old last trade doesn't make its request ask for hours of bars every tick.
+    A stock with nothing stored, or whose newest bar is older than max_gap_minutes, only gets its latest bars.
+    backfill walks a date range forward in the same windows; the newest stored bar is where it left off,
+    so running it again after an interruption continues instead of starting over.
+
+"""
+
+#basic libraries
+import os
+import time
+import asyncio
+import numpy as np
+import pandas as pd
+
+from EventLog import EventLog
+
+
+event_log = EventLog('bar_store')
+
+
+BAR_COLUMNS = ('t', 'o', 'h', 'l', 'c', 'v')
+HEADER_LENGTH = 128
+
+
+def get_column_dtype(name):
+    return np.dtype(np.int64) if name == 't' else np.dtype(np.float64)
+
+
+def get_npy_header(name, count):
+    header = np.lib.format.header_data_from_array_1_0(np.zeros(0, dtype=get_column_dtype(name)))
+    header['shape'] = (count,)
+    fp = FixedHeaderWriter()
+    np.lib.format.write_array_header_1_0(fp, header)
+    if len(fp.data) != HEADER_LENGTH:
+        raise ValueError(f'unexpected .npy header length {len(fp.data)}')
+    return np.frombuffer(fp.data, dtype=np.uint8)
+
+
+def get_timestamp_string(timestamp):
+    return pd.Timestamp(int(timestamp), unit='s', tz='UTC').isoformat()
+
+
+
+class FixedHeaderWriter():
+
+    #numpy writes the header to a file object, this collects it so it can go into the memory map instead
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+
+
+class BarStore():
+
+    def __init__(self, new_directory, new_trade_api_rest=None, new_symbols_per_request=200, new_chunk_minutes=1000, new_max_gap_minutes=7 * 24 * 60):
+        self.directory = new_directory
+        self.alpaca = new_trade_api_rest
+        self.symbols_per_request = new_symbols_per_request
+        self.chunk_minutes = new_chunk_minutes
+        self.max_gap_minutes = new_max_gap_minutes
+
+        #symbol -> {'count', 'capacity', 'files' (whole file uint8 maps), 'columns' (typed views past the header)}
+        self.stored = {}
+        #symbol -> the newest bar start an update already asked for, kept in memory only, a restart asks from the stored bars again
+        self.checked_until = {}
+        self.requests_made_last_update = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    #----- files -----
+
+    def get_stored(self, symbol):
+        if symbol not in self.stored:
+            self.stored[symbol] = self.open_symbol(symbol)
+        return self.stored[symbol]
+
+
+    def open_symbol(self, symbol):
+        symbol_directory = os.path.join(self.directory, symbol)
+        stored = {'count': 0, 'capacity': 0, 'files': {}, 'columns': {}}
+        if not os.path.exists(os.path.join(symbol_directory, 't.npy')):
+            return stored
+
+        #the header says how many bars were written, anything past that is spare room
+        with open(os.path.join(symbol_directory, 't.npy'), 'rb') as fp:
+            np.lib.format.read_magic(fp)
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+            if fp.tell() != HEADER_LENGTH:
+                raise ValueError(f'{symbol} bars were not written by BarStore or BacktestEngine.write_bar_files')
+        stored['count'] = int(shape[0])
+        self.map_files(symbol, stored)
+        return stored
+
+
+    def map_files(self, symbol, stored):
+        symbol_directory = os.path.join(self.directory, symbol)
+        stored['files'] = {}
+        stored['columns'] = {}
+        for name in BAR_COLUMNS:
+            path = os.path.join(symbol_directory, name + '.npy')
+            stored['files'][name] = np.memmap(path, dtype=np.uint8, mode='r+')
+            stored['columns'][name] = stored['files'][name][HEADER_LENGTH:].view(get_column_dtype(name))
+        stored['capacity'] = len(stored['columns']['t'])
+
+
+    def grow(self, symbol, stored, needed):
+        #doubling keeps the number of regrowths logarithmic in the number of bars
+        capacity = max(needed, 2 * stored['capacity'], 1024)
+        symbol_directory = os.path.join(self.directory, symbol)
+        os.makedirs(symbol_directory, exist_ok=True)
+
+        for files in stored['files'].values():
+            files.flush()
+        stored['files'] = {}
+        stored['columns'] = {}
+
+        for name in BAR_COLUMNS:
+            path = os.path.join(symbol_directory, name + '.npy')
+            mode = 'r+b' if os.path.exists(path) else 'w+b'
+            with open(path, mode) as fp:
+                fp.write(get_npy_header(name, stored['count']).tobytes())
+                fp.truncate(HEADER_LENGTH + capacity * get_column_dtype(name).itemsize)
+        self.map_files(symbol, stored)
+
+
+    def append_bars(self, symbol, columns):
+        #keeps only bars newer than the newest stored one, so overlapping fetches can be appended as they are
+        stored = self.get_stored(symbol)
+        timestamps = np.asarray(columns['t'], dtype=np.int64)
+        last_timestamp = self.get_last_timestamp(symbol)
+        keep = np.ones(len(timestamps), dtype=bool) if last_timestamp is None else timestamps > last_timestamp
+        if not keep.any():
+            return 0
+
+        order = np.argsort(timestamps[keep], kind='stable')
+        count = stored['count']
+        new_count = count + len(order)
+        if new_count > stored['capacity']:
+            self.grow(symbol, stored, new_count)
+
+        for name in BAR_COLUMNS:
+            stored['columns'][name][count:new_count] = np.asarray(columns[name])[keep][order]
+        #the headers go last, bars past the old length are invisible until they are complete
+        for name in BAR_COLUMNS:
+            stored['files'][name][:HEADER_LENGTH] = get_npy_header(name, new_count)
+        stored['count'] = new_count
+        return len(order)
+
+
+    def append_barset(self, symbols, barset):
+        #returns the newest bar start in the barset, None when it has no bars
+        newest_timestamp = None
+        for symbol in symbols:
+            bars = barset.get(symbol)
+            if not bars:
+                continue
+            raw_bars = bars._raw
+            self.append_bars(symbol, {name: [bar[name] for bar in raw_bars] for name in BAR_COLUMNS})
+            newest_timestamp = max(newest_timestamp or 0, int(raw_bars[-1]['t']))
+        return newest_timestamp
+
+
+    def flush(self):
+        for stored in self.stored.values():
+            for files in stored['files'].values():
+                files.flush()
+
+
+    #----- reading, every slice is a view of the memory map -----
+
+    def get_bar_count(self, symbol):
+        return self.get_stored(symbol)['count']
+
+
+    def get_last_timestamp(self, symbol):
+        stored = self.get_stored(symbol)
+        if stored['count'] == 0:
+            return None
+        return int(stored['columns']['t'][stored['count'] - 1])
+
+
+    def has_data(self, symbol, number_of_data_points):
+        return self.get_bar_count(symbol) >= number_of_data_points
+
+
+    def get_last_bars(self, symbol, number_of_data_points):
+        stored = self.get_stored(symbol)
+        count = stored['count']
+        start = max(0, count - number_of_data_points)
+        if count == 0:
+            return {name: np.zeros(0, dtype=get_column_dtype(name)) for name in BAR_COLUMNS}
+        return {name: stored['columns'][name][start:count] for name in BAR_COLUMNS}
+
+
+    def get_close_prices(self, symbol, number_of_data_points):
+        return self.get_last_bars(symbol, number_of_data_points)['c']
+
+
+    def get_volumes(self, symbol, number_of_data_points):
+        return self.get_last_bars(symbol, number_of_data_points)['v']
+
+
+    def get_timestamps(self, symbol, number_of_data_points):
+        return self.get_last_bars(symbol, number_of_data_points)['t']
+
+
+    #----- fetching only what is missing -----
+
+    def get_checked_until(self, symbol):
+        #the newest bar start this store knows about, a stored bar or an update that came back without one
+        last_timestamp = self.get_last_timestamp(symbol)
+        checked_until = self.checked_until.get(symbol)
+        if checked_until is None or (last_timestamp is not None and last_timestamp >= checked_until):
+            return last_timestamp
+        return checked_until
+
+
+    def mark_checked(self, requests, newest_timestamps):
+        #called once every request of an update came back, a failed update leaves the stocks where their stored bars are
+        #the newest bar any stock in a request got is as far as the broker had bars, the minute before it in case a thin stock's bar came late
+        checked = {}
+        for (chunk, window), newest_timestamp in zip(requests, newest_timestamps):
+            if newest_timestamp is not None:
+                for symbol in chunk:
+                    checked[symbol] = max(checked.get(symbol, 0), newest_timestamp - 60)
+        self.checked_until.update(checked)
+
+
+    def get_update_requests(self, symbols, number_of_data_points, now=None):
+        #one (symbols, get_barset keyword arguments) pair per request, at most symbols_per_request stocks each
+        if now is None:
+            now = time.time()
+        oldest_allowed = now - self.max_gap_minutes * 60
+
+        without_bars = []
+        behind = []
+        for symbol in symbols:
+            checked_until = self.get_checked_until(symbol)
+            if checked_until is None or checked_until < oldest_allowed:
+                without_bars.append(symbol)
+            else:
+                behind.append((checked_until, symbol))
+        #stocks that are about as far behind share requests, one stale stock only widens the window of its own request
+        behind.sort(key=lambda pair: pair[0])
+
+        requests = []
+        for chunk_start in range(0, len(without_bars), self.symbols_per_request):
+            requests.append((without_bars[chunk_start:chunk_start + self.symbols_per_request], {'limit': number_of_data_points}))
+        for chunk_start in range(0, len(behind), self.symbols_per_request):
+            chunk = behind[chunk_start:chunk_start + self.symbols_per_request]
+            after = max(chunk[0][0], int(oldest_allowed))
+            requests.extend(([symbol for checked_until, symbol in chunk], window) for window in self.get_windows(after, now))
+        return requests
+
+
+    def get_windows(self, after, until):
+        #chunk_minutes can hold at most chunk_minutes bars, so one request per window gets them all
+        windows = []
+        while after < until:
+            window_end = min(until, after + self.chunk_minutes * 60)
+            windows.append({'limit': self.chunk_minutes, 'after': get_timestamp_string(after), 'until': get_timestamp_string(window_end)})
+            after = window_end
+        return windows
+
+
+    def update(self, symbols, number_of_data_points, now=None):
+        requests = self.get_update_requests(symbols, number_of_data_points, now)
+        newest_timestamps = [self.append_barset(chunk, self.alpaca.get_barset(chunk, 'minute', **window)) for chunk, window in requests]
+        self.mark_checked(requests, newest_timestamps)
+        self.requests_made_last_update = len(requests)
+        return self.requests_made_last_update
+
+
+    async def update_async(self, async_rest, symbols, number_of_data_points, now=None):
+        requests = self.get_update_requests(symbols, number_of_data_points, now)
+        barsets = await asyncio.gather(*[async_rest.get_barset(chunk, 'minute', **window) for chunk, window in requests])
+        newest_timestamps = [self.append_barset(chunk, barset) for (chunk, window), barset in zip(requests, barsets)]
+        self.mark_checked(requests, newest_timestamps)
+        self.requests_made_last_update = len(requests)
+        return self.requests_made_last_update
+
+
+    def backfill(self, symbols, start, end=None):
+        #walks forward from each stock's newest stored bar (or start), appending every window as soon as it arrives
+        start_timestamp = int(pd.Timestamp(start, tz='UTC').timestamp()) if not isinstance(start, (int, float)) else int(start)
+        if end is None:
+            end_timestamp = int(time.time())
+        else:
+            end_timestamp = int(pd.Timestamp(end, tz='UTC').timestamp()) if not isinstance(end, (int, float)) else int(end)
+
+        groups = {}
+        for symbol in symbols:
+            last_timestamp = self.get_last_timestamp(symbol)
+            resume_from = start_timestamp if last_timestamp is None else max(start_timestamp, last_timestamp)
+            groups.setdefault(resume_from, []).append(symbol)
+
+        requests_made = 0
+        for resume_from, group in groups.items():
+            for chunk_start in range(0, len(group), self.symbols_per_request):
+                chunk = group[chunk_start:chunk_start + self.symbols_per_request]
+                for window in self.get_windows(resume_from, end_timestamp):
+                    self.append_barset(chunk, self.alpaca.get_barset(chunk, 'minute', **window))
+                    requests_made += 1
+                event_log.info('backfilled', stocks=len(chunk), until=get_timestamp_string(end_timestamp), requests=requests_made)
+
+        self.flush()
+        return requests_made
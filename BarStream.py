@@ -0,0 +1,119 @@
+"""
+    These classes push minute bars to the StrategyCollector as soon as each bar closes, instead of the collector polling once a minute.
+
+    A feed's run(symbols, on_bar) calls on_bar(symbol, bar) for every bar, bar being a dict with t (bar start, epoch seconds),
+    o, h, l, c and v, the same fields as a /v1 barset row.
+
+    AlpacaBarFeed subscribes to alpaca's minute bar stream.
+    ReplayBarFeed plays bars stored in the BacktestEngine/BarStore layout back in time order, as fast as possible or with a wait
+    between minutes, and can drop the connection after some minutes to test the collector's fallback to polling.
+
+"""
+
+#basic libraries
+import asyncio
+import numpy as np
+
+#algo brokerage api
+from alpaca_trade_api.common import get_data_stream_url
+from alpaca_trade_api.stream import DataStream
+
+from BarStore import BAR_COLUMNS
+from BacktestEngine import read_bar_files
+
+
+class AlpacaBarFeed():
+
+    def __init__(self, new_key_id, new_secret_key, new_data_stream_url=None, new_data_feed='iex'):
+        self.key_id = str(new_key_id)
+        self.secret_key = str(new_secret_key)
+        self.data_stream_url = new_data_stream_url or get_data_stream_url()
+        self.data_feed = new_data_feed
+        self.stream = None
+
+
+    async def run(self, symbols, on_bar):
+        #raw messages skip building an entity per bar, the websocket reconnects by itself when it can
+        self.stream = DataStream(self.key_id, self.secret_key, self.data_stream_url, True, self.data_feed)
+
+        async def handle_bar(bar):
+            on_bar(bar['S'], get_stream_bar(bar))
+
+        self.stream.subscribe_bars(handle_bar, *symbols)
+        await self.stream._run_forever()
+
+
+    async def stop(self):
+        if self.stream is not None:
+            await self.stream.stop_ws()
+            await self.stream.close()
+            self.stream = None
+
+
+
+def get_stream_bar(message):
+    #the stream's bar start is a msgpack Timestamp
+    timestamp = message['t']
+    if hasattr(timestamp, 'seconds'):
+        timestamp = timestamp.seconds
+    return {'t': int(timestamp), 'o': message['o'], 'h': message['h'], 'l': message['l'], 'c': message['c'], 'v': message['v']}
+
+
+
+class ReplayBarFeed():
+
+    def __init__(self, new_bar_directory, new_start_timestamp=None, new_end_timestamp=None, new_seconds_per_minute=0.0, new_drop_after_minutes=None):
+        self.bar_directory = new_bar_directory
+        self.start_timestamp = new_start_timestamp
+        self.end_timestamp = new_end_timestamp
+        self.seconds_per_minute = new_seconds_per_minute
+        self.drop_after_minutes = new_drop_after_minutes
+        self.bars_sent = 0
+        self.stopped = False
+
+
+    def get_replay_order(self, symbols):
+        #every stock's bars in one list sorted by time, stocks keep their list order within a minute
+        columns = {name: [] for name in BAR_COLUMNS}
+        rows = []
+        for row, symbol in enumerate(symbols):
+            bars = read_bar_files(self.bar_directory, symbol)
+            timestamps = np.asarray(bars['t'])
+            keep = np.ones(len(timestamps), dtype=bool)
+            if self.start_timestamp is not None:
+                keep &= timestamps >= self.start_timestamp
+            if self.end_timestamp is not None:
+                keep &= timestamps <= self.end_timestamp
+            for name in BAR_COLUMNS:
+                columns[name].append(np.asarray(bars[name])[keep])
+            rows.append(np.full(int(keep.sum()), row))
+
+        columns = {name: np.concatenate(values) if len(values) > 0 else np.zeros(0) for name, values in columns.items()}
+        rows = np.concatenate(rows) if len(rows) > 0 else np.zeros(0, dtype=np.int64)
+        order = np.argsort(columns['t'], kind='stable')
+        return {name: values[order] for name, values in columns.items()}, rows[order]
+
+
+    async def run(self, symbols, on_bar):
+        columns, rows = self.get_replay_order(list(symbols))
+        minutes_sent = 0
+        previous_timestamp = None
+
+        for i in range(len(rows)):
+            if self.stopped:
+                return
+            timestamp = int(columns['t'][i])
+            if previous_timestamp is not None and timestamp != previous_timestamp:
+                minutes_sent += 1
+                if self.drop_after_minutes is not None and minutes_sent >= self.drop_after_minutes:
+                    raise ConnectionError(f'replay feed dropped after {minutes_sent} minutes')
+                #a wait of 0 still lets the collector evaluate the minute that just finished
+                await asyncio.sleep(self.seconds_per_minute)
+            previous_timestamp = timestamp
+
+            on_bar(symbols[rows[i]], {name: columns[name][i].item() for name in BAR_COLUMNS})
+            self.bars_sent += 1
+
+
+    async def stop(self):
+        self.stopped = True
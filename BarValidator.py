@@ -0,0 +1,188 @@
+"""
+    This class checks a whole block of minute bars (one row per stock, right aligned like the MarketDataCache's matrices) in one numpy pass
+    and keeps stocks whose bars keep failing out of the fetches and the signal math for a while.
+
+    Every row gets a reason code, the bits below or'ed together, 0 when its bars are usable:
+    no bars at all, fewer bars than the strategies need (truncated), a nan or a zero (or negative) price inside the window,
+    timestamps that go backwards or repeat, too many missing minutes inside a session, and a last bar that is older than the block's newest by
+    more than max_stale_minutes (a halted stock, or one nobody trades). A gap longer than session_gap_minutes is the market being closed, not missing bars.
+    A thinly traded stock has no bar for the minutes nobody traded it, so only a window with more missing minutes than max_missing_fraction of its bars is flagged.
+
+    Only a data fault (no bars, a nan or zero price, timestamps out of order) counts toward quarantine. A truncated window is just skipped for that refresh.
+    A stale or gappy window is only flagged, its bars are still screened: it is what a thinly traded stock looks like, and rejecting it would
+    leave every quiet stock the universe screener picks fetched every tick but never evaluated.
+    A stock with a data fault in failures_to_quarantine refreshes in a row is quarantined: it isn't fetched or screened for quarantine_refreshes refreshes,
+    doubling every time it is quarantined again, up to max_quarantine_refreshes. When it is let back in it is on probation, one more fault
+    quarantines it again for twice as long, one refresh without a fault forgives it.
+    The quarantine counts refreshes (validate calls) rather than seconds, so a loop that ticks every 15 minutes keeps a stock out for as many ticks
+    as one that ticks every minute.
+
+"""
+
+#basic libraries
+import numpy as np
+
+from EventLog import EventLog
+
+
+event_log = EventLog('bar_validator')
+
+
+NO_BARS = 1
+TRUNCATED = 2
+NAN_PRICE = 4
+ZERO_PRICE = 8
+UNORDERED = 16
+MISSING_MINUTES = 32
+STALE = 64
+QUARANTINED = 128
+
+#the reasons that count toward quarantine
+DATA_FAULTS = NO_BARS | NAN_PRICE | ZERO_PRICE | UNORDERED
+#the reasons a row's bars are thrown out for, MISSING_MINUTES and STALE only flag a quiet stock whose bars are still screened
+REJECTIONS = DATA_FAULTS | TRUNCATED | QUARANTINED
+
+REASON_NAMES = {NO_BARS: 'no_bars', TRUNCATED: 'truncated', NAN_PRICE: 'nan_price', ZERO_PRICE: 'zero_price', UNORDERED: 'unordered',
+                MISSING_MINUTES: 'missing_minutes', STALE: 'stale', QUARANTINED: 'quarantined'}
+
+
+def get_reason_names(code):
+    return [name for bit, name in REASON_NAMES.items() if code & bit]
+
+
+def validate_bar_block(close_matrix, timestamp_matrix, bar_counts, number_of_data_points, now_timestamp=None, price_matrices=(),
+                       max_missing_fraction=0.5, max_stale_minutes=5, session_gap_minutes=240):
+    #one reason code per row, number_of_data_points is one window length for every row or one per row
+    #only the last number_of_data_points columns of a row are checked, that is the window the strategies read
+    number_of_rows, width = close_matrix.shape
+    codes = np.zeros(number_of_rows, dtype=np.uint8)
+    if number_of_rows == 0:
+        return codes
+
+    needed = np.minimum(np.broadcast_to(np.asarray(number_of_data_points, dtype=np.int64), (number_of_rows,)), width)
+    bar_counts = np.asarray(bar_counts, dtype=np.int64)
+    in_window = np.minimum(bar_counts, needed)
+
+    codes[bar_counts == 0] |= NO_BARS
+    codes[(bar_counts > 0) & (bar_counts < needed)] |= TRUNCATED
+
+    #the columns holding a bar inside the window, the nan padding left of a short row is not checked
+    has_bar = np.arange(width)[None, :] >= width - in_window[:, None]
+
+    with np.errstate(invalid='ignore'):
+        for price_matrix in (close_matrix,) + tuple(price_matrices):
+            codes[(np.isnan(price_matrix) & has_bar).any(axis=1)] |= NAN_PRICE
+            codes[((price_matrix <= 0) & has_bar).any(axis=1)] |= ZERO_PRICE
+
+    #minute steps between neighbouring bars that are both in the window
+    steps = np.diff(timestamp_matrix, axis=1)
+    step_has_bars = has_bar[:, 1:] & has_bar[:, :-1]
+    codes[((steps <= 0) & step_has_bars).any(axis=1)] |= UNORDERED
+
+    missing = np.where(step_has_bars & (steps > 60) & (steps <= 60 * session_gap_minutes), steps // 60 - 1, 0).sum(axis=1)
+    codes[missing > max_missing_fraction * np.maximum(needed, 1)] |= MISSING_MINUTES
+
+    #the newest bar any stock has is the time the block was fetched at, unless the caller knows better
+    last_timestamps = timestamp_matrix[:, -1]
+    if now_timestamp is None:
+        now_timestamp = last_timestamps[bar_counts > 0].max() if (bar_counts > 0).any() else 0
+    codes[(bar_counts > 0) & (last_timestamps < now_timestamp - 60 * max_stale_minutes)] |= STALE
+    return codes
+
+
+
+class BarValidator():
+
+    def __init__(self, new_max_missing_fraction=0.5, new_max_stale_minutes=5, new_session_gap_minutes=240, new_failures_to_quarantine=3,
+                 new_quarantine_refreshes=2, new_max_quarantine_refreshes=240):
+        self.max_missing_fraction = new_max_missing_fraction
+        self.max_stale_minutes = new_max_stale_minutes
+        self.session_gap_minutes = new_session_gap_minutes
+        self.failures_to_quarantine = new_failures_to_quarantine
+        self.quarantine_refreshes = new_quarantine_refreshes
+        self.max_quarantine_refreshes = new_max_quarantine_refreshes
+
+        self.refresh_number = 0
+        #per stock: failed refreshes in a row, times quarantined since it was last clean, and the refresh its quarantine ends on
+        self.failure_streaks = {}
+        self.quarantine_counts = {}
+        self.quarantined_until = {}
+        self.last_codes = {}
+        self.quarantines_started = 0
+
+
+    #----- quarantine -----
+
+    def is_quarantined(self, symbol):
+        return symbol in self.quarantined_until
+
+
+    def get_symbols_to_fetch(self, symbols):
+        if len(self.quarantined_until) == 0:
+            return list(symbols)
+        return [symbol for symbol in symbols if symbol not in self.quarantined_until]
+
+
+    def release_expired(self):
+        for symbol in [symbol for symbol, until in self.quarantined_until.items() if until <= self.refresh_number]:
+            del self.quarantined_until[symbol]
+            #on probation, the next failure quarantines it again
+            self.failure_streaks[symbol] = self.failures_to_quarantine - 1
+            event_log.info('symbol_released', symbol=symbol, quarantines=self.quarantine_counts.get(symbol, 0))
+
+
+    def quarantine(self, symbol, code):
+        count = self.quarantine_counts.get(symbol, 0) + 1
+        self.quarantine_counts[symbol] = count
+        refreshes = min(self.quarantine_refreshes * 2 ** (count - 1), self.max_quarantine_refreshes)
+        #this refresh's bars were already fetched, the quarantine covers the next refreshes
+        self.quarantined_until[symbol] = self.refresh_number + refreshes + 1
+        self.quarantines_started += 1
+        event_log.warning('symbol_quarantined', symbol=symbol, reasons=get_reason_names(code), refreshes=refreshes, quarantines=count)
+
+
+    #----- validation -----
+
+    def start_refresh(self):
+        #a new round of bars, quarantines that are over end here so their stocks are fetched again
+        self.refresh_number += 1
+        self.release_expired()
+
+
+    def validate(self, symbols, close_matrix, timestamp_matrix, bar_counts, number_of_data_points, now_timestamp=None, price_matrices=()):
+        #reason codes lined up with symbols, quarantined stocks are marked QUARANTINED without being checked
+        codes = validate_bar_block(close_matrix, timestamp_matrix, bar_counts, number_of_data_points, now_timestamp, price_matrices,
+                                   self.max_missing_fraction, self.max_stale_minutes, self.session_gap_minutes)
+
+        #a quarantined stock is marked even when the bars it was given look fine
+        quarantined_rows = [row for row, symbol in enumerate(symbols) if symbol in self.quarantined_until] if len(self.quarantined_until) > 0 else []
+        for row in np.flatnonzero(codes):
+            symbol = symbols[row]
+            if symbol in self.quarantined_until:
+                continue
+            if not codes[row] & DATA_FAULTS:
+                continue
+            streak = self.failure_streaks.get(symbol, 0) + 1
+            self.failure_streaks[symbol] = streak
+            if streak >= self.failures_to_quarantine:
+                self.failure_streaks[symbol] = 0
+                self.quarantine(symbol, codes[row])
+        codes[quarantined_rows] = QUARANTINED
+
+        #a refresh without a data fault forgives the stock's failures and earlier quarantines, the dicts only hold stocks that failed
+        if len(self.failure_streaks) > 0 or len(self.quarantine_counts) > 0:
+            for row in np.flatnonzero((codes & (DATA_FAULTS | QUARANTINED)) == 0):
+                self.failure_streaks.pop(symbols[row], None)
+                self.quarantine_counts.pop(symbols[row], None)
+
+        self.last_codes = {symbols[row]: int(codes[row]) for row in np.flatnonzero(codes)}
+        if len(self.last_codes) > 0:
+            rejected = int(((codes & REJECTIONS) > 0).sum())
+            event_log.info('bars_rejected', stocks=len(symbols), rejected=rejected, flagged=len(self.last_codes) - rejected, quarantined=len(self.quarantined_until),
+                           reasons={name: int(((codes & bit) > 0).sum()) for bit, name in REASON_NAMES.items() if (codes & bit).any()})
+        return codes
+
+
+    def get_reasons(self, symbol):
+        #the reasons the stock's bars were rejected or flagged in the last refresh, empty when nothing was wrong with them
+        return get_reason_names(self.last_codes.get(symbol, 0))
@@ -6,6 +6,8 @@
 """
     
 #basic libraries
+import re
+import logging
 import pandas as pd
 import numpy as np
 import time
@@ -19,13 +21,22 @@ import alpaca_trade_api as tradeapi
 #stats package
 from statsmodels.tsa.stattools import adfuller
 
+from RollingSmaIndicator import RollingSmaIndicator
+from TickMetrics import TickMetrics
+from EventLog import EventLog
+from OrderPipeline import OrderIntent
+from AccountLedger import AccountLedger
+from OhlcvBars import OhlcvBars
+
+
+event_log = EventLog('strategy')
+
 
 class BasicStrategy():
     
     def __init__(self,new_name, new_trade_api_rest, new_stock_list,new_allocated_max):
         self.strat_name = new_name
         self.alpaca = new_trade_api_rest
-        self.account = self.alpaca.get_account()
         self.stock_list = new_stock_list
         self.money_allocated_to_this_strategy = new_allocated_max
         self.minimum_reserve_balance = 500
@@ -35,65 +46,299 @@ class BasicStrategy():
         #journal number for client id
         self.journal_id_int = 1
         #self.journal_reason = "" 
+        #alpaca wants client order ids unique across runs, the strategy name and start time keep them apart, the journal number within a run
+        self.client_order_id_prefix = re.sub('[^A-Za-z0-9]+', '-', str(new_name)).strip('-')[:20] + '-' + np.base_repr(int(time.time()), 36).lower()
+
+        #how often the strategy runs, in minutes, a 15 minute strategy only runs on ticks at a 15 minute bar close
+        self.cadence_minutes = 1
+
+        #shared MarketDataCache, FastAdf, BrokerStateSnapshot and BarStore, set by the StrategyCollector when this strategy is appended
+        self.market_data = None
+        self.adf_test = None
+        self.broker_state = None
+        self.bar_store = None
+
+        #stage timings, the StrategyCollector hands every strategy its own shared TickMetrics, disabled unless it was turned on
+        self.metrics = TickMetrics()
+
+        #with an OrderPipeline, buys are handed to it and placed on its threads instead of one after another in the loop
+        self.order_pipeline = None
+
+        #cash and reservations, the StrategyCollector replaces this with the one ledger every strategy shares
+        self.account_ledger = AccountLedger(self.alpaca)
+
+        #without a shared cache or bar store, the last minute bar fetch per stock, reused until the minute changes
+        self.ohlcv_by_stock = {}
+
+        #the last bar each stock's signals were worked out on and what they came to, a thinly traded stock without a new bar since
+        #the last tick gets the same answer again without its ADF test and SMAs being redone, stock by stock and screened on a matrix
+        self.skip_unchanged_stocks = True
+        self.evaluated_signals = {}
+        self.screened_by_stock = {}
+        self.unchanged_stocks_skipped = 0
 
 
     #override this
     def run_strategy(self):
-        print("This method is meant to be overridden in the child class. If this is printing, then that needs to be fixed.")
+        event_log.warning('method_not_overridden', strategy=self.strat_name, method='run_strategy')
+
+
+    #override this to evaluate only some stocks when their bars arrive from a stream, runs the whole strategy by default
+    def run_strategy_on_stocks(self, stocks):
+        self.run_strategy()
 
 
     #override this
     def sell_positions_over_threshold(self):
-        print("This method is meant to be overridden in the child class. If this is printing, then that needs to be fixed.")
+        event_log.warning('method_not_overridden', strategy=self.strat_name, method='sell_positions_over_threshold')
+
+
+    #override this, tells the MarketDataCache how many minute bars to fetch for this strategy's stocks
+    def get_number_of_minute_bars_needed(self):
+        return 0
+
+
+    #override these three to let the StrategyCollector split the signal math across worker processes
+    def can_screen_in_process_pool(self):
+        return False
+
+
+    def screen_stocks_on_matrix(self, stocks, close_price_np_matrix, last_bar_timestamps):
+        return []
+
+
+    def act_on_screened_stocks(self, screened_stocks):
+        event_log.warning('method_not_overridden', strategy=self.strat_name, method='act_on_screened_stocks')
+
+
+    #a copy sent to a worker process leaves the broker connection and the shared caches behind
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('alpaca', 'account_ledger', 'market_data', 'adf_test', 'broker_state', 'bar_store', 'metrics', 'order_pipeline'):
+            state[key] = None
+        state['ohlcv_by_stock'] = {}
+        state['evaluated_signals'] = {}
+        state['screened_by_stock'] = {}
+        return state
+
+
+    #----- stocks without a new bar -----
 
+    def get_reusable_signals(self, stock, last_bar_timestamp):
+        #the signals worked out on this same last bar, None when the stock has a new bar or its bars came without times
+        if not self.skip_unchanged_stocks or last_bar_timestamp is None:
+            return None
+        evaluated = self.evaluated_signals.get(stock)
+        if evaluated is None or evaluated[0] != last_bar_timestamp:
+            return None
+        self.unchanged_stocks_skipped += 1
+        return evaluated[1]
 
-    def buy_market_ioc_and_add_trailing_stop_loss_price(self, stock, qty_to_buy,new_trail_price):
+
+    def remember_signals(self, stock, last_bar_timestamp, signals):
+        if last_bar_timestamp is not None:
+            self.evaluated_signals[stock] = (last_bar_timestamp, signals)
+
+
+    def get_changed_rows(self, stocks, last_bar_timestamps):
+        #the rows of a screen whose stock has a bar the last screen didn't see
+        if not self.skip_unchanged_stocks:
+            return np.arange(len(stocks))
+        changed = [row for row, stock in enumerate(stocks)
+                   if last_bar_timestamps[row] is None or stock not in self.screened_by_stock or self.screened_by_stock[stock][0] != last_bar_timestamps[row]]
+        self.unchanged_stocks_skipped += len(stocks) - len(changed)
+        return np.array(changed, dtype=np.intp)
+
+
+    def merge_screened_stocks(self, stocks, last_bar_timestamps, changed_rows, screened_stocks):
+        #the new screen's results for the changed rows and the remembered ones for the rest, in stock list order like a screen of every row
+        #screen_stocks_on_matrix only returns the stocks worth acting on, the others are remembered as None
+        screened_by_changed_stock = {screened[0]: screened for screened in screened_stocks}
+        for row in changed_rows:
+            stock = stocks[row]
+            if last_bar_timestamps[row] is None:
+                self.screened_by_stock.pop(stock, None)
+            else:
+                self.screened_by_stock[stock] = (last_bar_timestamps[row], screened_by_changed_stock.get(stock))
+
+        changed = set(int(row) for row in changed_rows)
+        merged = []
+        for row, stock in enumerate(stocks):
+            if row in changed:
+                screened = screened_by_changed_stock.get(stock)
+            else:
+                screened = self.screened_by_stock[stock][1]
+            if screened is not None:
+                merged.append(screened)
+        return merged
+
+
+    #----- stock list -----
+
+    def get_owned_stocks(self, stocks):
+        #the stocks among these with a position, an open order or a buy the order pipeline is still placing
+        if self.broker_state is not None:
+            owned = set(stock for stock in stocks if self.broker_state.has_open_order_or_position(stock))
+        else:
+            owned = set(position.symbol for position in self.alpaca.list_positions()) | set(order.symbol for order in self.alpaca.list_orders(status="open"))
+        if self.order_pipeline is not None:
+            owned |= set(stock for stock in stocks if self.order_pipeline.has_active_intent(stock))
+        return [stock for stock in stocks if stock in owned]
+
+
+    def set_stock_list(self, new_stock_list):
+        #sell_positions_over_threshold only manages the list's stocks, so a dropped stock stays on it while it still has a position or an open order
+        listed = set(new_stock_list)
+        dropped = [stock for stock in self.stock_list if stock not in listed]
+        kept = self.get_owned_stocks(dropped) if len(dropped) > 0 else []
+        self.stock_list = list(new_stock_list) + kept
+        self.forget_stocks(set(dropped).difference(kept))
+        return kept
+
+
+    def forget_stocks(self, stocks):
+        #the per stock state of stocks that left the list, so it doesn't grow with every stock ever screened
+        for stock in stocks:
+            self.ohlcv_by_stock.pop(stock, None)
+            self.evaluated_signals.pop(stock, None)
+            self.screened_by_stock.pop(stock, None)
+
+
+    #the StrategyCollector calls this at the start of every tick
+    def start_tick(self):
+        self.clear_ohlcv_cache()
+        self.unchanged_stocks_skipped = 0
+
+
+    #a reservation from reserve_cash is released once the buy is done
+    def buy_market_ioc_and_add_trailing_stop_loss_price(self, stock, qty_to_buy,new_trail_price, reservation=None):
+        with self.metrics.timer('order_submit', self.strat_name, stock):
+            client_order_id = self.get_next_client_order_id()
+            if self.order_pipeline is not None:
+                self.submit_order_intent(OrderIntent(self.strat_name, stock, qty_to_buy, client_order_id, new_trail_price=new_trail_price), reservation)
+            else:
+                try:
+                    self.submit_market_ioc_and_trailing_stop_loss_price(stock, qty_to_buy, new_trail_price, client_order_id)
+                finally:
+                    self.release_cash(reservation)
+
+
+    #without an OrderPipeline, the stop is sent right after the buy for the full quantity, filled or not
+    def submit_market_ioc_and_trailing_stop_loss_price(self, stock, qty_to_buy,new_trail_price, client_order_id=None):
         
         #first send the market order, immediate or cancel
-        self.alpaca.submit_order(
+        self.record_submitted_order(self.alpaca.submit_order(
                 symbol=stock,
                 qty=qty_to_buy,
                 side='buy',
                 type='market',
-                time_in_force='ioc'
-                )
+                time_in_force='ioc',
+                client_order_id=client_order_id
+                ))
 
         #then send the trailing stop loss order, good till close      
-        self.alpaca.submit_order(
+        self.record_submitted_order(self.alpaca.submit_order(
             symbol=stock,
             qty=qty_to_buy,
             side='sell',
             type='trailing_stop',
             trail_price = new_trail_price,
             #trail_percent=trailing_stop_perc,  # if user enters 1.0, then stop price will be hwm*0.99
-            time_in_force='gtc' #change this later?
-            )
+            time_in_force='gtc', #change this later?
+            client_order_id=None if client_order_id is None else client_order_id + '-stop'
+            ))
 
         
-    def buy_market_ioc_and_add_trailing_stop_loss_percent(self, stock, qty_to_buy,new_trail_percent):
+    #a reservation from reserve_cash is released once the buy is done
+    def buy_market_ioc_and_add_trailing_stop_loss_percent(self, stock, qty_to_buy,new_trail_percent, reservation=None):
+        with self.metrics.timer('order_submit', self.strat_name, stock):
+            client_order_id = self.get_next_client_order_id()
+            if self.order_pipeline is not None:
+                self.submit_order_intent(OrderIntent(self.strat_name, stock, qty_to_buy, client_order_id, new_trail_percent=new_trail_percent), reservation)
+            else:
+                try:
+                    self.submit_market_ioc_and_trailing_stop_loss_percent(stock, qty_to_buy, new_trail_percent, client_order_id)
+                finally:
+                    self.release_cash(reservation)
+
+
+    #without an OrderPipeline, the stop is sent right after the buy for the full quantity, filled or not
+    def submit_market_ioc_and_trailing_stop_loss_percent(self, stock, qty_to_buy,new_trail_percent, client_order_id=None):
         
         #first send the market order, immediate or cancel
-        self.alpaca.submit_order(
+        self.record_submitted_order(self.alpaca.submit_order(
                 symbol=stock,
                 qty=qty_to_buy,
                 side='buy',
                 type='market',
-                time_in_force='ioc'
-                )
+                time_in_force='ioc',
+                client_order_id=client_order_id
+                ))
 
         #then send the trailing stop loss order, good till close      
-        self.alpaca.submit_order(
+        self.record_submitted_order(self.alpaca.submit_order(
             symbol=stock,
             qty=qty_to_buy,
             side='sell',
             type='trailing_stop',
             trail_percent=new_trail_percent,  # if user enters 1.0, then stop price will be hwm*0.99
-            time_in_force='gtc' #change this later?
-            )
+            time_in_force='gtc', #change this later?
+            client_order_id=None if client_order_id is None else client_order_id + '-stop'
+            ))
+
+
+    def get_next_client_order_id(self):
+        client_order_id = f'{self.client_order_id_prefix}-{self.journal_id_int}'
+        self.journal_id_int += 1
+        return client_order_id
+
+
+    def submit_order_intent(self, intent, reservation=None):
+        #the pipeline reports the buy and the stop back here as the broker accepts them
+        intent.on_order = self.record_submitted_order
+        if reservation is not None:
+            #a buy that never filled gives its cash back without making the ledger fetch the account again
+            intent.on_finished = lambda finished_intent: self.release_cash(reservation, finished_intent.state != 'not_filled')
+        return self.order_pipeline.submit(intent)
+
+
+    #----- cash -----
+
+    def reserve_cash(self, stock, amount):
+        #None when the purchase would go over this strategy's allocation or leave less than the minimum reserve balance in the account
+        return self.account_ledger.reserve(self.strat_name, stock, amount, self.money_allocated_to_this_strategy, self.minimum_reserve_balance)
+
+
+    def release_cash(self, reservation, spent=True):
+        if reservation is not None:
+            self.account_ledger.release(reservation, spent)
+
+
+    #keeps the collector's BrokerStateSnapshot current so later checks this loop see the new order
+    def record_submitted_order(self, order):
+        if self.broker_state is not None and order is not None:
+            self.broker_state.record_submitted_order(order)
+        if order is not None:
+            self.metrics.record_order(self.strat_name, order.symbol)
+            event_log.info('order_submitted', strategy=self.strat_name, symbol=order.symbol, side=order.side, type=order.type, qty=order.qty, order_id=order.id)
+        return order
 
 
     def check_if_stock_already_has_open_order_or_position(self, stock):
+        with self.metrics.timer('broker_state', self.strat_name, stock):
+            return self.check_broker_for_open_order_or_position(stock)
+
+
+    def check_broker_for_open_order_or_position(self, stock):
+
+        #a buy still being placed by the order pipeline isn't in any listing yet
+        if self.order_pipeline is not None and self.order_pipeline.has_active_intent(stock):
+            return True
     
+        #one dictionary lookup in the snapshot the collector took at the start of this loop
+        if self.broker_state is not None:
+            return self.broker_state.has_open_order_or_position(stock)
+
         positions = self.alpaca.list_positions()
         
         for position in positions:
@@ -112,25 +357,23 @@ class BasicStrategy():
     def print_all_positions(self):
         positions = self.alpaca.list_positions()
         for position in positions:
-          print(position)
+          event_log.info('position', strategy=self.strat_name, symbol=position.symbol, qty=position.qty, unrealized_pl=position.unrealized_pl)
 
 
     def print_opportunities_found_this_run(self):
-        print(f"The strategy {self.strat_name} has found {self.opportunities_found_this_run} this many opportunities this run")
+        event_log.info('opportunities_found_this_run', strategy=self.strat_name, opportunities=self.opportunities_found_this_run, orders=self.orders_made_this_run,
+                       unchanged_stocks_skipped=self.unchanged_stocks_skipped)
         
 
-    def found_opportunity(self):
-        print('***************************************')
-        print('***********winner winner***************')
-        print('**********chicken dinner***************')
-        print('***************************************')
+    def found_opportunity(self, stock=None):
         self.opportunities_found_this_run += 1   
+        event_log.info('opportunity_found', strategy=self.strat_name, symbol=stock, opportunities=self.opportunities_found_this_run)
         
 
     def get_account_cash_as_float(self):
-        #alpaca returns all numbers as strings to not lose any precision, will have to cast to float
-        cash = float(self.account.cash)
-        print(f"This account has this much cash available: ${cash}")
+        #the account's cash less what every strategy has reserved for buys still being placed
+        cash = self.account_ledger.get_available_cash()
+        event_log.debug('account_cash', strategy=self.strat_name, cash=cash)
         return cash
 
 
@@ -142,53 +385,144 @@ class BasicStrategy():
 
     #based on the /v1 version of the API
     def get_historical_data_close_price_by_minutes(self, stock,number_of_data_points):
+        with self.metrics.timer('bar_fetch', self.strat_name, stock):
+            return self.fetch_close_prices_by_minutes(stock, number_of_data_points)
+
+
+    def fetch_close_prices_by_minutes(self, stock,number_of_data_points):
+        #read from the shared cache when the StrategyCollector already fetched this stock this loop
+        if self.market_data is not None and self.market_data.has_data(stock, number_of_data_points):
+            return self.market_data.get_close_prices(stock, number_of_data_points)
+        return self.fetch_ohlcv_by_minutes(stock, number_of_data_points).c
+
+
+    #called at the start of every tick, the next fetch of any stock goes to the broker again
+    def clear_ohlcv_cache(self):
+        self.ohlcv_by_stock = {}
+
+
+    #every column of the stock's minute bars from one fetch, close prices, volumes and longer bars are all read from it
+    def get_historical_data_ohlcv_by_minutes(self, stock,number_of_data_points):
+        with self.metrics.timer('bar_fetch', self.strat_name, stock):
+            return self.fetch_ohlcv_by_minutes(stock, number_of_data_points)
+
+
+    def fetch_ohlcv_by_minutes(self, stock,number_of_data_points):
+        if self.market_data is not None and self.market_data.has_data(stock, number_of_data_points):
+            return self.market_data.get_ohlcv(stock, number_of_data_points)
+
+        #the bar store only asks the broker for the bars it doesn't have yet
+        if self.bar_store is not None:
+            self.bar_store.update([stock], number_of_data_points)
+            return OhlcvBars(self.bar_store.get_last_bars(stock, number_of_data_points))
+
+        #a second call for the same stock within the minute, for no more bars than last time, is answered from the last fetch
+        minute = int(time.time() // 60)
+        cached = self.ohlcv_by_stock.get(stock)
+        if cached is not None and cached[0] == minute and cached[1] >= number_of_data_points:
+            return cached[2].tail(number_of_data_points)
+
         barset = self.alpaca.get_barset(stock,'minute',limit = number_of_data_points)
-        close_price_np_array = barset.df[(stock,'close')].values 
-        return close_price_np_array
+        ohlcv_bars = OhlcvBars.from_barset(barset, stock)
+        self.ohlcv_by_stock[stock] = (minute, number_of_data_points, ohlcv_bars)
+        return ohlcv_bars
 
 
-    #based on the /v1 version of the API
+    #bars of any length in minutes, built from minute bars instead of asking the broker for another timeframe
+    def get_historical_data_ohlcv_by_timeframe(self, stock, minutes, number_of_data_points):
+        with self.metrics.timer('bar_fetch', self.strat_name, stock):
+            if self.market_data is None or not self.market_data.has_data(stock, 1):
+                #minutes more minute bars than the whole bars need, the oldest bar may start before the first one fetched
+                return self.fetch_ohlcv_by_minutes(stock, minutes * (number_of_data_points + 1)).resample(minutes).tail(number_of_data_points)
+
+            #the shared cache keeps one resampler per stock and timeframe, fed every new minute bar as it closes
+            if not self.market_data.has_resampler(stock, minutes):
+                resampler = self.market_data.get_resampler(stock, minutes, max(200, number_of_data_points))
+                #seeded once with enough history from the bar store or one minute bar request
+                resampler.update(self.fetch_ohlcv_by_minutes(stock, minutes * (number_of_data_points + 1)))
+                resampler.update(self.market_data.get_ohlcv(stock, self.market_data.number_of_data_points))
+            return self.market_data.get_resampler(stock, minutes).get_bars(number_of_data_points)
+
+
+    #runs the ADF regressions for several stocks in one batch so the later augmented_dickey_fuller_test_on_list calls are cache hits
+    def prepare_augmented_dickey_fuller_tests(self, close_price_np_arrays, stocks, last_bar_timestamps):
+        if self.adf_test is not None and len(close_price_np_arrays) > 0:
+            with self.metrics.timer('adf', self.strat_name):
+                self.adf_test.test_on_lists(close_price_np_arrays, stocks, last_bar_timestamps)
+
+
+    #bar times in epoch seconds, only known when the bars came from the shared cache or the bar store
+    def get_historical_data_timestamps_by_minutes(self, stock,number_of_data_points):
+        if self.market_data is not None and self.market_data.has_data(stock, number_of_data_points):
+            return self.market_data.get_timestamps(stock, number_of_data_points)
+        #not updated here, the close prices asked for just before already brought the store up to date
+        if self.bar_store is not None:
+            return self.bar_store.get_timestamps(stock, number_of_data_points)
+        return None
+
+
+    def get_last_timestamp(self, timestamp_np_array):
+        if timestamp_np_array is None or len(timestamp_np_array) == 0:
+            return None
+        return int(timestamp_np_array[-1])
+
+
+    #15 minute bars built from the minute bars, no request of their own
     def get_historical_data_close_price_by_fifteen_minutes(self, stock,number_of_data_points):
-        barset = self.alpaca.get_barset(stock,'15Min',limit = number_of_data_points)
-        close_price_np_array = barset.df[(stock,'close')].values 
-        return close_price_np_array
+        return self.get_historical_data_ohlcv_by_timeframe(stock, 15, number_of_data_points).c
 
     #based on /v1 of API
     def get_historical_data_volume_by_minutes(self, stock,number_of_data_points):
-        barset = self.alpaca.get_barset(stock,'minute',limit = number_of_data_points)
-        #close_price_np_array = barset.df[(stock,'close')].values 
-        volume_np_array = barset.df[(stock,'volume')].values
-        #add error handling here for if barset goes wrong
-        return volume_np_array
+        if self.market_data is not None and self.market_data.has_data(stock, number_of_data_points):
+            return self.market_data.get_volumes(stock, number_of_data_points)
+        return self.fetch_ohlcv_by_minutes(stock, number_of_data_points).v
 
 
     def is_historical_data_clean(self, close_price_np_arry):
         return_bool = False
-        zero_value = 0.00
 
-        if zero_value in close_price_np_arry:
-            print("Data is not clean - contains one or more zeros! Do not use this data.")
+        #a nan compares false too, so one pass catches zeros, negative prices and holes
+        if not (np.asarray(close_price_np_arry) > 0.00).all():
+            event_log.debug('data_not_clean', strategy=self.strat_name, reason='contains one or more zero, negative or nan prices')
             pass #keep return_bool equal to false
         else:
-            print("Data is clean! :)")
             return_bool = True
 
         return return_bool
 
 
-    def augmented_dickey_fuller_test_on_list(self, close_price_np_array):
+    #the shared MarketDataCache's BarValidator threw the stock's bars out this tick, or it is quarantined
+    def is_stock_rejected(self, stock):
+        return self.market_data is not None and self.market_data.is_rejected(stock)
+
+
+    #batch version of is_historical_data_clean, one row per stock, the nan padding of short rows is not a zero
+    def is_historical_data_clean_on_matrix(self, close_price_np_matrix):
+        return ~(close_price_np_matrix == 0.00).any(axis=1)
+
+
+    def augmented_dickey_fuller_test_on_list(self, close_price_np_array, stock=None, last_bar_timestamp=None):
     
-        result = adfuller(close_price_np_array)
+        #the shared FastAdf reuses the result while the stock's last bar is unchanged
+        with self.metrics.timer('adf', self.strat_name, stock):
+            try:
+                if self.adf_test is not None:
+                    result = self.adf_test.test_on_list(close_price_np_array, stock, last_bar_timestamp)
+                else:
+                    result = adfuller(close_price_np_array)
+            except ValueError as error:
+                #adfuller refuses a constant window, a stock that did not move is not a stationary spike candidate
+                self.journal_reason = "ADF Test could not run because " + str(error)
+                event_log.debug('adf_test', strategy=self.strat_name, symbol=stock, error=str(error), is_stationary=False)
+                return False
    
         #print(f'ADF Statistic: {result[0]}')
         #print(f'n_lags: {result[1]}')
         #print(f'p-value: {result[1]}')
 
         if result[1] > .05:
-          print(f'p value is good, {result[1]}')
           is_p_good = True
         else:
-          print(f'p value is bad', {result[1]})
           is_p_good = False
 
         adf_metric = 0
@@ -196,27 +530,24 @@ class BasicStrategy():
         #  adf_metric = temp_adf_metric
         adf_metric = result[0]
 
-        print(f'ADF Metric = {adf_metric}')
         are_criticals_good = True
         temp_bool = True
         for key, value in result[4].items():
-            #print(f'Critical Values:   {key}, {value}') 
+            #the metric has to be over every critical value
             if adf_metric > value:
               temp_bool = True
-              print(f'adf_metric = {adf_metric} is GREATER than value = {value}')
             else:
               temp_bool = False
-              print(f'adf_metric = {adf_metric} is LESS than value = {value}')
 
             are_criticals_good = are_criticals_good and temp_bool
 
         is_stationary = is_p_good and are_criticals_good
-        if is_stationary:
-         
-          print(f'This ADF shows the time series is stationary because {is_p_good} and {are_criticals_good}')
-        else:
+        if not is_stationary:
           self.journal_reason = "ADF Test shows time series is NOT stationary because ADF Metric = " + str(adf_metric)
-          print(f'This ADF shows the time series is NOT stationary because {is_p_good} and {are_criticals_good}.')
+
+        #the critical values are the noisiest lines of a tick, they are only written at DEBUG
+        event_log.debug('adf_test', strategy=self.strat_name, symbol=stock, adf_metric=adf_metric, p_value=result[1], critical_values=result[4],
+                        is_p_good=is_p_good, are_criticals_good=are_criticals_good, is_stationary=is_stationary)
 
         return is_stationary
     
@@ -244,11 +575,11 @@ class BasicStrategy():
         #print(data.tail(5))
 
         if data['Crossing_Buy'].tail(1).values[0]:
-          print("Crossing Buy Signal Found")
-          print(data.tail(1))
+          if event_log.is_enabled(logging.DEBUG):
+              event_log.debug('crossing_buy_signal', strategy=self.strat_name, found=True, metrics=data.tail(1).iloc[0].to_dict())
           return True
         else:
-          print("Crossing Buy Signal *NOT* Found")
+          event_log.debug('crossing_buy_signal', strategy=self.strat_name, found=False)
           return False
 
 
@@ -282,40 +613,112 @@ class BasicStrategy():
         #print(data.tail(5))
 
         if data['Crossing_Buy'].tail(1).values[0] and data['diff_SHORT'].tail(1).values[0] > new_slope_min and data['diff_delta'].tail(1).values[0] > new_slope_diff_min:
-          print("Crossing Buy Signal Found")
-          print(data.tail(1))
+          #the row is only turned into a dict when DEBUG events are written, rendering it was a large part of a tick
+          if event_log.is_enabled(logging.DEBUG):
+              event_log.debug('crossing_buy_signal', strategy=self.strat_name, found=True, metrics=data.tail(1).iloc[0].to_dict())
+          return True
+        else:
+          event_log.debug('crossing_buy_signal', strategy=self.strat_name, found=False)
+          return False
+
+
+    #moving average of every row lag columns before the last one, nan where the window runs off the left edge or into nan padding
+    def get_sma_on_matrix(self, close_price_np_matrix, window, lag):
+        end = close_price_np_matrix.shape[1] - lag
+        start = end - window
+        if start < 0:
+            return np.full(close_price_np_matrix.shape[0], np.nan)
+        window_np_matrix = close_price_np_matrix[:, start:end]
+        sma = window_np_matrix.sum(axis=1) / window
+
+        #a flat window averages to exactly its value in pandas, keep that so equal averages still compare equal
+        flat = window_np_matrix.min(axis=1) == window_np_matrix.max(axis=1)
+        sma[flat] = window_np_matrix[flat, 0]
+        return sma
+
+
+    #batch version of check_mean_reversion_of_long_and_short_sma_and_sma_slopes for a (stocks x minutes) matrix
+    #returns a boolean vector with one entry per row, plus the metrics behind it
+    def check_mean_reversion_of_long_and_short_sma_and_sma_slopes_on_matrix(self, close_price_np_matrix,long,short,new_t,new_slope_min,new_slope_diff_min):
+
+        delta_t = new_t
+
+        sma_long = self.get_sma_on_matrix(close_price_np_matrix, long, 0)
+        sma_short = self.get_sma_on_matrix(close_price_np_matrix, short, 0)
+        previous_long = self.get_sma_on_matrix(close_price_np_matrix, long, 1)
+        previous_short = self.get_sma_on_matrix(close_price_np_matrix, short, 1)
+        diff_long = (sma_long - self.get_sma_on_matrix(close_price_np_matrix, long, delta_t)) / delta_t
+        diff_short = (sma_short - self.get_sma_on_matrix(close_price_np_matrix, short, delta_t)) / delta_t
+        diff_delta = diff_short - diff_long
+
+        crossing_buy = (sma_short > sma_long) & (previous_short <= previous_long)
+        crossing_buy_with_slopes = crossing_buy & (diff_short > new_slope_min) & (diff_delta > new_slope_diff_min)
+
+        #summing in a different order than pandas can flip a comparison that sits right on its threshold,
+        #redo those few rows with the indicator that repeats the pandas steps exactly
+        scale = np.maximum(np.abs(sma_long), 1.0) * 1e-9
+        close_to_a_boundary = ((np.abs(sma_short - sma_long) <= scale) | (np.abs(previous_short - previous_long) <= scale) |
+                               (np.abs(diff_short - new_slope_min) <= scale) | (np.abs(diff_delta - new_slope_diff_min) <= scale))
+
+        for row in np.flatnonzero(close_to_a_boundary):
+            close_price_np_array = close_price_np_matrix[row]
+            indicator = RollingSmaIndicator(long, short, delta_t, close_price_np_matrix.shape[1])
+            indicator.seed(close_price_np_array[~np.isnan(close_price_np_array)])
+            sma_long[row] = indicator.get_sma_long()
+            sma_short[row] = indicator.get_sma_short()
+            diff_short[row] = indicator.get_short_slope()
+            diff_delta[row] = indicator.get_slope_difference()
+            crossing_buy[row] = indicator.is_crossing_buy()
+            crossing_buy_with_slopes[row] = indicator.is_crossing_buy_with_slopes(new_slope_min, new_slope_diff_min)
+
+        metrics = {
+            'SMA_LONG': sma_long,
+            'SMA_SHORT': sma_short,
+            'diff_SHORT': diff_short,
+            'diff_delta': diff_delta,
+            'Crossing_Buy': crossing_buy,
+        }
+        return crossing_buy_with_slopes, metrics
+
+
+    #same answer as check_mean_reversion_of_long_and_short_sma_and_sma_slopes, but updates a per-stock RollingSmaIndicator with only the new bars
+    def check_mean_reversion_of_long_and_short_sma_and_sma_slopes_with_indicator(self, indicator, close_price_list, timestamp_list, new_slope_min, new_slope_diff_min):
+
+        if indicator.check_crossing_buy_with_slopes(close_price_list, timestamp_list, new_slope_min, new_slope_diff_min):
+          event_log.debug('crossing_buy_signal', strategy=self.strat_name, found=True, SMA_LONG=indicator.get_sma_long(), SMA_SHORT=indicator.get_sma_short(),
+                          diff_SHORT=indicator.get_short_slope(), diff_delta=indicator.get_slope_difference())
           return True
         else:
-          print("Crossing Buy Signal *NOT* Found")
+          event_log.debug('crossing_buy_signal', strategy=self.strat_name, found=False)
           return False
 
           
     def reset_journal_reason(self):
-        print("future expansion")
+        #future expansion
+        event_log.debug('reset_journal_reason', strategy=self.strat_name)
         #self.journal_reason = ""
 
         
     def get_buying_power(self):
         # Check how much money we can use to open new positions.
-        print('${} is available as buying power.'.format(self.account.buying_power))
-        return self.account.buying_power
+        buying_power = self.account_ledger.get_buying_power()
+        event_log.info('buying_power', strategy=self.strat_name, buying_power=buying_power)
+        return buying_power
 
 
     def print_all_open_orders(self):
-        print('Printing all open orders.')
         orders = self.alpaca.list_orders(status="open")
-        if len(orders) > 0:
-          for order in orders:
-            print(order)
-        else:
-          print('There are no open orders at this time.')
+        event_log.info('open_orders', strategy=self.strat_name, count=len(orders))
+        for order in orders:
+          event_log.info('open_order', strategy=self.strat_name, symbol=order.symbol, order_id=order.id, client_order_id=order.client_order_id,
+                         side=order.side, type=order.type, qty=order.qty, status=order.status)
 
 
     def buy_market_order_with_brackets(self, qty, stock, stop_loss_stop_price, stop_loss_limit_price, take_profit_price, client_id,current_price):
-        print(f'Trying to place a bracket order for {qty} shares of {stock} that is currently at {current_price}')
-        print(f'The stop loss is set to {stop_loss_stop_price} and the limit is {stop_loss_limit_price}, the take profit is {take_profit_price}')
+        event_log.info('bracket_order', strategy=self.strat_name, symbol=stock, qty=qty, current_price=current_price, stop_loss_stop_price=stop_loss_stop_price,
+                       stop_loss_limit_price=stop_loss_limit_price, take_profit_price=take_profit_price, client_order_id=client_id)
 
-        self.alpaca.submit_order(
+        self.record_submitted_order(self.alpaca.submit_order(
            symbol=stock,
            qty=qty, 
            side='buy',
@@ -326,5 +729,5 @@ class BasicStrategy():
            stop_loss={'stop_price': stop_loss_stop_price,
                      'limit_price':  stop_loss_limit_price},
            take_profit={'limit_price': take_profit_price}
-           )
+           ))
   
@@ -0,0 +1,95 @@
+"""
+    This class holds the account's positions and open orders, listed once per StrategyCollector loop
+    and indexed by symbol, so every strategy's entry and exit checks are dictionary lookups instead of new
+    list_positions and list_orders calls followed by linear scans.
+
+    Orders the strategies submit or cancel and positions they close during the loop are applied to the snapshot locally,
+    so a second strategy sees them without asking the broker again.
+    The OrderPipeline's threads record their orders here while the loop reads it, every read and write holds the snapshot's lock,
+    and a refresh builds the new indexes first and swaps them in under it.
+
+"""
+
+#basic libraries
+import asyncio
+import threading
+
+
+class BrokerStateSnapshot():
+
+    def __init__(self, new_trade_api_rest):
+        self.alpaca = new_trade_api_rest
+
+        self.positions_by_symbol = {}
+        self.open_orders_by_id = {}
+        self.open_order_ids_by_symbol = {}
+        self.lock = threading.Lock()
+
+        self.requests_made_last_refresh = 0
+
+
+    def refresh(self):
+        positions = self.alpaca.list_positions()
+        orders = self.alpaca.list_orders(status="open")
+        self.requests_made_last_refresh = 2
+        self.load(positions, orders)
+
+
+    async def refresh_async(self, async_rest):
+        positions, orders = await asyncio.gather(async_rest.list_positions(), async_rest.list_orders(status="open"))
+        self.requests_made_last_refresh = 2
+        self.load(positions, orders)
+
+
+    def load(self, positions, orders):
+        positions_by_symbol = {position.symbol: position for position in positions}
+        open_orders_by_id = {}
+        open_order_ids_by_symbol = {}
+        for order in orders:
+            open_orders_by_id[order.id] = order
+            open_order_ids_by_symbol.setdefault(order.symbol, set()).add(order.id)
+        with self.lock:
+            self.positions_by_symbol = positions_by_symbol
+            self.open_orders_by_id = open_orders_by_id
+            self.open_order_ids_by_symbol = open_order_ids_by_symbol
+
+
+    def add_open_order(self, order):
+        with self.lock:
+            self.open_orders_by_id[order.id] = order
+            self.open_order_ids_by_symbol.setdefault(order.symbol, set()).add(order.id)
+
+
+    def has_open_order_or_position(self, symbol):
+        with self.lock:
+            return symbol in self.positions_by_symbol or len(self.open_order_ids_by_symbol.get(symbol, ())) > 0
+
+
+    def get_positions(self):
+        with self.lock:
+            return list(self.positions_by_symbol.values())
+
+
+    def get_open_orders_for_symbol(self, symbol):
+        with self.lock:
+            return [self.open_orders_by_id[order_id] for order_id in self.open_order_ids_by_symbol.get(symbol, ())]
+
+
+    def record_submitted_order(self, order):
+        #even an immediate or cancel buy counts, until the next refresh it may already be a position
+        self.add_open_order(order)
+
+
+    def record_cancelled_order(self, order_id):
+        with self.lock:
+            order = self.open_orders_by_id.pop(order_id, None)
+            if order is not None:
+                self.open_order_ids_by_symbol[order.symbol].discard(order_id)
+
+
+    def record_closed_position(self, symbol, closing_order=None):
+        #the market sell close_position returns is an open order until the next refresh, so no strategy buys the symbol back in the same loop
+        with self.lock:
+            self.positions_by_symbol.pop(symbol, None)
+        if closing_order is not None:
+            self.add_open_order(closing_order)
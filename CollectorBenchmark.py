@@ -0,0 +1,114 @@
+"""
+    This benchmark runs the StrategyCollector's loop against FakeAlpaca instead of the paper trading API,
+    to see how a tick's wall time and REST call count grow with the number of stocks and the API's latency.
+
+    For every stock count, the stocks are split into StrategyBuyFiveMinuteSpikes strategies of up to 100 stocks,
+    the fake market moves one minute, and run_tick is timed, through the in-process FakeAlpacaRest and through a real
+    tradeapi.REST talking to a local FakeAlpacaServer.
+    Run this file directly to print the table for 10, 100 and 1,000 stocks.
+
+"""
+
+#basic libraries
+import os
+import time
+import contextlib
+import numpy as np
+import pandas as pd
+
+#algo brokerage api
+import alpaca_trade_api as tradeapi
+from alpaca_trade_api.rest import APIError
+
+from StrategyCollector import StrategyCollector
+from StrategyBuyFiveMinuteSpikes import StrategyBuyFiveMinuteSpikes
+from FakeAlpaca import FakeAlpacaRest, FakeAlpacaServer
+
+
+def get_symbols(number_of_symbols):
+    return ['SYM' + str(i) for i in range(number_of_symbols)]
+
+
+def build_collector(trade_api_rest, symbols, symbols_per_strategy=100):
+    collector = StrategyCollector(trade_api_rest)
+    for start in range(0, len(symbols), symbols_per_strategy):
+        strat = StrategyBuyFiveMinuteSpikes(f'Benchmark {start // symbols_per_strategy}', trade_api_rest, symbols[start:start + symbols_per_strategy],
+                                            5000, 25, 5, 2, 0.0, 0.0, 5.0)
+        collector.append_strat(strat)
+    return collector
+
+
+def time_ticks(collector, fake, number_of_ticks):
+    #one row per tick, the market moves a minute before each one like it does between live loops
+    rows = []
+    for tick in range(number_of_ticks):
+        fake.advance_minute()
+        fake.reset_call_counts()
+        started = time.perf_counter()
+        failed = False
+        try:
+            collector.run_tick()
+        except APIError:
+            #with an error rate the tick can fail, that is part of what is measured
+            failed = True
+        rows.append({'tick_seconds': time.perf_counter() - started, 'rest_calls': fake.get_call_count(),
+                     'errors_injected': fake.errors_injected, 'failed': failed, 'calls_by_method': dict(fake.call_counts)})
+    return rows
+
+
+def run_benchmark(number_of_symbols, transport='in_process', latency_seconds=0.0, error_rate=0.0, number_of_ticks=5, quiet=True):
+
+    symbols = get_symbols(number_of_symbols)
+    fake = FakeAlpacaRest(symbols, new_latency_seconds=latency_seconds, new_error_rate=error_rate)
+
+    output = open(os.devnull, 'w') if quiet else None
+    with contextlib.ExitStack() as stack:
+        #the strategies print a few lines per stock, at 1,000 stocks the printing would be what gets measured
+        if quiet:
+            stack.enter_context(output)
+            stack.enter_context(contextlib.redirect_stdout(output))
+
+        if transport == 'http':
+            server = stack.enter_context(FakeAlpacaServer(fake))
+            os.environ['APCA_API_DATA_URL'] = server.base_url
+            trade_api_rest = tradeapi.REST('fake-key', 'fake-secret', server.base_url, 'v2')
+        else:
+            trade_api_rest = fake
+
+        #errors are only injected into the timed ticks, setting up the collector has to succeed
+        fake.error_rate = 0.0
+        collector = build_collector(trade_api_rest, symbols)
+        fake.error_rate = error_rate
+        rows = time_ticks(collector, fake, number_of_ticks)
+        collector.close_process_pool()
+
+    tick_seconds = np.array([row['tick_seconds'] for row in rows])
+    last_calls = rows[-1]['calls_by_method']
+    return {
+        'symbols': number_of_symbols,
+        'transport': transport,
+        'latency_ms': latency_seconds * 1000,
+        'error_rate': error_rate,
+        'mean_tick_seconds': float(tick_seconds.mean()),
+        'max_tick_seconds': float(tick_seconds.max()),
+        'mean_rest_calls': float(np.mean([row['rest_calls'] for row in rows])),
+        'failed_ticks': sum(row['failed'] for row in rows),
+        'barset_calls': last_calls.get('get_barset', 0),
+        'order_calls': last_calls.get('submit_order', 0) + last_calls.get('cancel_order', 0) + last_calls.get('close_position', 0),
+    }
+
+
+def run_benchmark_suite(symbol_counts=(10, 100, 1000), transports=('in_process', 'http'), latencies_seconds=(0.0, 0.02), error_rate=0.0, number_of_ticks=5):
+    results = []
+    for transport in transports:
+        for latency_seconds in latencies_seconds:
+            for number_of_symbols in symbol_counts:
+                results.append(run_benchmark(number_of_symbols, transport, latency_seconds, error_rate, number_of_ticks))
+                print(results[-1])
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    pd.set_option('display.width', 1000)
+    pd.set_option('display.max_columns', 50)
+    print(run_benchmark_suite())
@@ -0,0 +1,142 @@
+"""
+    This class replaces the trading loop's prints with structured events, one JSON object per line.
+
+    Every event has a time, a level, the logger it came from, an event name and its fields (strategy, symbol, metrics, decision, ...).
+    The loop only puts the record on a queue; a background thread turns it into JSON and writes it, so a slow stdout or disk never holds up a tick.
+    Levels are the logging module's: the per-symbol diagnostics (ADF critical values, SMA values, clean data checks) are DEBUG
+    and are dropped before any formatting unless the level is lowered, decisions and orders are INFO, failures are WARNING or ERROR.
+
+    configure_event_log() sets up the queue and where the lines go, call it once at startup; stop_event_log() flushes what is queued.
+    A process forked from the loop (a process pool worker) has a copy of the queue but not the thread that empties it,
+    so right after the fork it writes its events straight to the same stream or file instead.
+
+"""
+
+#basic libraries
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+
+
+ROOT_LOGGER_NAME = 'algotrading'
+
+#the queue listener, one per process
+event_log_listener = None
+
+
+def get_json_value(value):
+    #numpy scalars and arrays, timestamps and anything else json can't write
+    if hasattr(value, 'item') and getattr(value, 'ndim', 0) == 0:
+        return value.item()
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+
+class JsonLineFormatter(logging.Formatter):
+
+    def format(self, record):
+        event = {'time': record.created, 'level': record.levelname, 'logger': record.name, 'event': record.getMessage()}
+        event.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            event['exception'] = self.formatException(record.exc_info)
+        return json.dumps(event, default=get_json_value)
+
+
+
+class EventLog():
+
+    def __init__(self, new_name):
+        self.logger = logging.getLogger(ROOT_LOGGER_NAME + '.' + new_name)
+
+
+    def is_enabled(self, level):
+        #guard for events whose fields are costly to build
+        return self.logger.isEnabledFor(level)
+
+
+    def log(self, level, event, fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, event, extra={'fields': fields})
+
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, fields)
+
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, fields)
+
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, fields)
+
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, fields)
+
+
+
+def configure_event_log(new_level='INFO', new_stream=None, new_path=None):
+    #events go to new_path when given, otherwise to new_stream (stdout by default), through a queue and a background thread
+    global event_log_listener
+    stop_event_log()
+
+    if new_path is not None:
+        handler = logging.FileHandler(new_path)
+    else:
+        handler = logging.StreamHandler(new_stream if new_stream is not None else sys.stdout)
+    handler.setFormatter(JsonLineFormatter())
+
+    event_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger(ROOT_LOGGER_NAME)
+    for old_handler in list(root_logger.handlers):
+        root_logger.removeHandler(old_handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(event_queue))
+    root_logger.setLevel(new_level)
+    #the events are already structured, the root logger's handlers would print them a second time
+    root_logger.propagate = False
+
+    event_log_listener = logging.handlers.QueueListener(event_queue, handler)
+    event_log_listener.start()
+    return event_log_listener
+
+
+def set_event_log_level(new_level):
+    logging.getLogger(ROOT_LOGGER_NAME).setLevel(new_level)
+
+
+def stop_event_log():
+    global event_log_listener
+    if event_log_listener is not None:
+        #stop() writes out every event still on the queue before it returns
+        event_log_listener.stop()
+        for handler in event_log_listener.handlers:
+            handler.flush()
+            if isinstance(handler, logging.FileHandler):
+                handler.close()
+        event_log_listener = None
+
+
+def write_directly_after_fork():
+    #runs in the child of a fork, the logging module has already reset the handlers' locks
+    global event_log_listener
+    if event_log_listener is None:
+        return
+    root_logger = logging.getLogger(ROOT_LOGGER_NAME)
+    for old_handler in list(root_logger.handlers):
+        root_logger.removeHandler(old_handler)
+    for handler in event_log_listener.handlers:
+        root_logger.addHandler(handler)
+    #the listener's thread only runs in the parent
+    event_log_listener = None
+
+
+atexit.register(stop_event_log)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=write_directly_after_fork)
@@ -0,0 +1,441 @@
+"""
+    These classes stand in for alpaca so the StrategyCollector can be run and measured without the paper trading API.
+
+    SyntheticBars makes up a random walk of minute bars for any number of stocks, one new bar per stock every advance_minute.
+    FakeAlpacaRest is an in-process replacement for tradeapi.REST covering the calls this project makes
+    (get_clock, get_account, get_barset, list_positions, list_orders, get_order, get_order_by_client_order_id, submit_order, cancel_order,
+    close_position, list_assets and the account configurations). Orders, positions and cash are kept by a SimulatedBroker filling against the synthetic bars.
+    Every call is counted, and can be slowed down by a fixed latency plus jitter or fail at a given error rate with an APIError.
+    With a lost response rate, a call can also be carried out and then fail as if the response never arrived, like a gateway timeout.
+
+    FakeAlpacaServer serves the same calls over local HTTP, with the same latency and errors, so a real tradeapi.REST
+    or an AsyncAlpacaRest can be pointed at it (base_url and APCA_API_DATA_URL set to server.base_url).
+
+"""
+
+#basic libraries
+import time
+import random
+import asyncio
+import threading
+import collections
+import numpy as np
+import pandas as pd
+from aiohttp import web
+
+#algo brokerage api
+from alpaca_trade_api.entity import Clock
+from alpaca_trade_api.rest import APIError
+
+from SimulatedBroker import SimulatedBroker
+
+
+class SyntheticBars():
+
+    def __init__(self, new_symbols, new_start_time='2021-01-04 14:30', new_history_minutes=200, new_volatility=0.002, new_seed=0):
+        self.symbols = [str(symbol) for symbol in new_symbols]
+        self.symbol_row = {symbol: row for row, symbol in enumerate(self.symbols)}
+        self.volatility = new_volatility
+        self.rng = np.random.default_rng(new_seed)
+
+        #the first history_minutes bars are already closed when the market opens
+        self.start_time = int(pd.Timestamp(new_start_time, tz='UTC').timestamp()) - 60 * new_history_minutes
+        self.last_closes = self.rng.uniform(5.0, 500.0, len(self.symbols))
+        self.columns = {name: np.zeros((len(self.symbols), 0)) for name in ('o', 'h', 'l', 'c', 'v')}
+        self.timeline = np.zeros(0, dtype=np.int64)
+
+        self.now_index = new_history_minutes - 1
+        self.generate(max(new_history_minutes, 1) + 390)
+
+
+    def generate(self, number_of_minutes):
+        #random walk for every stock at once, appended to the columns already made
+        shape = (len(self.symbols), number_of_minutes)
+        steps = self.rng.normal(0.0, self.volatility, shape)
+        closes = np.round(self.last_closes[:, None] * np.exp(np.cumsum(steps, axis=1)), 2)
+        opens = np.concatenate((np.round(self.last_closes, 2)[:, None], closes[:, :-1]), axis=1)
+        wicks = np.abs(self.rng.normal(0.0, self.volatility / 2, shape))
+        new_columns = {
+            'o': opens,
+            'h': np.round(np.maximum(opens, closes) * (1 + wicks), 2),
+            'l': np.round(np.minimum(opens, closes) * (1 - wicks), 2),
+            'c': closes,
+            'v': self.rng.integers(100, 10000, shape).astype(float),
+        }
+        for name, values in new_columns.items():
+            self.columns[name] = np.concatenate((self.columns[name], values), axis=1)
+
+        first_minute = len(self.timeline)
+        self.timeline = np.concatenate((self.timeline, self.start_time + 60 * np.arange(first_minute, first_minute + number_of_minutes, dtype=np.int64)))
+        self.last_closes = closes[:, -1]
+
+
+    def advance_minute(self):
+        self.now_index += 1
+        if self.now_index >= len(self.timeline):
+            self.generate(390)
+
+
+    def get_current_time(self):
+        return int(self.timeline[self.now_index])
+
+
+    def get_last_bars(self):
+        index = self.now_index
+        return (self.columns['o'][:, index], self.columns['h'][:, index], self.columns['l'][:, index], self.columns['c'][:, index])
+
+
+    #same shape the BacktestEngine hands the SimulatedBroker
+    def get_minute_bars(self, symbol, count, until=None):
+        row = self.symbol_row[symbol]
+        end = self.now_index + 1
+        if until is not None:
+            end = min(end, int(np.searchsorted(self.timeline, until, side='right')))
+        start = max(0, end - count)
+        bars = {name: self.columns[name][row, start:end] for name in ('o', 'h', 'l', 'c', 'v')}
+        bars['t'] = self.timeline[start:end]
+        return bars
+
+
+
+class FakeAlpacaRest():
+
+    def __init__(self, new_symbols, new_latency_seconds=0.0, new_latency_jitter_seconds=0.0, new_error_rate=0.0,
+                 new_starting_cash=100000.0, new_history_minutes=200, new_minutes_open=390, new_seed=0, new_lost_response_rate=0.0):
+        self.latency_seconds = new_latency_seconds
+        self.latency_jitter_seconds = new_latency_jitter_seconds
+        self.error_rate = new_error_rate
+        self.lost_response_rate = new_lost_response_rate
+        self.minutes_open = new_minutes_open
+        self.minutes_since_open = 0
+        self.rng = random.Random(new_seed)
+
+        self.bars = SyntheticBars(new_symbols, new_history_minutes=new_history_minutes, new_seed=new_seed)
+        self.broker = SimulatedBroker(new_starting_cash)
+        self.broker.bar_source = self.bars
+        self.broker.set_symbols(self.bars.symbols)
+        self.update_broker_bars()
+
+        self.call_counts = collections.Counter()
+        self.errors_injected = 0
+        self.lock = threading.Lock()
+
+
+    def update_broker_bars(self):
+        opens, highs, lows, closes = self.bars.get_last_bars()
+        self.broker.set_last_bars(self.bars.get_current_time(), opens, highs, lows, closes, np.ones(len(closes), dtype=bool))
+
+
+    def advance_minute(self):
+        #every stock gets a new bar, open trailing stops and brackets are checked against it
+        with self.lock:
+            self.bars.advance_minute()
+            self.minutes_since_open += 1
+            self.update_broker_bars()
+
+
+    def get_latency(self):
+        if self.latency_jitter_seconds > 0:
+            return max(0.0, self.latency_seconds + self.rng.uniform(-self.latency_jitter_seconds, self.latency_jitter_seconds))
+        return self.latency_seconds
+
+
+    def check_for_injected_error(self, name):
+        if self.error_rate > 0 and self.rng.random() < self.error_rate:
+            self.errors_injected += 1
+            raise APIError({'code': 50010000, 'message': f'injected error in {name}'})
+
+
+    def check_for_lost_response(self, name):
+        #the call already happened, only the answer is lost
+        if self.lost_response_rate > 0 and self.rng.random() < self.lost_response_rate:
+            self.errors_injected += 1
+            raise APIError({'code': 50410000, 'message': f'injected lost response in {name}'})
+
+
+    def get_call_count(self):
+        return sum(self.call_counts.values())
+
+
+    def reset_call_counts(self):
+        self.call_counts = collections.Counter()
+        self.errors_injected = 0
+
+
+    def call(self, name, *args, **kwargs):
+        #every public method goes through here, the HTTP server does the same steps with an asyncio sleep
+        self.call_counts[name] += 1
+        latency = self.get_latency()
+        if latency > 0:
+            time.sleep(latency)
+        self.check_for_injected_error(name)
+        result = self.handle(name, *args, **kwargs)
+        self.check_for_lost_response(name)
+        return result
+
+
+    def handle(self, name, *args, **kwargs):
+        with self.lock:
+            if name == 'get_clock':
+                return self.get_clock_without_latency()
+            return getattr(self.broker, name)(*args, **kwargs)
+
+
+    def get_clock_without_latency(self):
+        #bars are stamped with their start, the clock reads the end of the newest bar
+        timestamp = pd.Timestamp(self.bars.get_current_time() + 60, unit='s', tz='UTC')
+        next_close = timestamp + pd.Timedelta(minutes=max(0, self.minutes_open - self.minutes_since_open))
+        return Clock({'timestamp': timestamp.isoformat(), 'is_open': self.minutes_since_open < self.minutes_open,
+                      'next_open': (timestamp + pd.Timedelta(days=1)).isoformat(), 'next_close': next_close.isoformat()})
+
+
+    def get_clock(self):
+        return self.call('get_clock')
+
+
+    def get_account(self):
+        return self.call('get_account')
+
+
+    def get_account_configurations(self):
+        return self.call('get_account_configurations')
+
+
+    def update_account_configurations(self, no_shorting=None, dtbp_check=None, trade_confirm_email=None, suspend_trade=None):
+        return self.call('update_account_configurations', no_shorting, dtbp_check, trade_confirm_email, suspend_trade)
+
+
+    def get_barset(self, symbols, timeframe, limit=None, start=None, end=None, after=None, until=None):
+        return self.call('get_barset', symbols, timeframe, limit=limit, after=after, until=until)
+
+
+    def list_positions(self):
+        return self.call('list_positions')
+
+
+    def list_orders(self, status=None, limit=None, **kwargs):
+        return self.call('list_orders', status=status, limit=limit)
+
+
+    def get_order(self, order_id):
+        return self.call('get_order', order_id)
+
+
+    def get_order_by_client_order_id(self, client_order_id):
+        return self.call('get_order_by_client_order_id', client_order_id)
+
+
+    def submit_order(self, symbol, qty=None, side=None, type=None, time_in_force=None, **kwargs):
+        return self.call('submit_order', symbol, qty=qty, side=side, type=type, time_in_force=time_in_force, **kwargs)
+
+
+    def cancel_order(self, order_id):
+        return self.call('cancel_order', order_id)
+
+
+    def close_position(self, symbol):
+        return self.call('close_position', symbol)
+
+
+    def list_assets(self, status=None, asset_class=None):
+        return self.call('list_assets', status=status, asset_class=asset_class)
+
+
+
+def order_to_raw(order):
+    return {
+        'id': order.id,
+        'client_order_id': order.client_order_id,
+        'symbol': order.symbol,
+        'qty': str(order.qty),
+        'filled_qty': str(order.filled_qty),
+        'filled_avg_price': None if order.filled_avg_price is None else str(order.filled_avg_price),
+        'side': order.side,
+        'type': order.type,
+        'time_in_force': order.time_in_force,
+        'status': order.status,
+        'order_class': order.order_class or '',
+        'limit_price': None if order.limit_price is None else str(order.limit_price),
+        'stop_price': None if order.stop_price is None else str(order.stop_price),
+        'trail_percent': None if order.trail_percent is None else str(order.trail_percent),
+        'trail_price': None if order.trail_price is None else str(order.trail_price),
+        'hwm': None if order.hwm is None else str(order.hwm),
+        'submitted_at': order.submitted_at.isoformat(),
+        'filled_at': None if order.filled_at is None else order.filled_at.isoformat(),
+        'legs': None if order.legs is None else [order_to_raw(leg) for leg in order.legs],
+    }
+
+
+def position_to_raw(position):
+    return {
+        'symbol': position.symbol,
+        'qty': position.qty,
+        'side': 'long',
+        'avg_entry_price': position.avg_entry_price,
+        'current_price': position.current_price,
+        'market_value': position.market_value,
+        'unrealized_pl': position.unrealized_pl,
+    }
+
+
+def account_to_raw(account):
+    return {'id': 'fake-account', 'status': account.status, 'currency': 'USD', 'cash': account.cash,
+            'buying_power': account.buying_power, 'equity': account.equity, 'trading_blocked': account.trading_blocked}
+
+
+#the simulated broker's objects as the alpaca entity they stand in for, for a SessionRecorder wrapped around a FakeAlpacaRest
+RAW_CONVERTERS = {'SimulatedOrder': ('Order', order_to_raw), 'SimulatedPosition': ('Position', position_to_raw), 'SimulatedAccount': ('Account', account_to_raw)}
+
+
+
+class FakeAlpacaServer():
+
+    def __init__(self, new_fake_rest, new_host='127.0.0.1', new_port=0):
+        self.fake = new_fake_rest
+        self.host = new_host
+        self.port = new_port
+        self.base_url = None
+
+        self.loop = None
+        self.runner = None
+        self.thread = None
+
+
+    def get_application(self):
+        app = web.Application()
+        app.router.add_get('/v2/clock', self.get_clock)
+        app.router.add_get('/v2/account', self.get_account)
+        app.router.add_get('/v2/account/configurations', self.get_account_configurations)
+        app.router.add_patch('/v2/account/configurations', self.update_account_configurations)
+        app.router.add_get('/v2/positions', self.list_positions)
+        app.router.add_delete('/v2/positions/{symbol}', self.close_position)
+        app.router.add_get('/v2/orders', self.list_orders)
+        app.router.add_post('/v2/orders', self.submit_order)
+        app.router.add_get('/v2/orders:by_client_order_id', self.get_order_by_client_order_id)
+        app.router.add_get('/v2/orders/{order_id}', self.get_order)
+        app.router.add_delete('/v2/orders/{order_id}', self.cancel_order)
+        app.router.add_get('/v2/assets', self.list_assets)
+        app.router.add_get('/v1/bars/{timeframe}', self.get_barset)
+        return app
+
+
+    def start(self):
+        #the server gets its own event loop on a background thread, so a synchronous tradeapi.REST can call it
+        started = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+        async def start_site():
+            self.runner = web.AppRunner(self.get_application())
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, self.host, self.port)
+            await site.start()
+            self.port = site._server.sockets[0].getsockname()[1]
+            self.base_url = f'http://{self.host}:{self.port}'
+
+        def run_loop():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(start_site())
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run_loop, daemon=True)
+        self.thread.start()
+        started.wait()
+        return self.base_url
+
+
+    def stop(self):
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+    async def respond(self, name, to_raw, *args, **kwargs):
+        #same counting, latency and injected errors as FakeAlpacaRest.call, but the wait doesn't block other requests
+        self.fake.call_counts[name] += 1
+        latency = self.fake.get_latency()
+        if latency > 0:
+            await asyncio.sleep(latency)
+        try:
+            self.fake.check_for_injected_error(name)
+            result = self.fake.handle(name, *args, **kwargs)
+            self.fake.check_for_lost_response(name)
+        except APIError as error:
+            #alpaca's error codes start with the http status
+            return web.json_response({'code': error.code, 'message': str(error)}, status=error.code // 100000)
+        raw = to_raw(result)
+        if raw is None:
+            return web.Response(status=204)
+        return web.json_response(raw)
+
+
+    async def get_clock(self, request):
+        return await self.respond('get_clock', lambda clock: clock._raw)
+
+
+    async def get_account(self, request):
+        return await self.respond('get_account', account_to_raw)
+
+
+    async def get_account_configurations(self, request):
+        return await self.respond('get_account_configurations', lambda configurations: configurations._raw)
+
+
+    async def update_account_configurations(self, request):
+        params = await request.json()
+        return await self.respond('update_account_configurations', lambda configurations: configurations._raw,
+                                  params.get('no_shorting'), params.get('dtbp_check'), params.get('trade_confirm_email'), params.get('suspend_trade'))
+
+
+    async def list_positions(self, request):
+        return await self.respond('list_positions', lambda positions: [position_to_raw(position) for position in positions])
+
+
+    async def close_position(self, request):
+        return await self.respond('close_position', order_to_raw, request.match_info['symbol'])
+
+
+    async def list_orders(self, request):
+        limit = request.query.get('limit')
+        return await self.respond('list_orders', lambda orders: [order_to_raw(order) for order in orders],
+                                  status=request.query.get('status'), limit=None if limit is None else int(limit))
+
+
+    async def get_order(self, request):
+        return await self.respond('get_order', order_to_raw, request.match_info['order_id'])
+
+
+    async def get_order_by_client_order_id(self, request):
+        return await self.respond('get_order_by_client_order_id', order_to_raw, request.query['client_order_id'])
+
+
+    async def submit_order(self, request):
+        params = await request.json()
+        return await self.respond('submit_order', order_to_raw, **params)
+
+
+    async def cancel_order(self, request):
+        return await self.respond('cancel_order', lambda result: None, request.match_info['order_id'])
+
+
+    async def list_assets(self, request):
+        return await self.respond('list_assets', lambda assets: [asset._raw for asset in assets],
+                                  status=request.query.get('status'), asset_class=request.query.get('asset_class'))
+
+
+    async def get_barset(self, request):
+        limit = request.query.get('limit')
+        return await self.respond('get_barset', lambda barset: barset._raw, request.query['symbols'], request.match_info['timeframe'],
+                                  limit=None if limit is None else int(limit), after=request.query.get('after'), until=request.query.get('until'))
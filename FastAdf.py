@@ -0,0 +1,272 @@
+"""
+    This class is a faster replacement for calling statsmodels' adfuller once per stock every minute.
+
+    The lag length is bounded (the same 12*(nobs/100)^(1/4) limit adfuller uses unless one is given), and every candidate
+    lag is fit for all stocks of the same window length at once with stacked numpy least squares instead of one OLS model per lag per stock.
+    With autolag='AIC' the lag is picked the same way adfuller picks it, with autolag=None the maximum lag is always used.
+
+    Results are memoized in a bounded LRU keyed by stock, last bar timestamp and window length, so a stock whose last bar did not change
+    is not tested again, and several strategies sharing a stock share its result.
+
+    Rows the batched solve can not answer with certainty (rank deficient regressions, information criteria that tie,
+    or a p-value or test statistic within rounding distance of a threshold) are handed to statsmodels, so the stationary verdict
+    and critical value comparisons always match augmented_dickey_fuller_test_on_list.
+    Rank deficient rows are found from R's diagonal before it is inverted, so a flat window with one jump does not fail the batch,
+    and a constant window gets adfuller's ValueError as its own result instead of raising for every stock in the batch.
+    Run this file directly to check the parity with statsmodels.
+
+"""
+
+#basic libraries
+from collections import OrderedDict
+import functools
+import numpy as np
+
+#stats package
+from statsmodels.tsa.stattools import adfuller
+from statsmodels.tsa.adfvalues import mackinnonp, mackinnoncrit
+
+
+@functools.lru_cache(maxsize=None)
+def get_critical_values(nobs):
+    critvalues = mackinnoncrit(N=1, regression='c', nobs=nobs)
+    return {"1%": critvalues[0], "5%": critvalues[1], "10%": critvalues[2]}
+
+
+class FastAdf():
+
+    def __init__(self, new_maxlag=None, new_autolag='AIC', new_cache_size=10000):
+        self.maxlag = new_maxlag
+        self.autolag = new_autolag
+        self.cache_size = new_cache_size
+        self.cache = OrderedDict()
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.statsmodels_fallbacks = 0
+
+
+    def get_maxlag(self, length):
+        #same default as adfuller with a constant, the -1 is for the diff
+        if self.maxlag is not None:
+            return self.maxlag
+        maxlag = int(np.ceil(12.0 * np.power(length / 100.0, 1 / 4.0)))
+        return min(length // 2 - 1 - 1, maxlag)
+
+
+    def test_on_list(self, close_price_np_array, stock=None, last_bar_timestamp=None):
+        result = self.test_on_lists([close_price_np_array], [stock], [last_bar_timestamp])[0]
+        #a series adfuller refuses (constant or too short) raises here like adfuller would, only for this one stock
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+    def test_on_lists(self, close_price_np_arrays, stocks=None, last_bar_timestamps=None):
+        #returns one adfuller style result tuple per array, reusing cached results where the stock's last bar has not changed,
+        #or the ValueError adfuller raised for that array so one constant series does not fail the whole batch
+
+        if stocks is None:
+            stocks = [None] * len(close_price_np_arrays)
+        if last_bar_timestamps is None:
+            last_bar_timestamps = [None] * len(close_price_np_arrays)
+
+        results = [None] * len(close_price_np_arrays)
+        rows_by_length = {}
+
+        for i, close_price_np_array in enumerate(close_price_np_arrays):
+            key = self.get_cache_key(stocks[i], last_bar_timestamps[i], len(close_price_np_array))
+            if key is not None and key in self.cache:
+                self.cache.move_to_end(key)
+                results[i] = self.cache[key]
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+                rows_by_length.setdefault(len(close_price_np_array), []).append(i)
+
+        #one stacked solve per window length
+        for length, rows in rows_by_length.items():
+            close_price_np_matrix = np.array([close_price_np_arrays[i] for i in rows], dtype=float)
+            for i, result in zip(rows, self.test_on_matrix(close_price_np_matrix)):
+                results[i] = result
+                key = self.get_cache_key(stocks[i], last_bar_timestamps[i], length)
+                if key is not None:
+                    self.cache[key] = result
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+
+        return results
+
+
+    def get_cache_key(self, stock, last_bar_timestamp, length):
+        if stock is None or last_bar_timestamp is None:
+            return None
+        return (stock, int(last_bar_timestamp), length, self.maxlag, self.autolag)
+
+
+    def build_regression(self, close_price_np_matrix, maxlag, lag):
+        #stacked version of adfuller's lagmat, columns are constant, lagged level, then lag diffs, for the rows adfuller uses with maxlag
+        xdiff = np.diff(close_price_np_matrix, axis=1)
+        nobs = xdiff.shape[1] - maxlag
+
+        columns = [np.ones((close_price_np_matrix.shape[0], nobs)), close_price_np_matrix[:, maxlag:maxlag + nobs]]
+        for j in range(1, lag + 1):
+            columns.append(xdiff[:, maxlag - j:maxlag - j + nobs])
+
+        exog = np.stack(columns, axis=2)
+        endog = xdiff[:, maxlag:]
+        return endog, exog
+
+
+    def fit_ols(self, endog, exog):
+        #least squares for every stock at once, returns the level coefficient's t value, the aic and whether the regression has full rank
+        nobs = exog.shape[1]
+        number_of_columns = exog.shape[2]
+        q, r = np.linalg.qr(exog)
+        qty = np.einsum('snk,sn->sk', q, endog)
+
+        #a rank deficient row has a zero on R's diagonal and would make inv raise for the whole batch, so find those rows first
+        #and give them an identity R, their numbers are thrown away and statsmodels answers them instead
+        rank = np.linalg.matrix_rank(exog)
+        r_diagonal = np.abs(np.diagonal(r, axis1=1, axis2=2))
+        tolerance = r_diagonal.max(axis=1, keepdims=True) * max(nobs, number_of_columns) * np.finfo(float).eps
+        full_rank = (rank == number_of_columns) & np.all(r_diagonal > tolerance, axis=1)
+        r[~full_rank] = np.eye(number_of_columns)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r_inverse = np.linalg.inv(r)
+            params = np.einsum('sjk,sk->sj', r_inverse, qty)
+            resid = endog - np.einsum('snk,sk->sn', exog, params)
+            ssr = np.einsum('sn,sn->s', resid, resid)
+
+            scale = ssr / (nobs - rank)
+            #diagonal of (X'X)^-1 for the level column is the squared norm of that row of R^-1
+            level_variance = np.einsum('sk,sk->s', r_inverse[:, 1, :], r_inverse[:, 1, :]) * scale
+            tvalue = params[:, 1] / np.sqrt(level_variance)
+
+            llf = -nobs / 2.0 * (np.log(2 * np.pi) + np.log(ssr / nobs) + 1)
+            aic = -2.0 * llf + 2.0 * rank
+        return tvalue, aic, full_rank
+
+
+    def test_on_matrix(self, close_price_np_matrix):
+
+        number_of_rows, length = close_price_np_matrix.shape
+        maxlag = self.get_maxlag(length)
+        needs_statsmodels = np.zeros(number_of_rows, dtype=bool)
+
+        #adfuller raises on constant or too short series, those rows get its error as their result
+        needs_statsmodels |= close_price_np_matrix.max(axis=1) == close_price_np_matrix.min(axis=1)
+        if maxlag < 0 or maxlag > length // 2 - 1 - 1:
+            needs_statsmodels[:] = True
+
+        results = [None] * number_of_rows
+        rows = np.flatnonzero(~needs_statsmodels)
+
+        if len(rows) > 0:
+            x = close_price_np_matrix[rows]
+
+            if self.autolag is not None:
+                #fit every lag on the same sample so the aic values are comparable, like adfuller's _autolag
+                aics = np.empty((len(rows), maxlag + 1))
+                for lag in range(maxlag + 1):
+                    endog, exog = self.build_regression(x, maxlag, lag)
+                    tvalue, aics[:, lag], full_rank = self.fit_ols(endog, exog)
+                    needs_statsmodels[rows[~full_rank]] = True
+
+                usedlags = np.argmin(aics, axis=1)
+                icbests = aics[np.arange(len(rows)), usedlags]
+
+                #two lags within rounding distance of each other could be picked either way
+                if maxlag > 0:
+                    sorted_aics = np.sort(aics, axis=1)
+                    close_tie = np.abs(sorted_aics[:, 1] - sorted_aics[:, 0]) <= 1e-9 * np.maximum(np.abs(sorted_aics[:, 0]), 1.0)
+                    needs_statsmodels[rows[close_tie]] = True
+            else:
+                usedlags = np.full(len(rows), maxlag)
+                icbests = None
+
+            #rerun the regression with the chosen lag on all the rows that lag allows, grouped by lag
+            adfstats = np.empty(len(rows))
+            nobs_used = np.empty(len(rows), dtype=np.int64)
+            for lag in np.unique(usedlags):
+                lag_rows = np.flatnonzero(usedlags == lag)
+                endog, exog = self.build_regression(x[lag_rows], int(lag), int(lag))
+                tvalue, aic, full_rank = self.fit_ols(endog, exog)
+                adfstats[lag_rows] = tvalue
+                nobs_used[lag_rows] = endog.shape[1]
+                needs_statsmodels[rows[lag_rows[~full_rank]]] = True
+
+            for i, row in enumerate(rows):
+                if needs_statsmodels[row]:
+                    continue
+
+                adfstat = float(adfstats[i])
+                pvalue = mackinnonp(adfstat, regression='c', N=1)
+                critvalues = get_critical_values(int(nobs_used[i]))
+
+                #the verdict compares against these thresholds, a hair's difference from statsmodels must not flip it
+                thresholds = [(pvalue, .05)] + [(adfstat, value) for value in critvalues.values()]
+                if any(abs(left - right) <= 1e-9 * max(abs(right), 1.0) for left, right in thresholds):
+                    needs_statsmodels[row] = True
+                    continue
+
+                if self.autolag is not None:
+                    results[row] = (adfstat, pvalue, int(usedlags[i]), int(nobs_used[i]), critvalues, float(icbests[i]))
+                else:
+                    results[row] = (adfstat, pvalue, int(usedlags[i]), int(nobs_used[i]), critvalues)
+
+        for row in np.flatnonzero(needs_statsmodels):
+            self.statsmodels_fallbacks += 1
+            try:
+                results[row] = adfuller(close_price_np_matrix[row], maxlag=self.maxlag, autolag=self.autolag)
+            except ValueError as error:
+                results[row] = error
+
+        return results
+
+
+
+def is_stationary(result):
+    #the same verdict augmented_dickey_fuller_test_on_list in BasicStrategy gives, a series adfuller refused is not stationary
+    if isinstance(result, Exception):
+        return False
+    is_p_good = result[1] > .05
+    are_criticals_good = all(result[0] > value for value in result[4].values())
+    return is_p_good and are_criticals_good
+
+
+def check_parity_with_statsmodels(number_of_series=2000, length=27, seed=0):
+
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(0, 0.05, (number_of_series, length))
+    #mix random walks with mean reverting series so both verdicts show up
+    steps[::2] -= 0.5 * np.cumsum(steps[::2], axis=1)
+    close_price_np_matrix = np.round(20 + np.cumsum(steps, axis=1), 2)
+    #a flat window with one final jump makes the regression rank deficient, a constant window makes adfuller raise
+    flat_with_jump = np.append(np.full(length - 1, 10.0), 10.5)
+    constant = np.full(length, 10.0)
+    close_price_np_matrix = np.vstack([close_price_np_matrix, flat_with_jump, constant])
+
+    fast_adf = FastAdf()
+    fast_results = fast_adf.test_on_matrix(close_price_np_matrix)
+
+    mismatches = 0
+    for row in range(len(close_price_np_matrix)):
+        fast_result = fast_results[row]
+        try:
+            result = adfuller(close_price_np_matrix[row])
+        except ValueError:
+            mismatches += not isinstance(fast_result, ValueError)
+            continue
+        if (isinstance(fast_result, Exception) or is_stationary(result) != is_stationary(fast_result) or result[2] != fast_result[2] or result[3] != fast_result[3]
+                or not np.isclose(result[0], fast_result[0], rtol=1e-6) or not np.isclose(result[1], fast_result[1], rtol=1e-6)):
+            mismatches += 1
+
+    print(f'{mismatches} of {len(close_price_np_matrix)} series differ from statsmodels adfuller, {fast_adf.statsmodels_fallbacks} were handed to statsmodels.')
+    return mismatches == 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(0 if check_parity_with_statsmodels() else 1)
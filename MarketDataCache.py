@@ -0,0 +1,391 @@
+"""
+    This class is the shared market data layer owned by the StrategyCollector.
+
+    Once per loop the StrategyCollector hands it every strategy, it takes the union of their stock lists
+    and fetches the minute bars for all of them in a few chunked multi-symbol get_barset requests,
+    instead of one request per stock per strategy. A stock used by several strategies is only fetched once.
+
+    The bars are stored in 2-D numpy arrays (one row per stock, one column per minute, right aligned)
+    so strategies can be handed zero-copy views of the rows for their stocks.
+
+    With a BarStore, only the bars newer than what is already on disk are fetched and the matrices are filled from the store,
+    so after a restart the history is already there.
+
+    get_ohlcv() hands out a stock's row as an OhlcvBars, and get_resampler() keeps a longer timeframe for a stock (15 minute bars, say)
+    that is fed the new minute bars after every refresh, so longer bars cost no requests of their own.
+
+    With a BarValidator, every refresh checks the whole block at once. A rejected stock's row is emptied, so no strategy screens bad bars
+    (is_rejected tells a strategy not to fetch it on its own either), and a quarantined stock isn't fetched at all until its quarantine is over.
+    A stale or gappy row is only flagged in bar_codes and kept, a thinly traded stock's bars are still screened.
+
+"""
+
+#basic libraries
+import asyncio
+import numpy as np
+
+from OhlcvBars import OhlcvBars, BarResampler
+from BarValidator import REJECTIONS
+from EventLog import EventLog
+
+
+event_log = EventLog('market_data')
+
+
+class MarketDataCache():
+
+    def __init__(self, new_trade_api_rest, new_symbols_per_request=200, new_bar_store=None):
+        self.alpaca = new_trade_api_rest
+        self.bar_store = new_bar_store
+
+        #alpaca's /v1 bars endpoint accepts at most 200 symbols per request
+        self.symbols_per_request = new_symbols_per_request
+
+        self.symbols = []
+        self.symbol_row = {}
+        self.number_of_data_points = 0
+        self.bar_counts = np.zeros(0, dtype=np.int64)
+        self.open_matrix = np.empty((0, 0))
+        self.high_matrix = np.empty((0, 0))
+        self.low_matrix = np.empty((0, 0))
+        self.close_matrix = np.empty((0, 0))
+        self.volume_matrix = np.empty((0, 0))
+        self.timestamp_matrix = np.empty((0, 0), dtype=np.int64)
+
+        #the BarValidator's reason code for every row of the last refresh, 0 for usable bars, off unless the StrategyCollector sets a validator
+        self.bar_validator = None
+        self.bar_codes = np.zeros(0, dtype=np.uint8)
+
+        #(stock, minutes) -> BarResampler, kept across refreshes
+        self.resamplers = {}
+
+        self.requests_made_last_refresh = 0
+
+
+    def gather_symbols_from_strategies(self, strat_list):
+        #union of every strategy's stock list, kept in order of first appearance
+        #so a strategy's stocks stay next to each other in the matrices
+        symbols = []
+        seen = set()
+        for strat in strat_list:
+            for stock in strat.stock_list:
+                stock = str(stock)
+                if stock not in seen:
+                    seen.add(stock)
+                    symbols.append(stock)
+        return symbols
+
+
+    def get_number_of_data_points_for_strategies(self, strat_list):
+        number_of_data_points = 0
+        for strat in strat_list:
+            number_of_data_points = max(number_of_data_points, strat.get_number_of_minute_bars_needed())
+        return number_of_data_points
+
+
+    def get_number_of_data_points_by_symbol(self, strat_list):
+        #a stock is only truncated when it has fewer bars than the most any of its strategies read
+        number_of_data_points_by_symbol = {}
+        for strat in strat_list:
+            number_of_data_points = strat.get_number_of_minute_bars_needed()
+            for stock in strat.stock_list:
+                stock = str(stock)
+                number_of_data_points_by_symbol[stock] = max(number_of_data_points_by_symbol.get(stock, 0), number_of_data_points)
+        return number_of_data_points_by_symbol
+
+
+    def refresh_for_strategies(self, strat_list):
+        symbols = self.gather_symbols_from_strategies(strat_list)
+        number_of_data_points = self.get_number_of_data_points_for_strategies(strat_list)
+        self.refresh(symbols, number_of_data_points, self.get_number_of_data_points_by_symbol(strat_list))
+
+
+    def refresh(self, symbols, number_of_data_points, number_of_data_points_by_symbol=None):
+
+        self.allocate(symbols, number_of_data_points)
+        self.requests_made_last_refresh = 0
+
+        if number_of_data_points <= 0:
+            return
+
+        if self.bar_validator is not None:
+            self.bar_validator.start_refresh()
+
+        if self.bar_store is not None:
+            self.requests_made_last_refresh = self.bar_store.update(self.get_symbols_to_fetch(), number_of_data_points)
+            self.load_from_bar_store()
+            self.validate_rows(number_of_data_points_by_symbol)
+            self.update_resamplers()
+            event_log.info('market_data_refreshed', stocks=len(self.symbols), requests=self.requests_made_last_refresh, source='bar_store')
+            return
+
+        for chunk in self.get_chunks():
+            barset = self.alpaca.get_barset(chunk, 'minute', limit=number_of_data_points)
+            self.requests_made_last_refresh += 1
+            self.store_barset(chunk, barset)
+        self.validate_rows(number_of_data_points_by_symbol)
+        self.update_resamplers()
+
+        event_log.info('market_data_refreshed', stocks=len(self.symbols), requests=self.requests_made_last_refresh, source='broker')
+
+
+    def get_symbols_to_fetch(self):
+        #quarantined stocks keep their (empty) rows, they just aren't asked for
+        if self.bar_validator is None:
+            return self.symbols
+        return self.bar_validator.get_symbols_to_fetch(self.symbols)
+
+
+    def get_chunks(self):
+        symbols = self.get_symbols_to_fetch()
+        return [symbols[chunk_start:chunk_start + self.symbols_per_request] for chunk_start in range(0, len(symbols), self.symbols_per_request)]
+
+
+    async def refresh_for_strategies_async(self, async_rest, strat_list):
+        symbols = self.gather_symbols_from_strategies(strat_list)
+        number_of_data_points = self.get_number_of_data_points_for_strategies(strat_list)
+        await self.refresh_async(async_rest, symbols, number_of_data_points, self.get_number_of_data_points_by_symbol(strat_list))
+
+
+    #same as refresh, but every chunk is requested at the same time through an AsyncAlpacaRest
+    async def refresh_async(self, async_rest, symbols, number_of_data_points, number_of_data_points_by_symbol=None):
+
+        self.allocate(symbols, number_of_data_points)
+        self.requests_made_last_refresh = 0
+
+        if number_of_data_points <= 0:
+            return
+
+        if self.bar_validator is not None:
+            self.bar_validator.start_refresh()
+
+        if self.bar_store is not None:
+            self.requests_made_last_refresh = await self.bar_store.update_async(async_rest, self.get_symbols_to_fetch(), number_of_data_points)
+            self.load_from_bar_store()
+            self.validate_rows(number_of_data_points_by_symbol)
+            self.update_resamplers()
+            event_log.info('market_data_refreshed', stocks=len(self.symbols), requests=self.requests_made_last_refresh, source='bar_store', concurrent=True)
+            return
+
+        chunks = self.get_chunks()
+        barsets = await asyncio.gather(*[async_rest.get_barset(chunk, 'minute', limit=number_of_data_points) for chunk in chunks])
+        for chunk, barset in zip(chunks, barsets):
+            self.requests_made_last_refresh += 1
+            self.store_barset(chunk, barset)
+        self.validate_rows(number_of_data_points_by_symbol)
+        self.update_resamplers()
+
+        event_log.info('market_data_refreshed', stocks=len(self.symbols), requests=self.requests_made_last_refresh, source='broker', concurrent=True)
+
+
+    def allocate(self, symbols, number_of_data_points):
+        self.symbols = list(symbols)
+        self.symbol_row = {stock: row for row, stock in enumerate(self.symbols)}
+        self.number_of_data_points = number_of_data_points
+
+        shape = (len(self.symbols), number_of_data_points)
+        self.bar_counts = np.zeros(len(self.symbols), dtype=np.int64)
+        self.open_matrix = np.full(shape, np.nan)
+        self.high_matrix = np.full(shape, np.nan)
+        self.low_matrix = np.full(shape, np.nan)
+        self.close_matrix = np.full(shape, np.nan)
+        self.volume_matrix = np.full(shape, np.nan)
+        self.timestamp_matrix = np.zeros(shape, dtype=np.int64)
+        self.bar_codes = np.zeros(len(self.symbols), dtype=np.uint8)
+
+
+    #fills the cache from bars that are already aligned, used by the backtest instead of calling the broker
+    #open, high and low default to the close for a source that only has closes
+    def load_matrices(self, symbols, close_matrix, volume_matrix, timestamp_matrix, bar_counts, open_matrix=None, high_matrix=None, low_matrix=None):
+        if symbols != self.symbols:
+            self.symbols = list(symbols)
+            self.symbol_row = {stock: row for row, stock in enumerate(self.symbols)}
+        self.number_of_data_points = close_matrix.shape[1]
+        self.open_matrix = close_matrix if open_matrix is None else open_matrix
+        self.high_matrix = close_matrix if high_matrix is None else high_matrix
+        self.low_matrix = close_matrix if low_matrix is None else low_matrix
+        self.close_matrix = close_matrix
+        self.volume_matrix = volume_matrix
+        self.timestamp_matrix = timestamp_matrix
+        self.bar_counts = bar_counts
+        self.bar_codes = np.zeros(len(self.symbols), dtype=np.uint8)
+        self.requests_made_last_refresh = 0
+        self.update_resamplers()
+
+
+    def store_barset(self, chunk, barset):
+        for stock in chunk:
+            bars = barset.get(stock)
+            if not bars:
+                continue
+
+            #read the raw json rows, building a DataFrame per stock is what made the old path slow
+            raw_bars = bars._raw[-self.number_of_data_points:]
+            count = len(raw_bars)
+            row = self.symbol_row[stock]
+
+            self.bar_counts[row] = count
+            self.open_matrix[row, -count:] = [bar['o'] for bar in raw_bars]
+            self.high_matrix[row, -count:] = [bar['h'] for bar in raw_bars]
+            self.low_matrix[row, -count:] = [bar['l'] for bar in raw_bars]
+            self.close_matrix[row, -count:] = [bar['c'] for bar in raw_bars]
+            self.volume_matrix[row, -count:] = [bar['v'] for bar in raw_bars]
+            self.timestamp_matrix[row, -count:] = [bar['t'] for bar in raw_bars]
+
+
+    def load_from_bar_store(self):
+        for row, stock in enumerate(self.symbols):
+            if self.bar_validator is not None and self.bar_validator.is_quarantined(stock):
+                continue
+            bars = self.bar_store.get_last_bars(stock, self.number_of_data_points)
+            count = len(bars['t'])
+            if count == 0:
+                continue
+            self.bar_counts[row] = count
+            self.open_matrix[row, -count:] = bars['o']
+            self.high_matrix[row, -count:] = bars['h']
+            self.low_matrix[row, -count:] = bars['l']
+            self.close_matrix[row, -count:] = bars['c']
+            self.volume_matrix[row, -count:] = bars['v']
+            self.timestamp_matrix[row, -count:] = bars['t']
+
+
+    #one pass over the whole block, the rows the validator rejects are emptied so they read like a stock without bars, flagged rows are kept
+    def validate_rows(self, number_of_data_points_by_symbol=None):
+        if self.bar_validator is None:
+            return
+        if number_of_data_points_by_symbol is None:
+            number_of_data_points = self.number_of_data_points
+        else:
+            number_of_data_points = np.array([number_of_data_points_by_symbol.get(stock, self.number_of_data_points) for stock in self.symbols], dtype=np.int64)
+
+        self.bar_codes = self.bar_validator.validate(self.symbols, self.close_matrix, self.timestamp_matrix, self.bar_counts, number_of_data_points,
+                                                     price_matrices=(self.open_matrix, self.high_matrix, self.low_matrix))
+        rejected_rows = np.flatnonzero(self.bar_codes & REJECTIONS)
+        if len(rejected_rows) == 0:
+            return
+        for matrix in (self.open_matrix, self.high_matrix, self.low_matrix, self.close_matrix, self.volume_matrix):
+            matrix[rejected_rows] = np.nan
+        self.timestamp_matrix[rejected_rows] = 0
+        self.bar_counts[rejected_rows] = 0
+
+
+    def is_rejected(self, stock):
+        #the stock's bars were thrown out by the last refresh's validation, fetching them again for one strategy won't help
+        row = self.symbol_row.get(stock)
+        return row is not None and row < len(self.bar_codes) and (self.bar_codes[row] & REJECTIONS) != 0
+
+
+    #streaming mode, one new bar slides the stock's row left by one instead of refetching the whole window
+    def append_bar(self, stock, bar):
+        row = self.symbol_row.get(stock)
+        if row is None or self.number_of_data_points <= 0:
+            return False
+        if self.bar_validator is not None and self.bar_validator.is_quarantined(stock):
+            return False
+        if self.bar_counts[row] > 0 and bar['t'] <= self.timestamp_matrix[row, -1]:
+            return False
+
+        for matrix, name in ((self.open_matrix, 'o'), (self.high_matrix, 'h'), (self.low_matrix, 'l'), (self.close_matrix, 'c'), (self.volume_matrix, 'v'),
+                             (self.timestamp_matrix, 't')):
+            matrix[row, :-1] = matrix[row, 1:]
+            matrix[row, -1] = bar[name]
+        self.bar_counts[row] = min(self.bar_counts[row] + 1, self.number_of_data_points)
+        self.update_resamplers([stock])
+
+        if self.bar_store is not None:
+            self.bar_store.append_bars(stock, {name: [bar[name]] for name in ('t', 'o', 'h', 'l', 'c', 'v')})
+        return True
+
+
+    def has_data(self, stock, number_of_data_points):
+        #only serve requests that fit inside what was fetched this loop
+        row = self.symbol_row.get(stock)
+        if row is None or number_of_data_points > self.number_of_data_points:
+            return False
+        return self.bar_counts[row] > 0
+
+
+    def get_row_slice(self, stock, number_of_data_points):
+        row = self.symbol_row[stock]
+        count = min(int(self.bar_counts[row]), number_of_data_points)
+        return row, slice(self.number_of_data_points - count, self.number_of_data_points)
+
+
+    def get_close_prices(self, stock, number_of_data_points):
+        #basic slicing of a row returns a view, nothing is copied
+        row, columns = self.get_row_slice(stock, number_of_data_points)
+        return self.close_matrix[row, columns]
+
+
+    def get_volumes(self, stock, number_of_data_points):
+        row, columns = self.get_row_slice(stock, number_of_data_points)
+        return self.volume_matrix[row, columns]
+
+
+    def get_timestamps(self, stock, number_of_data_points):
+        row, columns = self.get_row_slice(stock, number_of_data_points)
+        return self.timestamp_matrix[row, columns]
+
+
+    def get_ohlcv(self, stock, number_of_data_points):
+        #every column of the stock's row as views, nothing is copied
+        row, columns = self.get_row_slice(stock, number_of_data_points)
+        return OhlcvBars({'t': self.timestamp_matrix[row, columns], 'o': self.open_matrix[row, columns], 'h': self.high_matrix[row, columns],
+                          'l': self.low_matrix[row, columns], 'c': self.close_matrix[row, columns], 'v': self.volume_matrix[row, columns]})
+
+
+    #----- longer timeframes -----
+
+    def get_resampler(self, stock, minutes, max_bars=200):
+        #a new resampler starts from the minute bars the cache holds now, seed it with older minute bars first (BarResampler.update) for a longer history
+        key = (stock, minutes)
+        if key not in self.resamplers:
+            self.resamplers[key] = BarResampler(minutes, max_bars)
+        return self.resamplers[key]
+
+
+    def has_resampler(self, stock, minutes):
+        return (stock, minutes) in self.resamplers
+
+
+    def update_resamplers(self, stocks=None):
+        #only the minute bars a resampler hasn't seen are added, a bar that closed since the last refresh costs O(1)
+        for (stock, minutes), resampler in self.resamplers.items():
+            if (stocks is None or stock in stocks) and stock in self.symbol_row and self.bar_counts[self.symbol_row[stock]] > 0:
+                resampler.update(self.get_ohlcv(stock, self.number_of_data_points))
+
+
+    def get_last_timestamp(self, stock):
+        row = self.symbol_row[stock]
+        if self.bar_counts[row] == 0:
+            return None
+        return int(self.timestamp_matrix[row, -1])
+
+
+    def has_rows(self, stock_list, number_of_data_points):
+        if number_of_data_points > self.number_of_data_points:
+            return False
+        for stock in stock_list:
+            if str(stock) not in self.symbol_row:
+                return False
+        return True
+
+
+    def get_close_matrix(self, stock_list, number_of_data_points):
+        #(stocks x minutes) block for a strategy, stocks without bars are rows of nan
+        rows = [self.symbol_row[str(stock)] for stock in stock_list]
+        columns = slice(self.number_of_data_points - number_of_data_points, self.number_of_data_points)
+        if len(rows) > 0 and rows == list(range(rows[0], rows[0] + len(rows))):
+            #the strategy's stocks sit next to each other, so this is a view
+            return self.close_matrix[rows[0]:rows[0] + len(rows), columns]
+        return self.close_matrix[rows, columns]
+
+
+    def get_close_price_views(self, stock_list, number_of_data_points):
+        views = {}
+        for stock in stock_list:
+            stock = str(stock)
+            if self.has_data(stock, number_of_data_points):
+                views[stock] = self.get_close_prices(stock, number_of_data_points)
+        return views
@@ -0,0 +1,161 @@
+"""
+    These classes hold one stock's bars as columns, so close prices, volumes and longer timeframes all come from one minute bar fetch.
+
+    OhlcvBars is six numpy arrays, t (epoch seconds), o, h, l, c and v, built straight from alpaca's raw json rows
+    (or from a BarStore's or MarketDataCache's columns) without a DataFrame. resample() groups its minute bars into longer bars.
+    BarResampler keeps a longer timeframe (15 minute bars, say) up to date one minute bar at a time: update() only reads the minute bars newer
+    than the last one it saw, adds them to the bar that is still forming and closes that bar once a minute from the next bucket arrives.
+
+    Bars start on multiples of their length in epoch time, like alpaca's, so 15 minute bars start at :00, :15, :30 and :45,
+    and the newest one may still be forming, also like alpaca's.
+
+"""
+
+#basic libraries
+import numpy as np
+
+
+OHLCV_COLUMNS = ('t', 'o', 'h', 'l', 'c', 'v')
+
+
+def get_column_dtype(name):
+    return np.int64 if name == 't' else np.float64
+
+
+def aggregate_bars(columns, seconds_per_bar):
+    #groups minute bars into longer bars that start on multiples of seconds_per_bar
+    if len(columns['t']) == 0:
+        return columns
+    group = np.asarray(columns['t']) // seconds_per_bar
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    ends = np.r_[starts[1:], len(group)] - 1
+    return {
+        't': group[starts] * seconds_per_bar,
+        'o': np.asarray(columns['o'])[starts],
+        'h': np.maximum.reduceat(np.asarray(columns['h']), starts),
+        'l': np.minimum.reduceat(np.asarray(columns['l']), starts),
+        'c': np.asarray(columns['c'])[ends],
+        'v': np.add.reduceat(np.asarray(columns['v']), starts),
+    }
+
+
+
+class OhlcvBars():
+
+    __slots__ = OHLCV_COLUMNS
+
+    def __init__(self, new_columns):
+        for name in OHLCV_COLUMNS:
+            setattr(self, name, np.asarray(new_columns[name], dtype=get_column_dtype(name)))
+
+
+    @classmethod
+    def from_raw_bars(cls, raw_bars):
+        #alpaca's json rows, oldest first
+        return cls({name: np.fromiter((bar[name] for bar in raw_bars), dtype=get_column_dtype(name), count=len(raw_bars)) for name in OHLCV_COLUMNS})
+
+
+    @classmethod
+    def from_barset(cls, barset, stock):
+        bars = barset.get(stock)
+        return cls.from_raw_bars(bars._raw if bars else [])
+
+
+    @classmethod
+    def empty(cls):
+        return cls({name: np.zeros(0, dtype=get_column_dtype(name)) for name in OHLCV_COLUMNS})
+
+
+    def __len__(self):
+        return len(self.t)
+
+
+    def get_columns(self):
+        return {name: getattr(self, name) for name in OHLCV_COLUMNS}
+
+
+    def tail(self, number_of_bars):
+        #views of the last number_of_bars bars, nothing is copied
+        start = max(0, len(self.t) - number_of_bars)
+        return OhlcvBars({name: getattr(self, name)[start:] for name in OHLCV_COLUMNS})
+
+
+    def after(self, timestamp):
+        #the bars newer than timestamp, the columns are sorted so this is a binary search and a view
+        start = np.searchsorted(self.t, timestamp, side='right')
+        return OhlcvBars({name: getattr(self, name)[start:] for name in OHLCV_COLUMNS})
+
+
+    def resample(self, minutes):
+        if minutes == 1:
+            return self
+        return OhlcvBars(aggregate_bars(self.get_columns(), 60 * minutes))
+
+
+
+class BarResampler():
+
+    def __init__(self, new_minutes, new_max_bars=200):
+        self.minutes = new_minutes
+        self.seconds_per_bar = 60 * new_minutes
+        self.max_bars = new_max_bars
+
+        #closed bars, kept in twice max_bars of space and compacted when full, so adding one is O(1) amortized
+        self.columns = {name: np.zeros(2 * new_max_bars, dtype=get_column_dtype(name)) for name in OHLCV_COLUMNS}
+        self.count = 0
+
+        #the bar that is still forming, None before the first minute bar
+        self.forming = None
+        self.last_minute_timestamp = None
+
+
+    def update(self, minute_bars):
+        #minute_bars is an OhlcvBars of minute bars, anything already seen is skipped
+        if self.last_minute_timestamp is not None:
+            minute_bars = minute_bars.after(self.last_minute_timestamp)
+        if len(minute_bars) == 0:
+            return 0
+
+        grouped = aggregate_bars(minute_bars.get_columns(), self.seconds_per_bar)
+        for i in range(len(grouped['t'])):
+            self.add_bar(int(grouped['t'][i]), grouped['o'][i], grouped['h'][i], grouped['l'][i], grouped['c'][i], grouped['v'][i])
+        self.last_minute_timestamp = int(minute_bars.t[-1])
+        return len(minute_bars)
+
+
+    def add_bar(self, start, open_price, high, low, close, volume):
+        #a part of the bar starting at start, merged into the forming bar or closing it and starting the next one
+        if self.forming is not None and self.forming[0] == start:
+            forming = self.forming
+            forming[2] = max(forming[2], high)
+            forming[3] = min(forming[3], low)
+            forming[4] = close
+            forming[5] += volume
+            return
+
+        if self.forming is not None:
+            self.close_forming_bar()
+        self.forming = [start, open_price, high, low, close, volume]
+
+
+    def close_forming_bar(self):
+        if self.count == len(self.columns['t']):
+            for name in OHLCV_COLUMNS:
+                self.columns[name][:self.max_bars] = self.columns[name][self.count - self.max_bars:self.count]
+            self.count = self.max_bars
+        for name, value in zip(OHLCV_COLUMNS, self.forming):
+            self.columns[name][self.count] = value
+        self.count += 1
+
+
+    def get_bars(self, number_of_bars, include_forming=True):
+        #the newest number_of_bars bars, the last one still forming unless include_forming is False
+        start = max(0, self.count - number_of_bars + (1 if include_forming and self.forming is not None else 0))
+        columns = {name: self.columns[name][start:self.count] for name in OHLCV_COLUMNS}
+        if include_forming and self.forming is not None and number_of_bars > 0:
+            columns = {name: np.append(columns[name], value) for name, value in zip(OHLCV_COLUMNS, self.forming)}
+        return OhlcvBars(columns)
+
+
+    def get_bar_count(self, include_forming=True):
+        return self.count + (1 if include_forming and self.forming is not None else 0)
@@ -0,0 +1,315 @@
+"""
+    This class places the strategies' orders on worker threads, so a strategy hands over an order intent and moves on to its next stock.
+
+    An intent is a buy of some shares protected by a trailing stop. The pipeline sends the immediate or cancel market buy, waits for it to
+    reach a final status, and only then sends the trailing stop, for the quantity that actually filled; a buy that didn't fill gets no stop.
+
+    Every order carries a client_order_id built from the strategy's journal_id_int. The broker refuses a second order with the same id,
+    so a request that failed in a way that may still have reached the broker (a timeout, a dropped connection, a 5xx) is retried safely:
+    the pipeline first looks the id up, and a retry that is refused as a duplicate fetches the order that got through instead.
+    Errors that can't be transient (a 403, a 422 for a bad order) are not retried.
+
+    Intents are tracked by client_order_id, and a stock with an intent still in flight counts as having an open order.
+
+    The wait for the buy's fill polls get_order after poll_seconds, doubling the wait after every poll up to max_poll_seconds, so a slow fill
+    costs a handful of order requests instead of one every poll_seconds. With max_polls_per_tick, the polls of all intents share that many
+    get_order calls between two start_tick calls (the StrategyCollector calls it every tick), the rest wait for the next tick or the fill timeout.
+
+"""
+
+#basic libraries
+import time
+import threading
+import concurrent.futures
+
+import requests
+
+#algo brokerage api
+from alpaca_trade_api.rest import APIError
+
+from EventLog import EventLog
+
+
+event_log = EventLog('orders')
+
+FINAL_ORDER_STATUSES = ('filled', 'canceled', 'expired', 'rejected', 'done_for_day', 'replaced')
+TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+def get_error_status_code(error):
+    #a real APIError carries the http response, FakeAlpaca's and SimulatedBroker's only carry alpaca's code, which starts with the status
+    if error.status_code is not None:
+        return error.status_code
+    if isinstance(error.code, int):
+        return error.code // 100000
+    return None
+
+
+def is_transient_error(error):
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ConnectionError, TimeoutError)):
+        return True
+    return isinstance(error, APIError) and get_error_status_code(error) in TRANSIENT_STATUS_CODES
+
+
+def is_duplicate_client_order_id_error(error):
+    return isinstance(error, APIError) and 'client_order_id' in str(error)
+
+
+
+class OrderIntent():
+
+    def __init__(self, new_strategy_name, new_symbol, new_qty, new_client_order_id, new_trail_percent=None, new_trail_price=None):
+        self.strategy_name = new_strategy_name
+        self.symbol = new_symbol
+        self.qty = new_qty
+        self.client_order_id = new_client_order_id
+        self.trail_percent = new_trail_percent
+        self.trail_price = new_trail_price
+
+        #pending -> submitted -> filled -> protected, or not_filled, filled_without_stop, failed
+        self.state = 'pending'
+        self.buy_order = None
+        self.stop_order = None
+        self.filled_qty = 0.0
+        self.filled_avg_price = None
+        self.attempts = 0
+        self.error = None
+        self.future = None
+
+        #called with every order the broker accepted, and with the intent once it is finished, from the worker thread
+        self.on_order = None
+        self.on_finished = None
+
+        self.created = time.monotonic()
+        self.finished = None
+
+
+    def get_stop_client_order_id(self):
+        return self.client_order_id + '-stop'
+
+
+    def is_active(self):
+        return self.finished is None
+
+
+    def __repr__(self):
+        return f'OrderIntent(client_order_id={self.client_order_id}, symbol={self.symbol}, qty={self.qty}, state={self.state}, filled_qty={self.filled_qty})'
+
+
+
+class OrderPipeline():
+
+    def __init__(self, new_trade_api_rest, new_number_of_threads=8, new_fill_timeout_seconds=10.0, new_poll_seconds=0.2, new_max_poll_seconds=2.0,
+                 new_max_polls_per_tick=None, new_max_attempts=4, new_retry_backoff_seconds=0.25, new_sleep_function=time.sleep):
+        self.alpaca = new_trade_api_rest
+        self.number_of_threads = new_number_of_threads
+        self.fill_timeout_seconds = new_fill_timeout_seconds
+        self.poll_seconds = new_poll_seconds
+        self.max_poll_seconds = new_max_poll_seconds
+        self.max_polls_per_tick = new_max_polls_per_tick
+        self.max_attempts = new_max_attempts
+        self.retry_backoff_seconds = new_retry_backoff_seconds
+        self.sleep = new_sleep_function
+
+        self.executor = None
+        self.intents_by_client_order_id = {}
+        self.active_intents_by_symbol = {}
+        self.retries = 0
+        self.duplicates_avoided = 0
+        self.polls = 0
+        self.polls_this_tick = 0
+        self.polls_deferred = 0
+
+        #the strategies submit from the loop's thread while the workers finish intents
+        self.lock = threading.Lock()
+        #a worker out of polls for this tick waits on it until start_tick hands out new ones
+        self.poll_budget_renewed = threading.Condition(self.lock)
+
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.number_of_threads, thread_name_prefix='order-pipeline')
+        return self.executor
+
+
+    def submit(self, intent):
+        with self.lock:
+            if intent.client_order_id in self.intents_by_client_order_id:
+                raise ValueError(f'client_order_id {intent.client_order_id} was already used')
+            self.intents_by_client_order_id[intent.client_order_id] = intent
+            self.active_intents_by_symbol.setdefault(intent.symbol, set()).add(intent.client_order_id)
+
+        event_log.info('order_intent', strategy=intent.strategy_name, symbol=intent.symbol, qty=intent.qty, client_order_id=intent.client_order_id)
+        intent.future = self.get_executor().submit(self.execute, intent)
+        return intent
+
+
+    def has_active_intent(self, symbol):
+        with self.lock:
+            return len(self.active_intents_by_symbol.get(symbol, ())) > 0
+
+
+    #----- one intent, on a worker thread -----
+
+    def execute(self, intent):
+        try:
+            buy_order = self.place_order(intent, intent.client_order_id, symbol=intent.symbol, qty=intent.qty, side='buy', type='market', time_in_force='ioc')
+            intent.buy_order = buy_order
+            intent.state = 'submitted'
+            self.report_order(intent, buy_order)
+
+            buy_order = self.wait_for_final_status(buy_order)
+            intent.buy_order = buy_order
+            intent.filled_qty = float(buy_order.filled_qty or 0)
+            intent.filled_avg_price = buy_order.filled_avg_price
+            if intent.filled_qty <= 0:
+                intent.state = 'not_filled'
+                return intent
+
+            #the stop protects what was bought, not what was asked for
+            intent.state = 'filled'
+            stop_qty = int(intent.filled_qty)
+            if stop_qty <= 0:
+                intent.state = 'filled_without_stop'
+                return intent
+
+            stop_arguments = {'trail_percent': intent.trail_percent} if intent.trail_price is None else {'trail_price': intent.trail_price}
+            intent.stop_order = self.place_order(intent, intent.get_stop_client_order_id(), symbol=intent.symbol, qty=stop_qty, side='sell',
+                                                 type='trailing_stop', time_in_force='gtc', **stop_arguments)
+            intent.state = 'protected'
+            self.report_order(intent, intent.stop_order)
+            return intent
+
+        except Exception as error:
+            intent.state = 'failed'
+            intent.error = repr(error)
+            event_log.error('order_failed', strategy=intent.strategy_name, symbol=intent.symbol, client_order_id=intent.client_order_id,
+                            filled_qty=intent.filled_qty, error=intent.error)
+            return intent
+
+        finally:
+            intent.finished = time.monotonic()
+            with self.lock:
+                self.active_intents_by_symbol.get(intent.symbol, set()).discard(intent.client_order_id)
+            event_log.info('order_intent_finished', strategy=intent.strategy_name, symbol=intent.symbol, client_order_id=intent.client_order_id,
+                           state=intent.state, qty=intent.qty, filled_qty=intent.filled_qty, filled_avg_price=intent.filled_avg_price,
+                           attempts=intent.attempts, seconds=intent.finished - intent.created)
+            if intent.on_finished is not None:
+                intent.on_finished(intent)
+
+
+    def place_order(self, intent, client_order_id, **order_arguments):
+        for attempt in range(1, self.max_attempts + 1):
+            intent.attempts += 1
+            try:
+                return self.alpaca.submit_order(client_order_id=client_order_id, **order_arguments)
+            except Exception as error:
+                #an earlier attempt got through after all, use that order instead of placing a second one
+                if attempt > 1 and is_duplicate_client_order_id_error(error):
+                    self.duplicates_avoided += 1
+                    return self.get_order_by_client_order_id(client_order_id)
+                if not is_transient_error(error) or attempt == self.max_attempts:
+                    raise
+
+                existing_order = self.find_order(client_order_id)
+                if existing_order is not None:
+                    self.duplicates_avoided += 1
+                    return existing_order
+
+                self.retries += 1
+                event_log.warning('order_retry', symbol=order_arguments.get('symbol'), client_order_id=client_order_id, attempt=attempt, error=repr(error))
+                self.sleep(self.retry_backoff_seconds * 2 ** (attempt - 1))
+
+
+    def get_order_by_client_order_id(self, client_order_id):
+        #the order is known to exist, only a transient failure can keep the lookup from finding it
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return self.alpaca.get_order_by_client_order_id(client_order_id)
+            except Exception as error:
+                if not is_transient_error(error) or attempt == self.max_attempts:
+                    raise
+                self.sleep(self.retry_backoff_seconds * 2 ** (attempt - 1))
+
+
+    def find_order(self, client_order_id):
+        #if the lookup fails too, the retry is still safe, the broker refuses the id if the first request got through
+        try:
+            return self.alpaca.get_order_by_client_order_id(client_order_id)
+        except Exception:
+            return None
+
+
+    def wait_for_final_status(self, order):
+        deadline = time.monotonic() + self.fill_timeout_seconds
+        poll_seconds = self.poll_seconds
+        while order.status not in FINAL_ORDER_STATUSES:
+            if time.monotonic() >= deadline:
+                #whatever filled by now is what gets protected
+                try:
+                    self.alpaca.cancel_order(order.id)
+                except Exception as error:
+                    event_log.warning('order_cancel_failed', symbol=order.symbol, order_id=order.id, error=repr(error))
+                return self.get_order(order)
+            self.sleep(min(poll_seconds, max(0.0, deadline - time.monotonic())))
+            poll_seconds = min(poll_seconds * 2, self.max_poll_seconds)
+            if self.take_poll(deadline):
+                order = self.get_order(order)
+        return order
+
+
+    def take_poll(self, deadline):
+        #False when this tick's polls ran out and no new tick started before the deadline
+        with self.poll_budget_renewed:
+            while self.max_polls_per_tick is not None and self.polls_this_tick >= self.max_polls_per_tick:
+                seconds_left = deadline - time.monotonic()
+                if seconds_left <= 0:
+                    return False
+                self.polls_deferred += 1
+                self.poll_budget_renewed.wait(seconds_left)
+            self.polls_this_tick += 1
+            self.polls += 1
+            return True
+
+
+    def start_tick(self):
+        with self.poll_budget_renewed:
+            self.polls_this_tick = 0
+            self.poll_budget_renewed.notify_all()
+
+
+    def get_order(self, order):
+        try:
+            return self.alpaca.get_order(order.id)
+        except Exception as error:
+            if not is_transient_error(error):
+                raise
+            return order
+
+
+    def report_order(self, intent, order):
+        if intent.on_order is not None:
+            intent.on_order(order)
+
+
+    #----- waiting and reporting -----
+
+    def wait_for_all(self, timeout=None):
+        with self.lock:
+            futures = [intent.future for intent in self.intents_by_client_order_id.values() if intent.future is not None]
+        concurrent.futures.wait(futures, timeout=timeout)
+
+
+    def get_state_counts(self):
+        with self.lock:
+            intents = list(self.intents_by_client_order_id.values())
+        state_counts = {}
+        for intent in intents:
+            state_counts[intent.state] = state_counts.get(intent.state, 0) + 1
+        return state_counts
+
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
@@ -0,0 +1,387 @@
+"""
+    This class searches StrategyBuyFiveMinuteSpikes settings (long, short, slope_duration, slope_threshold,
+    short_long_slope_diff_threshold and target_profit) over stored minute bars, with a grid or a random search,
+    instead of guessing them for every tier in AlgoTradingBot.
+
+    Every combination replays the strategy's rules on each stock's whole bar history at once:
+    a buy happens on a bar where the long+2 bar window is clean, the short SMA crosses above the long SMA with the required slopes
+    and the ADF test says the window is stationary, and the stock is not already held.
+    The position is sold by the 1% trailing stop, or at the close of the first bar whose unrealized profit beats target_profit,
+    the same fills the SimulatedBroker gives the BacktestEngine.
+    Stocks are simulated independently and the account is assumed to cover every purchase that fits the allocation,
+    so a combination's ranking is not decided by which stock happened to buy first.
+
+    The bars are copied once into shared memory that every worker process maps, no worker gets its own copy.
+    Combinations are sorted and handed out in chunks that share a long window, so inside a worker the rolling sums of a window
+    and the ADF results of a long+2 bar window are computed once per stock and reused by every combination that needs them.
+
+    Each finished chunk is appended to the results file right away, running the same sweep again skips the combinations
+    already in it, so an interrupted sweep picks up where it stopped.
+
+"""
+
+#basic libraries
+import os
+import random
+import itertools
+import multiprocessing
+import concurrent.futures
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import pandas as pd
+
+from FastAdf import FastAdf, is_stationary
+from BacktestEngine import read_bar_files
+from EventLog import EventLog
+
+
+event_log = EventLog('sweep')
+
+
+PARAMETER_NAMES = ('long', 'short', 'slope_duration', 'slope_threshold', 'short_long_slope_diff_threshold', 'target_profit')
+SHARED_COLUMNS = ('t', 'o', 'h', 'l', 'c')
+
+
+#bars of every stock back to back, set in each worker by attach_shared_bars
+worker_bars = None
+worker_adf_test = None
+
+
+def share_array(np_array):
+    #copies an array into a new shared memory block, the descriptor is all another process needs to map it
+    block = shared_memory.SharedMemory(create=True, size=max(1, np_array.nbytes))
+    shared_np_array = np.ndarray(np_array.shape, dtype=np_array.dtype, buffer=block.buf)
+    shared_np_array[:] = np_array
+    return block, (block.name, np_array.shape, np_array.dtype.str)
+
+
+def attach_shared_array(descriptor):
+    name, shape, dtype = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    #the parent owns the block, keep the worker's resource tracker from unlinking it when the worker exits
+    resource_tracker.unregister(block._name, 'shared_memory')
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def attach_shared_bars(descriptors, symbols, offsets):
+    global worker_bars
+    blocks = {}
+    columns = {}
+    for name, descriptor in descriptors.items():
+        blocks[name], columns[name] = attach_shared_array(descriptor)
+    worker_bars = {'blocks': blocks, 'columns': columns, 'symbols': symbols, 'offsets': offsets}
+
+
+def run_sweep_task(combinations, settings):
+    global worker_adf_test
+    if worker_adf_test is None:
+        worker_adf_test = FastAdf(new_cache_size=settings['adf_cache_size'])
+    return evaluate_combinations(worker_bars, combinations, settings, worker_adf_test)
+
+
+def get_rolling_means(close_np_array, window, rolling_sums):
+    #the moving average ending at every bar, nan until the first full window, computed once per window length
+    if window not in rolling_sums:
+        sma = np.full(len(close_np_array), np.nan)
+        if 0 < window <= len(close_np_array):
+            windows = np.lib.stride_tricks.sliding_window_view(close_np_array, window)
+            sums = windows.sum(axis=1)
+            sma[window - 1:] = sums / window
+            #a flat window averages to exactly its value, like get_sma_on_matrix in BasicStrategy
+            flat = windows.min(axis=1) == windows.max(axis=1)
+            sma[window - 1:][flat] = windows[flat, 0]
+        rolling_sums[window] = sma
+    return rolling_sums[window]
+
+
+def get_crossing_buy_indexes(close_np_array, combination, rolling_sums):
+    #every bar where check_mean_reversion_of_long_and_short_sma_and_sma_slopes_on_matrix would find a signal in the long+2 bar window ending there
+    long, short, delta_t = combination['long'], combination['short'], combination['slope_duration']
+    history_length = long + 2
+    length = len(close_np_array)
+
+    #a slope that needs more bars than the window holds is nan live, so it never signals
+    if length < history_length or long + delta_t > history_length or short + delta_t > history_length or delta_t < 1:
+        return np.zeros(0, dtype=np.int64)
+
+    sma_long = get_rolling_means(close_np_array, long, rolling_sums)
+    sma_short = get_rolling_means(close_np_array, short, rolling_sums)
+    index = np.arange(history_length - 1, length)
+
+    diff_long = (sma_long[index] - sma_long[index - delta_t]) / delta_t
+    diff_short = (sma_short[index] - sma_short[index - delta_t]) / delta_t
+    diff_delta = diff_short - diff_long
+
+    crossing_buy = (sma_short[index] > sma_long[index]) & (sma_short[index - 1] <= sma_long[index - 1])
+    crossing_buy &= (diff_short > combination['slope_threshold']) & (diff_delta > combination['short_long_slope_diff_threshold'])
+
+    #a window with a zero price is skipped by is_historical_data_clean
+    zero_counts = np.concatenate(([0], np.cumsum(close_np_array == 0.0)))
+    crossing_buy &= zero_counts[index + 1] - zero_counts[index + 1 - history_length] == 0
+
+    return index[crossing_buy]
+
+
+def find_exit(bars, entry_index, entry_price, qty, target_profit, trail_percent):
+    #first bar after the entry where the trailing stop or the profit target closes the position, scanned in growing blocks
+    opens, highs, lows, closes = bars['o'], bars['h'], bars['l'], bars['c']
+    end_of_data = len(closes)
+    high_water_mark = entry_price
+    block_start = entry_index + 1
+    block_size = 390
+
+    while block_start < end_of_data:
+        block_end = min(end_of_data, block_start + block_size)
+
+        #the stop is checked against the high water mark from before each bar, like the SimulatedBroker does
+        previous_marks = np.maximum.accumulate(np.concatenate(([high_water_mark], highs[block_start:block_end])))[:-1]
+        stop_prices = previous_marks * (1 - trail_percent / 100.0)
+        stop_hit = lows[block_start:block_end] <= stop_prices
+        profit_hit = (closes[block_start:block_end] - entry_price) * qty > target_profit
+        hit = stop_hit | profit_hit
+
+        if hit.any():
+            k = int(np.argmax(hit))
+            if stop_hit[k]:
+                return block_start + k, min(float(opens[block_start + k]), float(stop_prices[k])), 'trailing_stop'
+            return block_start + k, float(closes[block_start + k]), 'target_profit'
+
+        high_water_mark = max(high_water_mark, float(highs[block_start:block_end].max()))
+        block_start = block_end
+        block_size *= 2
+
+    #still held when the data ends, valued at the last close
+    return end_of_data - 1, float(closes[-1]), 'open'
+
+
+def simulate_stock(bars, stock, combination, rolling_sums, adf_test, settings):
+    closes = bars['c']
+    history_length = combination['long'] + 2
+    signal_indexes = get_crossing_buy_indexes(closes, combination, rolling_sums)
+
+    #the ADF result of a window only depends on long, so the FastAdf cache shares it between combinations
+    windows = [closes[index - history_length + 1:index + 1] for index in signal_indexes]
+    timestamps = [int(bars['t'][index]) for index in signal_indexes]
+    adf_results = adf_test.test_on_lists(windows, [stock] * len(windows), timestamps)
+
+    trades = []
+    opportunities = 0
+    next_allowed_index = 0
+    for i, index in enumerate(signal_indexes):
+        if not is_stationary(adf_results[i]):
+            continue
+        opportunities += 1
+        if index < next_allowed_index:
+            continue
+
+        #same sizing and allocation check as buy_opportunity
+        half_std_dev = windows[i].std() / 2
+        if half_std_dev == 0:
+            continue
+        qty = round(combination['target_profit'] / half_std_dev)
+        entry_price = float(closes[index])
+        if qty <= 0 or not entry_price * qty < settings['allocated_max']:
+            continue
+
+        exit_index, exit_price, exit_reason = find_exit(bars, index, entry_price, qty, combination['target_profit'], settings['trail_percent'])
+        trades.append((int(bars['t'][exit_index]), (exit_price - entry_price) * qty, exit_reason))
+        #the broker's trailing stop fills during the bar, so that bar's buy check already sees no position
+        #a profit target is taken by sell_positions_over_threshold, which run_tick calls after the strategies, so the buy check of that bar still sees the position
+        if exit_reason == 'trailing_stop':
+            next_allowed_index = exit_index
+        elif exit_reason == 'target_profit':
+            next_allowed_index = exit_index + 1
+        else:
+            next_allowed_index = len(closes)
+
+    return trades, opportunities
+
+
+def get_combination_metrics(trades, opportunities):
+    closed_trades = sorted(trade for trade in trades if trade[2] != 'open')
+    profits = np.array([trade[1] for trade in closed_trades])
+    cumulative_pl = np.cumsum(profits) if len(profits) > 0 else np.zeros(1)
+    drawdowns = np.maximum.accumulate(np.maximum(cumulative_pl, 0.0)) - cumulative_pl
+
+    return {
+        'total_pl': float(profits.sum()),
+        'number_of_trades': len(closed_trades),
+        'win_rate': float((profits > 0).mean()) if len(profits) > 0 else 0.0,
+        'average_pl': float(profits.mean()) if len(profits) > 0 else 0.0,
+        'max_drawdown': float(drawdowns.max()),
+        'trailing_stop_exits': sum(1 for trade in closed_trades if trade[2] == 'trailing_stop'),
+        'unrealized_pl': float(sum(trade[1] for trade in trades if trade[2] == 'open')),
+        'opportunities_found': opportunities,
+    }
+
+
+def evaluate_combinations(shared_bars, combinations, settings, adf_test):
+    #stocks on the outside, so a stock's rolling sums stay cached while every combination of the chunk uses them
+    columns = shared_bars['columns']
+    offsets = shared_bars['offsets']
+    trades = [[] for combination in combinations]
+    opportunities = [0] * len(combinations)
+
+    for row, stock in enumerate(shared_bars['symbols']):
+        bars = {name: columns[name][offsets[row]:offsets[row + 1]] for name in SHARED_COLUMNS}
+        rolling_sums = {}
+        for i, combination in enumerate(combinations):
+            stock_trades, stock_opportunities = simulate_stock(bars, stock, combination, rolling_sums, adf_test, settings)
+            trades[i].extend(stock_trades)
+            opportunities[i] += stock_opportunities
+
+    results = []
+    for i, combination in enumerate(combinations):
+        result = dict(combination)
+        result.update(get_combination_metrics(trades[i], opportunities[i]))
+        results.append(result)
+    return results
+
+
+
+class ParameterSweep():
+
+    def __init__(self, new_bar_directory, new_stock_list, new_allocated_max, new_results_path, new_number_of_processes=1,
+                 new_trail_percent=1.0, new_combinations_per_task=8):
+        self.bar_directory = new_bar_directory
+        self.stock_list = [str(stock) for stock in new_stock_list]
+        self.results_path = new_results_path
+        self.number_of_processes = new_number_of_processes
+        self.combinations_per_task = new_combinations_per_task
+        self.settings = {'allocated_max': float(new_allocated_max), 'trail_percent': float(new_trail_percent), 'adf_cache_size': 1000000}
+
+        self.blocks = {}
+        self.shared_bars = None
+
+
+    def get_grid_combinations(self, grid):
+        #grid maps every parameter name to the list of values to try
+        return [dict(zip(PARAMETER_NAMES, values)) for values in itertools.product(*[grid[name] for name in PARAMETER_NAMES])]
+
+
+    def get_random_combinations(self, choices, number_of_combinations, seed=0):
+        #a fixed seed draws the same combinations again, which is what lets a random search resume
+        rng = random.Random(seed)
+        combinations = []
+        seen = set()
+        for attempt in range(number_of_combinations * 20):
+            if len(combinations) == number_of_combinations:
+                break
+            combination = {name: rng.choice(list(choices[name])) for name in PARAMETER_NAMES}
+            key = self.get_combination_key(combination)
+            if key not in seen:
+                seen.add(key)
+                combinations.append(combination)
+        return combinations
+
+
+    def get_combination_key(self, combination):
+        return tuple(float(combination[name]) for name in PARAMETER_NAMES)
+
+
+    def get_finished_keys(self):
+        if not os.path.exists(self.results_path):
+            return set()
+        finished = pd.read_csv(self.results_path)
+        return {tuple(float(value) for value in values) for values in finished[list(PARAMETER_NAMES)].itertuples(index=False)}
+
+
+    def load_bars(self):
+        #every stock's bars back to back in shared memory, offsets[row] to offsets[row+1] are that stock's bars
+        columns = {name: [] for name in SHARED_COLUMNS}
+        offsets = [0]
+        for stock in self.stock_list:
+            bars = read_bar_files(self.bar_directory, stock)
+            for name in SHARED_COLUMNS:
+                columns[name].append(np.asarray(bars[name]))
+            offsets.append(offsets[-1] + len(bars['t']))
+
+        descriptors = {}
+        for name in SHARED_COLUMNS:
+            dtype = np.int64 if name == 't' else np.float64
+            np_array = np.concatenate(columns[name]).astype(dtype) if offsets[-1] > 0 else np.zeros(0, dtype=dtype)
+            self.blocks[name], descriptors[name] = share_array(np_array)
+
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.descriptors = descriptors
+        self.shared_bars = {'columns': {name: np.ndarray(descriptors[name][1], dtype=descriptors[name][2], buffer=self.blocks[name].buf) for name in SHARED_COLUMNS},
+                            'symbols': self.stock_list, 'offsets': self.offsets}
+
+
+    def release_bars(self):
+        self.shared_bars = None
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+
+    def split_into_tasks(self, combinations):
+        #combinations that share a long window land in the same chunk, so they share its rolling sums and ADF results
+        ordered = sorted(combinations, key=lambda combination: self.get_combination_key(combination))
+        tasks = []
+        for long, group in itertools.groupby(ordered, key=lambda combination: combination['long']):
+            group = list(group)
+            for start in range(0, len(group), self.combinations_per_task):
+                tasks.append(group[start:start + self.combinations_per_task])
+        return tasks
+
+
+    def save_results(self, results):
+        write_header = not os.path.exists(self.results_path)
+        pd.DataFrame(results).to_csv(self.results_path, mode='a', header=write_header, index=False)
+
+
+    def run(self, combinations):
+
+        finished_keys = self.get_finished_keys()
+        remaining = [combination for combination in combinations if self.get_combination_key(combination) not in finished_keys]
+        event_log.info('sweep_started', combinations=len(combinations), already_finished=len(combinations) - len(remaining), remaining=len(remaining),
+                       results_path=self.results_path)
+
+        tasks = self.split_into_tasks(remaining)
+        if len(tasks) > 0:
+            self.load_bars()
+            try:
+                if self.number_of_processes > 1:
+                    self.run_tasks_in_process_pool(tasks)
+                else:
+                    adf_test = FastAdf(new_cache_size=self.settings['adf_cache_size'])
+                    for task_number, task in enumerate(tasks):
+                        self.save_results(evaluate_combinations(self.shared_bars, task, self.settings, adf_test))
+                        event_log.info('sweep_chunk_finished', chunk=task_number + 1, chunks=len(tasks))
+            finally:
+                self.release_bars()
+
+        return self.get_ranked_results()
+
+
+    def run_tasks_in_process_pool(self, tasks):
+        #fork like the StrategyCollector's pool, the bars still reach the workers through shared memory only
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.number_of_processes, mp_context=context, initializer=attach_shared_bars,
+                                                    initargs=(self.descriptors, self.stock_list, self.offsets)) as pool:
+            futures = [pool.submit(run_sweep_task, task, self.settings) for task in tasks]
+            for task_number, future in enumerate(concurrent.futures.as_completed(futures)):
+                #saved as each chunk finishes, so an interruption only loses the chunks still running
+                self.save_results(future.result())
+                event_log.info('sweep_chunk_finished', chunk=task_number + 1, chunks=len(tasks))
+
+
+    def get_ranked_results(self, rank_by='total_pl'):
+        if not os.path.exists(self.results_path):
+            return pd.DataFrame(columns=list(PARAMETER_NAMES))
+        results = pd.read_csv(self.results_path)
+        results = results.sort_values([rank_by, 'max_drawdown'], ascending=[False, True]).reset_index(drop=True)
+        results.index = results.index + 1
+        results.index.name = 'rank'
+        return results
+
+
+    def print_ranked_results(self, number_to_print=20, rank_by='total_pl'):
+        for rank, row in self.get_ranked_results(rank_by).head(number_to_print).iterrows():
+            event_log.info('sweep_result', rank=rank, rank_by=rank_by, **row.to_dict())
@@ -0,0 +1,230 @@
+"""
+    This class stands in for the alpaca REST object and keeps every request the bot makes under the account's per-minute quota.
+
+    Requests take a token from one shared bucket, refilled at requests_per_minute / 60 tokens a second. When the bucket is empty,
+    callers wait in priority order instead of all hitting the broker and getting 429s:
+    orders (submit, cancel, close, order lookups) go first, then account state (positions, open orders, clock), then market data.
+    The last order_reserve tokens are only handed to orders, so a tick that spends its budget on bars still leaves room to trade.
+
+    Identical reads that are in flight at the same time (the same method and arguments from several threads) share one request.
+    A 429 from the broker empties the bucket, since something else is using the same quota.
+    Counters are kept for the whole run and for the current tick (start_tick resets them).
+
+"""
+
+#basic libraries
+import time
+import heapq
+import itertools
+import threading
+
+#algo brokerage api
+from alpaca_trade_api.rest import APIError
+
+
+ORDER_PRIORITY = 0
+ACCOUNT_PRIORITY = 1
+MARKET_DATA_PRIORITY = 2
+
+PRIORITY_NAMES = {ORDER_PRIORITY: 'order', ACCOUNT_PRIORITY: 'account', MARKET_DATA_PRIORITY: 'market_data'}
+
+METHOD_PRIORITIES = {
+    'submit_order': ORDER_PRIORITY,
+    'cancel_order': ORDER_PRIORITY,
+    'cancel_all_orders': ORDER_PRIORITY,
+    'replace_order': ORDER_PRIORITY,
+    'close_position': ORDER_PRIORITY,
+    'close_all_positions': ORDER_PRIORITY,
+    'get_order': ORDER_PRIORITY,
+    'get_order_by_client_order_id': ORDER_PRIORITY,
+    'list_positions': ACCOUNT_PRIORITY,
+    'get_position': ACCOUNT_PRIORITY,
+    'list_orders': ACCOUNT_PRIORITY,
+    'get_account': ACCOUNT_PRIORITY,
+    'get_clock': ACCOUNT_PRIORITY,
+    'get_account_configurations': ACCOUNT_PRIORITY,
+    'update_account_configurations': ACCOUNT_PRIORITY,
+}
+
+
+def get_method_priority(method):
+    return METHOD_PRIORITIES.get(method, MARKET_DATA_PRIORITY)
+
+
+def is_read_method(method):
+    return method.startswith('get_') or method.startswith('list_')
+
+
+
+class InFlightRead():
+
+    #the first caller makes the request, the others wait on done and read its result
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+
+class RateLimitGovernor():
+
+    def __init__(self, new_trade_api_rest, new_requests_per_minute=200, new_burst=None, new_order_reserve=10, new_monotonic_function=time.monotonic):
+        self.rest = new_trade_api_rest
+        self.requests_per_minute = new_requests_per_minute
+        self.capacity = float(new_burst if new_burst is not None else new_requests_per_minute)
+        self.refill_per_second = new_requests_per_minute / 60.0
+        self.order_reserve = min(new_order_reserve, self.capacity - 1)
+        self.monotonic = new_monotonic_function
+
+        self.tokens = self.capacity
+        self.last_refill = self.monotonic()
+        self.condition = threading.Condition()
+        self.waiting_tickets = []
+        self.ticket_numbers = itertools.count()
+
+        self.in_flight_reads = {}
+        self.in_flight_lock = threading.Lock()
+
+        self.counter_lock = threading.Lock()
+        self.total_counters = self.get_empty_counters()
+        self.tick_counters = self.get_empty_counters()
+        self.tick_started = self.monotonic()
+
+
+    def get_empty_counters(self):
+        counters = {'requests': 0, 'coalesced': 0, 'waits': 0, 'wait_seconds': 0.0, 'rate_limited': 0}
+        for name in PRIORITY_NAMES.values():
+            counters['requests_' + name] = 0
+            counters['wait_seconds_' + name] = 0.0
+        return counters
+
+
+    def count(self, name, amount=1):
+        with self.counter_lock:
+            self.total_counters[name] += amount
+            self.tick_counters[name] += amount
+
+
+    #----- token bucket -----
+
+    def refill(self):
+        now = self.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_per_second)
+        self.last_refill = now
+
+
+    def acquire(self, priority):
+        started = self.monotonic()
+        waited = False
+        with self.condition:
+            ticket = (priority, next(self.ticket_numbers))
+            heapq.heappush(self.waiting_tickets, ticket)
+            #only orders may dip into the reserve
+            floor = 0.0 if priority == ORDER_PRIORITY else self.order_reserve
+
+            while True:
+                self.refill()
+                is_first = self.waiting_tickets[0] == ticket
+                if is_first and self.tokens - floor >= 1.0:
+                    heapq.heappop(self.waiting_tickets)
+                    self.tokens -= 1.0
+                    break
+                waited = True
+                #the first ticket sleeps until its token has dripped in, the rest until the first one takes its token
+                timeout = max(0.001, (floor + 1.0 - self.tokens) / self.refill_per_second) if is_first else None
+                self.condition.wait(timeout)
+
+            self.condition.notify_all()
+
+        name = PRIORITY_NAMES[priority]
+        self.count('requests')
+        self.count('requests_' + name)
+        if waited:
+            wait_seconds = self.monotonic() - started
+            self.count('waits')
+            self.count('wait_seconds', wait_seconds)
+            self.count('wait_seconds_' + name, wait_seconds)
+
+
+    def drain(self):
+        with self.condition:
+            self.refill()
+            self.tokens = 0.0
+
+
+    #----- calls -----
+
+    def call(self, method, *args, **kwargs):
+        if not is_read_method(method):
+            return self.request(method, args, kwargs)
+
+        key = (method, repr(args), repr(sorted(kwargs.items())))
+        with self.in_flight_lock:
+            in_flight = self.in_flight_reads.get(key)
+            if in_flight is None:
+                in_flight = self.in_flight_reads[key] = InFlightRead()
+                is_owner = True
+            else:
+                in_flight.waiters += 1
+                is_owner = False
+
+        if not is_owner:
+            self.count('coalesced')
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+
+        try:
+            in_flight.result = self.request(method, args, kwargs)
+            return in_flight.result
+        except Exception as error:
+            in_flight.error = error
+            raise
+        finally:
+            with self.in_flight_lock:
+                self.in_flight_reads.pop(key, None)
+            in_flight.done.set()
+
+
+    def request(self, method, args, kwargs):
+        self.acquire(get_method_priority(method))
+        try:
+            return getattr(self.rest, method)(*args, **kwargs)
+        except APIError as error:
+            if error.status_code == 429 or error.code == 42910000:
+                self.count('rate_limited')
+                self.drain()
+            raise
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self.rest, name)
+        if not callable(attribute):
+            return attribute
+
+        def governed(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+
+        #cached on the instance, so the next call skips __getattr__
+        self.__dict__[name] = governed
+        return governed
+
+
+    #----- budget reporting -----
+
+    def start_tick(self):
+        self.tick_counters = self.get_empty_counters()
+        self.tick_started = self.monotonic()
+
+
+    def get_tick_counters(self):
+        counters = dict(self.tick_counters)
+        with self.condition:
+            self.refill()
+            counters['tokens_left'] = self.tokens
+        #the share of the per-minute quota this tick used, over 1.0 means the tick could not have run every minute at this rate
+        counters['budget_used'] = counters['requests'] / self.requests_per_minute
+        counters['seconds'] = self.monotonic() - self.tick_started
+        return counters
@@ -0,0 +1,222 @@
+"""
+    This class keeps the long and short simple moving averages, their slopes and the crossing flag for one stock
+    and updates them in O(1) every time a new minute bar arrives, instead of rebuilding a DataFrame over the whole window.
+
+    The running sums follow the same Kahan summation steps as pandas' rolling mean, so fed the same bars it gives the
+    same values as check_mean_reversion_of_long_and_short_sma_and_sma_slopes in BasicStrategy.
+    Continuing the running sums across windows can round the last digit differently than summing a fresh window does,
+    so when a comparison lands within rounding distance of its threshold the indicator is reseeded from the window.
+    That keeps the decisions identical while almost every update stays O(1).
+    history_length mimics the fixed size window that function is given (long_duration+2 bars in StrategyBuyFiveMinuteSpikes),
+    a moving average or slope that would not fit inside that window is reported as nan, just like pandas would.
+
+"""
+
+#basic libraries
+import math
+import numpy as np
+
+
+class RollingMean():
+
+    __slots__ = ('window', 'nobs', 'sum_x', 'neg_ct', 'compensation_add', 'compensation_remove',
+                 'num_consecutive_same_value', 'prev_value')
+
+    def __init__(self, new_window):
+        self.window = new_window
+        self.reset()
+
+
+    def reset(self):
+        self.nobs = 0
+        self.sum_x = 0.0
+        self.neg_ct = 0
+        self.compensation_add = 0.0
+        self.compensation_remove = 0.0
+        self.num_consecutive_same_value = 0
+        self.prev_value = math.nan
+
+
+    def add(self, val):
+        #same steps as add_mean in pandas/_libs/window/aggregations.pyx
+        if val == val:
+            self.nobs += 1
+            y = val - self.compensation_add
+            t = self.sum_x + y
+            self.compensation_add = t - self.sum_x - y
+            self.sum_x = t
+            if math.copysign(1.0, val) < 0:
+                self.neg_ct += 1
+
+            #pandas counts repeated values to return them exactly instead of a sum with floating point artifacts
+            if val == self.prev_value:
+                self.num_consecutive_same_value += 1
+            else:
+                self.num_consecutive_same_value = 1
+            self.prev_value = val
+
+
+    def remove(self, val):
+        if val == val:
+            self.nobs -= 1
+            y = - val - self.compensation_remove
+            t = self.sum_x + y
+            self.compensation_remove = t - self.sum_x - y
+            self.sum_x = t
+            if math.copysign(1.0, val) < 0:
+                self.neg_ct -= 1
+
+
+    def mean(self):
+        if self.nobs >= self.window and self.nobs > 0:
+            result = self.sum_x / self.nobs
+            if self.num_consecutive_same_value >= self.nobs:
+                result = self.prev_value
+            elif self.neg_ct == 0 and result < 0:
+                result = 0.0
+            elif self.neg_ct == self.nobs and result > 0:
+                result = 0.0
+            return result
+        return math.nan
+
+
+
+class RollingSmaIndicator():
+
+    def __init__(self, new_long, new_short, new_t, new_history_length=None):
+        self.long_duration = new_long
+        self.short_duration = new_short
+        self.delta_t = new_t
+        self.history_length = new_history_length
+
+        #ring buffer of the last closes, big enough to know which value leaves each window
+        self.close_ring = np.zeros(max(new_long, new_short))
+
+        #ring buffers of the last delta_t+1 averages, used for the previous values and the diff(delta_t) slopes
+        self.sma_long_ring = np.zeros(new_t + 1)
+        self.sma_short_ring = np.zeros(new_t + 1)
+
+        self.long_mean = RollingMean(new_long)
+        self.short_mean = RollingMean(new_short)
+
+        self.reset()
+
+
+    def reset(self):
+        self.number_of_bars = 0
+        self.last_timestamp = None
+        self.long_mean.reset()
+        self.short_mean.reset()
+        self.close_ring.fill(np.nan)
+        self.sma_long_ring.fill(np.nan)
+        self.sma_short_ring.fill(np.nan)
+
+
+    def update(self, close_price):
+
+        ring_size = self.close_ring.shape[0]
+        position = self.number_of_bars % ring_size
+
+        #drop the closes leaving each window before adding the new one, in the same order pandas does
+        if self.number_of_bars >= self.long_duration:
+            self.long_mean.remove(self.close_ring[(self.number_of_bars - self.long_duration) % ring_size])
+        if self.number_of_bars >= self.short_duration:
+            self.short_mean.remove(self.close_ring[(self.number_of_bars - self.short_duration) % ring_size])
+
+        close_price = float(close_price)
+        self.close_ring[position] = close_price
+        self.long_mean.add(close_price)
+        self.short_mean.add(close_price)
+
+        sma_position = self.number_of_bars % self.sma_long_ring.shape[0]
+        self.sma_long_ring[sma_position] = self.long_mean.mean()
+        self.sma_short_ring[sma_position] = self.short_mean.mean()
+
+        self.number_of_bars += 1
+
+
+    def seed(self, close_price_np_array, timestamp_np_array=None):
+        self.reset()
+        for close_price in close_price_np_array:
+            self.update(close_price)
+        if timestamp_np_array is not None and len(timestamp_np_array) > 0:
+            self.last_timestamp = int(timestamp_np_array[-1])
+
+
+    def update_from_window(self, close_price_np_array, timestamp_np_array=None):
+        #feeds only the bars newer than the last one seen, reseeds when it can't tell which bars are new
+        if timestamp_np_array is None or self.last_timestamp is None or len(timestamp_np_array) == 0:
+            self.seed(close_price_np_array, timestamp_np_array)
+            return
+
+        if int(timestamp_np_array[-1]) == self.last_timestamp:
+            return
+
+        new_bars_start = int(np.searchsorted(timestamp_np_array, self.last_timestamp, side='right'))
+        if new_bars_start == 0 or int(timestamp_np_array[new_bars_start - 1]) != self.last_timestamp:
+            #the last bar we saw has fallen out of the window, too many bars are missing to continue
+            self.seed(close_price_np_array, timestamp_np_array)
+            return
+
+        for close_price in close_price_np_array[new_bars_start:]:
+            self.update(close_price)
+        self.last_timestamp = int(timestamp_np_array[-1])
+
+
+    def get_sma(self, sma_ring, window, lag):
+        #value of the moving average lag bars ago, or nan if it would not fit in the window the old function was given
+        bars_available = self.number_of_bars
+        if self.history_length is not None:
+            bars_available = min(bars_available, self.history_length)
+        if lag >= sma_ring.shape[0] or bars_available - lag < window:
+            return math.nan
+        return sma_ring[(self.number_of_bars - 1 - lag) % sma_ring.shape[0]]
+
+
+    def get_sma_long(self, lag=0):
+        return self.get_sma(self.sma_long_ring, self.long_duration, lag)
+
+
+    def get_sma_short(self, lag=0):
+        return self.get_sma(self.sma_short_ring, self.short_duration, lag)
+
+
+    def get_short_slope(self):
+        return (self.get_sma_short() - self.get_sma_short(self.delta_t)) / self.delta_t
+
+
+    def get_long_slope(self):
+        return (self.get_sma_long() - self.get_sma_long(self.delta_t)) / self.delta_t
+
+
+    def get_slope_difference(self):
+        return self.get_short_slope() - self.get_long_slope()
+
+
+    def is_crossing_buy(self):
+        #comparisons with nan are False, the same as the pandas version
+        return (self.get_sma_short() > self.get_sma_long()) and (self.get_sma_short(1) <= self.get_sma_long(1))
+
+
+    def is_crossing_buy_with_slopes(self, new_slope_min, new_slope_diff_min):
+        return self.is_crossing_buy() and self.get_short_slope() > new_slope_min and self.get_slope_difference() > new_slope_diff_min
+
+
+    def is_close_to_a_decision_boundary(self, new_slope_min, new_slope_diff_min):
+        scale = max(abs(self.get_sma_long()), 1.0)
+        comparisons = ((self.get_sma_short(), self.get_sma_long()),
+                       (self.get_sma_short(1), self.get_sma_long(1)),
+                       (self.get_short_slope(), new_slope_min),
+                       (self.get_slope_difference(), new_slope_diff_min))
+        for left, right in comparisons:
+            #nan comparisons are False, so missing values never count as close
+            if abs(left - right) <= 1e-9 * scale:
+                return True
+        return False
+
+
+    def check_crossing_buy_with_slopes(self, close_price_np_array, timestamp_np_array, new_slope_min, new_slope_diff_min):
+        self.update_from_window(close_price_np_array, timestamp_np_array)
+        if self.is_close_to_a_decision_boundary(new_slope_min, new_slope_diff_min):
+            self.seed(close_price_np_array, timestamp_np_array)
+        return self.is_crossing_buy_with_slopes(new_slope_min, new_slope_diff_min)
@@ -0,0 +1,393 @@
+"""
+    These classes record a live session's broker traffic and play it back, so a session that misbehaved can be run again exactly as it happened.
+
+    SessionRecorder stands in for the alpaca REST object. Every call made through it (clock, bars, positions, orders, account, ...) is passed on
+    and then appended to a gzip compressed log, one JSON line per call: the method and its arguments, the response as alpaca's raw json
+    (or the error), the wall time, the monotonic time and how long the call took. Lines are flushed as they are written, so a crash loses nothing
+    already answered, and opening the same path again appends a new gzip member the reader reads straight through.
+
+    SessionReplay reads the log and stands in for the REST object of an unmodified StrategyCollector and strategies.
+    A read is answered with the recorded response of the same call (the same method and arguments) that is due by the replay's clock;
+    a write (submit, cancel, close, ...) takes the next recorded one with the same arguments. attach() gives the collector's scheduler and
+    account ledger the replay's clock: the scheduler's waits between bar closes only move that clock forward, instead of sleeping,
+    so a session replays as fast as the strategies can run (or speed times faster than it was recorded, with a speed).
+    Client order ids carry the time the strategies were created, so the replay's ids are mapped to the recorded ones as its orders come in.
+
+    get_order_report() compares the orders the replay submitted with the recorded ones. A call the log has no answer for is a divergence:
+    it is raised as ReplayDivergence, listed in the report, and once the replay's clock is past the last recorded call it ends the replay instead.
+    A BarStore asks for bars by the wall clock and by what is on disk, and a BarStream is not driven by this clock, replay the polling loop without them.
+
+"""
+
+#basic libraries
+import gzip
+import json
+import time
+import builtins
+import itertools
+import threading
+import collections
+import requests
+
+#algo brokerage api
+import alpaca_trade_api.entity
+from alpaca_trade_api.rest import APIError
+
+from EventLog import EventLog, get_json_value
+
+
+event_log = EventLog('session')
+
+#calls that change the account, each recorded one is replayed once and in order
+WRITE_METHODS = ('submit_order', 'cancel_order', 'cancel_all_orders', 'replace_order', 'close_position', 'close_all_positions',
+                 'update_account_configurations')
+
+#the order fields compared between the recording and the replay, client_order_id is left out, it carries the time the strategy was made
+ORDER_FIELDS = ('symbol', 'qty', 'side', 'type', 'time_in_force', 'limit_price', 'stop_price', 'trail_price', 'trail_percent', 'order_class')
+
+
+def encode_response(value, raw_converters):
+    #alpaca's raw json for entities, a stand-in object (a SimulatedOrder, say) is turned into raw json by its converter
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {'value': value}
+    if isinstance(value, (list, tuple)):
+        return {'list': [encode_response(item, raw_converters) for item in value]}
+    converter = raw_converters.get(type(value).__name__)
+    if converter is not None:
+        entity_name, to_raw = converter
+        return {'entity': entity_name, 'raw': to_raw(value)}
+    if hasattr(value, '_raw'):
+        return {'entity': type(value).__name__, 'raw': value._raw}
+    return {'repr': repr(value)}
+
+
+def decode_response(encoded):
+    if 'value' in encoded:
+        return encoded['value']
+    if 'list' in encoded:
+        return [decode_response(item) for item in encoded['list']]
+    if 'entity' in encoded:
+        return getattr(alpaca_trade_api.entity, encoded['entity'])(encoded['raw'])
+    return encoded['repr']
+
+
+def encode_error(error):
+    if isinstance(error, APIError):
+        return {'api_error': {'code': error.code, 'message': str(error)}, 'status_code': error.status_code}
+    return {'exception': type(error).__name__, 'message': str(error)}
+
+
+def decode_error(encoded):
+    if 'api_error' in encoded:
+        return APIError(encoded['api_error'])
+    #connection errors and timeouts come back as themselves, OrderPipeline retries those
+    error_class = getattr(requests.exceptions, encoded['exception'], None) or getattr(builtins, encoded['exception'], None)
+    if not (isinstance(error_class, type) and issubclass(error_class, Exception)):
+        error_class = RuntimeError
+    return error_class(encoded['message'])
+
+
+def read_session_log(path):
+    #every record, the session headers included, in the order they were written
+    with gzip.open(path, 'rt') as log_file:
+        return [json.loads(line) for line in log_file if line.strip()]
+
+
+def get_order_key(arguments):
+    #the recorded submit_order arguments that decide what the order is
+    return tuple((field, str(arguments[field])) for field in ORDER_FIELDS if arguments.get(field) is not None)
+
+
+
+class ReplayDivergence(Exception):
+    pass
+
+
+
+class ReplayFinished(Exception):
+    pass
+
+
+
+class SessionRecorder():
+
+    def __init__(self, new_trade_api_rest, new_path, new_raw_converters=None, new_monotonic_function=time.monotonic, new_compress_level=6):
+        self.rest = new_trade_api_rest
+        self.path = new_path
+        #{type name: (alpaca entity name, function returning raw json)} for REST stand-ins that don't return alpaca entities
+        self.raw_converters = new_raw_converters if new_raw_converters is not None else {}
+        self.monotonic = new_monotonic_function
+
+        self.lock = threading.Lock()
+        self.sequence_numbers = itertools.count()
+        self.records_written = 0
+        self.log_file = gzip.open(new_path, 'at', compresslevel=new_compress_level)
+        self.write({'session': 'started', 't': time.time(), 'm': self.monotonic()})
+
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':'), default=get_json_value)
+        with self.lock:
+            self.log_file.write(line + '\n')
+            #a sync flush, what is written survives a crash
+            self.log_file.flush()
+            self.records_written += 1
+
+
+    def call(self, method, *args, **kwargs):
+        record = {'sequence': next(self.sequence_numbers), 'method': method, 'args': list(args), 'kwargs': kwargs, 't': time.time(), 'm': self.monotonic()}
+        started = time.perf_counter()
+        try:
+            result = getattr(self.rest, method)(*args, **kwargs)
+        except Exception as error:
+            record['seconds'] = time.perf_counter() - started
+            record['error'] = encode_error(error)
+            self.write(record)
+            raise
+        record['seconds'] = time.perf_counter() - started
+        record['result'] = encode_response(result, self.raw_converters)
+        self.write(record)
+        return result
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self.rest, name)
+        if not callable(attribute):
+            return attribute
+
+        def recorded(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+
+        #cached on the instance, so the next call skips __getattr__
+        self.__dict__[name] = recorded
+        return recorded
+
+
+    def close(self):
+        with self.lock:
+            if self.log_file is None:
+                return
+        self.write({'session': 'stopped', 't': time.time(), 'm': self.monotonic()})
+        with self.lock:
+            self.log_file.close()
+            self.log_file = None
+        event_log.info('session_recorded', path=self.path, records=self.records_written)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+
+class SessionReplay():
+
+    def __init__(self, new_path, new_speed=None, new_tolerance_seconds=1.0):
+        self.path = new_path
+        #None replays as fast as the strategies run, a number paces the waits to that many times real time
+        self.speed = new_speed
+        #a recorded read this close to the replay's clock is from the same tick, the live calls of a tick are spread over its run time
+        self.tolerance_seconds = new_tolerance_seconds
+
+        records = read_session_log(new_path)
+        self.calls = [record for record in records if 'method' in record]
+        self.first_recorded_time = self.calls[0]['m'] if self.calls else 0.0
+        self.last_recorded_time = self.calls[-1]['m'] if self.calls else 0.0
+
+        #recorded calls by (method, arguments), a read's list is walked with a cursor, a write's is used up
+        self.calls_by_key = collections.defaultdict(list)
+        for call in self.calls:
+            self.calls_by_key[self.get_call_key(call['method'], call['args'], call['kwargs'])].append(call)
+        self.cursors = collections.defaultdict(int)
+
+        #the replay's clock starts at the local monotonic time, so anything made before attach() (the collector's first account fetch) agrees with it
+        self.offset = time.monotonic() - self.first_recorded_time
+        self.now = time.monotonic()
+        self.lock = threading.RLock()
+
+        #replayed client order id -> recorded one, and back
+        self.recorded_client_order_ids = {}
+        self.replayed_client_order_ids = {}
+
+        self.replayed_orders = []
+        self.divergences = []
+        self.calls_replayed = 0
+        self.reads_reused = 0
+        self.finished = False
+
+
+    #----- clock -----
+
+    def monotonic(self):
+        with self.lock:
+            return self.now
+
+
+    def sleep(self, seconds):
+        #the wait is skipped, only the replay's clock moves on
+        with self.lock:
+            self.now += max(0.0, seconds)
+        if self.speed is not None and seconds > 0:
+            time.sleep(seconds / self.speed)
+
+
+    def attach(self, collector):
+        #the collector and its helpers read this clock instead of the local one, nothing else about them changes
+        collector.scheduler.monotonic = self.monotonic
+        collector.scheduler.sleep = self.sleep
+        collector.account_ledger.monotonic = self.monotonic
+        if collector.universe_screener is not None:
+            collector.universe_screener.monotonic = self.monotonic
+        if collector.order_pipeline is not None:
+            collector.order_pipeline.sleep = self.sleep
+        return collector
+
+
+    #----- matching -----
+
+    def get_call_key(self, method, args, kwargs):
+        #a submit_order is matched without its client order id, the ids of the two runs never agree
+        if method == 'submit_order':
+            kwargs = {name: value for name, value in kwargs.items() if name != 'client_order_id'}
+        return method + json.dumps([args, sorted(kwargs.items())], separators=(',', ':'), default=get_json_value)
+
+
+    def translate_arguments(self, args, kwargs):
+        #a replayed client order id is asked for by its recorded id
+        args = [self.recorded_client_order_ids.get(value, value) if isinstance(value, str) else value for value in args]
+        kwargs = {name: self.recorded_client_order_ids.get(value, value) if isinstance(value, str) else value for name, value in kwargs.items()}
+        return args, kwargs
+
+
+    def translate_response(self, encoded):
+        #and the recorded ids in responses are handed back as the replay's
+        if 'list' in encoded:
+            return {'list': [self.translate_response(item) for item in encoded['list']]}
+        if 'raw' in encoded and isinstance(encoded['raw'], dict):
+            raw = dict(encoded['raw'])
+            if raw.get('client_order_id') in self.replayed_client_order_ids:
+                raw['client_order_id'] = self.replayed_client_order_ids[raw['client_order_id']]
+            if isinstance(raw.get('legs'), list):
+                raw['legs'] = [self.translate_response({'raw': leg})['raw'] for leg in raw['legs']]
+            return dict(encoded, raw=raw)
+        return encoded
+
+
+    def find_recorded_call(self, method, key):
+        calls = self.calls_by_key.get(key)
+        if not calls:
+            return None
+        cursor = self.cursors[key]
+
+        if method in WRITE_METHODS:
+            if cursor >= len(calls):
+                return None
+            self.cursors[key] = cursor + 1
+            return calls[cursor]
+
+        if cursor >= len(calls):
+            #asked for more often than in the recording, the state it read hasn't changed since the last answer
+            self.reads_reused += 1
+            return calls[-1]
+        #answers from before this tick are passed over while a newer one is due, the replay asked for them less often than the recording
+        while (cursor + 1 < len(calls) and calls[cursor]['m'] + self.offset < self.now - self.tolerance_seconds and
+               calls[cursor + 1]['m'] + self.offset <= self.now):
+            cursor += 1
+        #an answer from well after now belongs to a later tick, the last one is still the state as of now
+        if cursor > 0 and calls[cursor]['m'] + self.offset > self.now + self.tolerance_seconds:
+            self.cursors[key] = cursor
+            self.reads_reused += 1
+            return calls[cursor - 1]
+        self.cursors[key] = cursor + 1
+        return calls[cursor]
+
+
+    def call(self, method, *args, **kwargs):
+        with self.lock:
+            args, kwargs = self.translate_arguments(list(args), dict(kwargs))
+            recorded = self.find_recorded_call(method, self.get_call_key(method, args, kwargs))
+
+            if recorded is None:
+                if self.now >= self.last_recorded_time + self.offset:
+                    self.finished = True
+                    raise ReplayFinished(f'the recording ends before this {method} call')
+                divergence = {'method': method, 'args': args, 'kwargs': kwargs, 'seconds': self.now - self.offset - self.first_recorded_time}
+                self.divergences.append(divergence)
+                event_log.warning('replay_divergence', **divergence)
+                raise ReplayDivergence(f'{method} with these arguments was not recorded: {args} {kwargs}')
+
+            #the call happened at least this late in the recording
+            self.now = max(self.now, recorded['m'] + self.offset)
+            self.calls_replayed += 1
+
+            if method == 'submit_order':
+                recorded_client_order_id = recorded['kwargs'].get('client_order_id')
+                replayed_client_order_id = kwargs.get('client_order_id')
+                if recorded_client_order_id is not None and replayed_client_order_id is not None:
+                    self.recorded_client_order_ids[replayed_client_order_id] = recorded_client_order_id
+                    self.replayed_client_order_ids[recorded_client_order_id] = replayed_client_order_id
+                self.replayed_orders.append(dict(kwargs, symbol=args[0] if args else kwargs.get('symbol')))
+
+        if 'error' in recorded:
+            raise decode_error(recorded['error'])
+        return decode_response(self.translate_response(recorded['result']))
+
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def replayed(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+
+        self.__dict__[name] = replayed
+        return replayed
+
+
+    #----- checking -----
+
+    def get_recorded_orders(self):
+        return [dict(call['kwargs'], symbol=call['args'][0] if call['args'] else call['kwargs'].get('symbol')) for call in self.calls if call['method'] == 'submit_order']
+
+
+    def get_order_report(self):
+        recorded_keys = [get_order_key(order) for order in self.get_recorded_orders()]
+        replayed_keys = [get_order_key(order) for order in self.replayed_orders]
+        #orders placed on the OrderPipeline's threads can come in another order, the same orders in any order still match
+        missing = collections.Counter(recorded_keys) - collections.Counter(replayed_keys)
+        extra = collections.Counter(replayed_keys) - collections.Counter(recorded_keys)
+        return {
+            'recorded_orders': len(recorded_keys),
+            'replayed_orders': len(replayed_keys),
+            'same_orders': len(missing) == 0 and len(extra) == 0,
+            'same_order_sequence': recorded_keys == replayed_keys,
+            'missing_orders': [dict(key) for key in missing.elements()],
+            'extra_orders': [dict(key) for key in extra.elements()],
+            'divergences': list(self.divergences),
+            'calls_recorded': len(self.calls),
+            'calls_replayed': self.calls_replayed,
+            'reads_reused': self.reads_reused,
+            'reached_end_of_recording': self.finished,
+        }
+
+
+def replay_session(path, build_collector, new_speed=None):
+    #build_collector(trade_api_rest) makes the StrategyCollector and appends its strategies, the same way the recorded session did
+    replay = SessionReplay(path, new_speed)
+    collector = replay.attach(build_collector(replay))
+    started = time.perf_counter()
+    try:
+        collector.run_strat_collector()
+    except (ReplayFinished, ReplayDivergence):
+        #the replay stops at the first call the recording can't answer, the report says which
+        collector.close_process_pool()
+        collector.close_order_pipeline()
+
+    report = replay.get_order_report()
+    report['replay_seconds'] = time.perf_counter() - started
+    report['recorded_seconds'] = replay.last_recorded_time - replay.first_recorded_time
+    event_log.info('session_replayed', path=path, **{name: value for name, value in report.items() if not isinstance(value, list)})
+    return report
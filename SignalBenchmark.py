@@ -0,0 +1,246 @@
+"""
+    This benchmark times BasicStrategy's signal math on made-up minute bars, so a pandas or statsmodels upgrade, or a change to the strategies,
+    that slows a tick down shows up as a failed run instead of as late orders.
+
+    get_synthetic_minute_bars() makes the same bars for the same seed: a random walk per stock, spikes that climb for a few minutes
+    and fall back (the moves StrategyBuyFiveMinuteSpikes looks for) and a few zero prices like the bad prints the clean check throws out.
+    Each case times one pass over every stock: is_historical_data_clean, augmented_dickey_fuller_test_on_list,
+    check_mean_reversion_of_long_and_short_sma and check_mean_reversion_of_long_and_short_sma_and_sma_slopes are called once per stock,
+    and a StrategyBuyFiveMinuteSpikes.run_strategy pass runs against a FakeAlpacaRest serving the bars (its long SMA is the window minus 2 bars).
+    Every case runs at each window length and stock count, and the fastest of a few repeats is kept, it is the least disturbed by the rest of the machine.
+    A run_strategy repeat starts from a new FakeAlpacaRest and a strategy that has seen one minute, so every repeat times the same minute.
+
+    The timings are compared against SignalBenchmarkBaselines.json. A case more than threshold slower than its baseline (and slower by more than
+    min_regression_seconds, so sub-millisecond noise doesn't count) fails the run. The default threshold fails a case that takes twice its baseline,
+    a shared machine can be 50% off from one run to the next.
+    Run this file directly to check against the baselines, with --update-baselines to store this machine's timings as the new ones.
+
+"""
+
+#basic libraries
+import os
+import sys
+import json
+import time
+import platform
+import numpy as np
+import pandas as pd
+import statsmodels
+
+from BasicStrategy import BasicStrategy
+from StrategyBuyFiveMinuteSpikes import StrategyBuyFiveMinuteSpikes
+from FakeAlpaca import FakeAlpacaRest
+from CollectorBenchmark import get_symbols
+from EventLog import configure_event_log, stop_event_log
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SignalBenchmarkBaselines.json')
+
+SIGNAL_FUNCTIONS = ('is_historical_data_clean', 'augmented_dickey_fuller_test_on_list', 'check_mean_reversion_of_long_and_short_sma',
+                    'check_mean_reversion_of_long_and_short_sma_and_sma_slopes', 'run_strategy')
+
+#the strategy settings AlgoTradingBot trades with, the long SMA follows the window
+SHORT_DURATION = 5
+SLOPE_DURATION = 2
+
+
+def get_synthetic_minute_bars(number_of_symbols, number_of_minutes, seed=0, volatility=0.002, spike_rate=0.004, spike_size=0.03, spike_minutes=5,
+                              zero_rate=0.0005):
+    #o, h, l, c and v matrices, one row per stock, the same for the same arguments
+    rng = np.random.default_rng(seed)
+    shape = (number_of_symbols, number_of_minutes)
+    log_prices = np.log(rng.uniform(5.0, 500.0, number_of_symbols))[:, None] + np.cumsum(rng.normal(0.0, volatility, shape), axis=1)
+
+    #a spike climbs for spike_minutes and falls back over the same time, most go up like the ones the strategy buys
+    spike_starts = (rng.random(shape) < spike_rate) * rng.choice((1.0, -1.0), shape, p=(0.8, 0.2)) * rng.uniform(0.5, 1.5, shape)
+    kernel = spike_size * np.r_[np.linspace(0.0, 1.0, spike_minutes + 1)[1:], np.linspace(1.0, 0.0, spike_minutes + 1)[1:]]
+    for offset, height in enumerate(kernel):
+        log_prices[:, offset:] += spike_starts[:, :number_of_minutes - offset] * height
+
+    closes = np.round(np.exp(log_prices), 2)
+    opens = np.concatenate((closes[:, :1], closes[:, :-1]), axis=1)
+    wicks = np.abs(rng.normal(0.0, volatility / 2, shape))
+    bars = {
+        'o': opens,
+        'h': np.round(np.maximum(opens, closes) * (1 + wicks), 2),
+        'l': np.round(np.minimum(opens, closes) * (1 - wicks), 2),
+        'c': closes,
+        'v': rng.integers(100, 10000, shape).astype(float),
+    }
+
+    #bad prints, the whole bar reads zero
+    glitches = rng.random(shape) < zero_rate
+    for name in ('o', 'h', 'l', 'c'):
+        bars[name][glitches] = 0.0
+    return bars
+
+
+def build_fake_rest(symbols, seed=0):
+    #a FakeAlpacaRest whose random walk is replaced by the spiky bars, the broker fills against them too
+    fake = FakeAlpacaRest(symbols, new_starting_cash=1e9, new_seed=seed)
+    bars = get_synthetic_minute_bars(len(symbols), len(fake.bars.timeline), seed)
+    fake.bars.columns = bars
+    #bars made past the end continue from the last price that isn't a glitch
+    fake.bars.last_closes = np.array([row[row > 0][-1] for row in bars['c']])
+    fake.update_broker_bars()
+    return fake
+
+
+def get_timestamps(number_of_minutes):
+    return 1609770600 + 60 * np.arange(number_of_minutes, dtype=np.int64)
+
+
+def time_best_of(function, number_of_repeats, min_seconds=0.5, setup=None):
+    #the fastest repeat, function is called once untimed first so imports and caches are warm
+    #fast cases repeat until min_seconds have been spent, a few tries are not enough to get one past the machine's noise
+    #with setup, every repeat times the function setup() returns, so each one starts from the same state
+    get_function = setup if setup is not None else (lambda: function)
+    get_function()()
+    best = np.inf
+    repeats = 0
+    spent = 0.0
+    while repeats < number_of_repeats or spent < min_seconds:
+        timed_function = get_function()
+        started = time.perf_counter()
+        timed_function()
+        seconds = time.perf_counter() - started
+        best = min(best, seconds)
+        spent += seconds
+        repeats += 1
+    return best
+
+
+def time_signal_function(function_name, number_of_symbols, window, number_of_repeats=3, seed=0):
+    #seconds for one pass of function_name over number_of_symbols stocks with window minute bars each
+    symbols = get_symbols(number_of_symbols)
+    long_duration = window - 2
+
+    if function_name == 'run_strategy':
+        def setup():
+            #a strategy that has already run a minute, timed on the next one, the same minute every repeat
+            fake = build_fake_rest(symbols, seed)
+            strat = StrategyBuyFiveMinuteSpikes('Signal benchmark', fake, symbols, 1e9, long_duration, SHORT_DURATION, SLOPE_DURATION, 0.0, 0.0, 5.0)
+            strat.run_strategy()
+            fake.advance_minute()
+            strat.clear_ohlcv_cache()
+            return strat.run_strategy
+        return time_best_of(None, number_of_repeats, setup=setup)
+
+    closes = get_synthetic_minute_bars(number_of_symbols, window, seed)['c']
+    timestamps = get_timestamps(window)
+    strat = BasicStrategy('Signal benchmark', None, symbols, 1e9)
+
+    if function_name == 'is_historical_data_clean':
+        def run_pass():
+            for row in closes:
+                strat.is_historical_data_clean(row)
+    elif function_name == 'augmented_dickey_fuller_test_on_list':
+        #statsmodels on every stock, the zero rows too, without the shared FastAdf's cache
+        def run_pass():
+            for symbol, row in zip(symbols, closes):
+                strat.augmented_dickey_fuller_test_on_list(row, symbol, int(timestamps[-1]))
+    elif function_name == 'check_mean_reversion_of_long_and_short_sma':
+        def run_pass():
+            for row in closes:
+                strat.check_mean_reversion_of_long_and_short_sma(row, long_duration, SHORT_DURATION)
+    elif function_name == 'check_mean_reversion_of_long_and_short_sma_and_sma_slopes':
+        def run_pass():
+            for row in closes:
+                strat.check_mean_reversion_of_long_and_short_sma_and_sma_slopes(row, long_duration, SHORT_DURATION, SLOPE_DURATION, 0.0, 0.0)
+    else:
+        raise ValueError(f'no benchmark for {function_name}, the functions are {", ".join(SIGNAL_FUNCTIONS)}')
+
+    return time_best_of(run_pass, number_of_repeats)
+
+
+def get_case_name(function_name, number_of_symbols, window):
+    return f'{function_name}/symbols={number_of_symbols}/window={window}'
+
+
+def run_benchmark_suite(function_names=SIGNAL_FUNCTIONS, symbol_counts=(10, 100), windows=(30, 60, 120), number_of_repeats=3, seed=0, quiet=True):
+    #{case name: seconds}
+    results = {}
+    output = open(os.devnull, 'w') if quiet else None
+    #the strategies' events are written like in a live run, to nowhere
+    configure_event_log('INFO', new_stream=output)
+    try:
+        for function_name in function_names:
+            for number_of_symbols in symbol_counts:
+                for window in windows:
+                    name = get_case_name(function_name, number_of_symbols, window)
+                    results[name] = time_signal_function(function_name, number_of_symbols, window, number_of_repeats, seed)
+                    print(f'{name}: {results[name] * 1000:.2f} ms')
+    finally:
+        stop_event_log()
+        if output is not None:
+            output.close()
+    return results
+
+
+#----- baselines -----
+
+def get_environment():
+    #the versions the timings depend on, an upgrade of one of them is what the baselines are there to catch
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__, 'statsmodels': statsmodels.__version__,
+            'machine': platform.machine(), 'system': platform.system()}
+
+
+def load_baselines(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baselines(results, path=BASELINE_PATH):
+    baselines = {'environment': get_environment(), 'cases': {name: round(seconds, 6) for name, seconds in sorted(results.items())}}
+    with open(path, 'w') as baseline_file:
+        json.dump(baselines, baseline_file, indent=2)
+        baseline_file.write('\n')
+    return baselines
+
+
+def compare_with_baselines(results, baselines, threshold=1.0, min_regression_seconds=0.0005):
+    #one row per case, regressed is whether it counts against the run
+    rows = []
+    for name, seconds in results.items():
+        baseline_seconds = baselines['cases'].get(name)
+        if baseline_seconds is None:
+            rows.append({'case': name, 'seconds': seconds, 'baseline_seconds': np.nan, 'ratio': np.nan, 'regressed': False})
+            continue
+        ratio = seconds / baseline_seconds if baseline_seconds > 0 else np.inf
+        regressed = ratio > 1 + threshold and seconds - baseline_seconds > min_regression_seconds
+        rows.append({'case': name, 'seconds': seconds, 'baseline_seconds': baseline_seconds, 'ratio': ratio, 'regressed': regressed})
+    return pd.DataFrame(rows, columns=['case', 'seconds', 'baseline_seconds', 'ratio', 'regressed'])
+
+
+def check_for_regressions(results, path=BASELINE_PATH, threshold=1.0, min_regression_seconds=0.0005):
+    #True when no case regressed
+    baselines = load_baselines(path)
+    if baselines is None:
+        print(f'No baselines at {path}, run with --update-baselines to store them.')
+        return True
+
+    changed = {name: (value, baselines['environment'].get(name)) for name, value in get_environment().items() if baselines['environment'].get(name) != value}
+    if changed:
+        print('The baselines were timed with ' + ', '.join(f'{name} {baseline_value}' for name, (value, baseline_value) in changed.items()) +
+              ', this run has ' + ', '.join(f'{name} {value}' for name, (value, baseline_value) in changed.items()) + '.')
+
+    comparison = compare_with_baselines(results, baselines, threshold, min_regression_seconds)
+    print(comparison.to_string(index=False))
+    regressions = comparison[comparison['regressed']]
+    if len(regressions) > 0:
+        print(f'{len(regressions)} of {len(comparison)} cases are more than {threshold:.0%} slower than their baselines.')
+        return False
+    print(f'No case is more than {threshold:.0%} slower than its baseline.')
+    return True
+
+
+if __name__ == '__main__':
+    pd.set_option('display.width', 1000)
+    results = run_benchmark_suite()
+    if '--update-baselines' in sys.argv[1:]:
+        save_baselines(results)
+        print(f'Stored {len(results)} baselines in {BASELINE_PATH}.')
+        sys.exit(0)
+    sys.exit(0 if check_for_regressions(results) else 1)
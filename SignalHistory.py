@@ -0,0 +1,120 @@
+"""
+    This class remembers each stock's last few minutes of signals, so a strategy can act on a crossing that came a minute or two
+    before (or after) the ADF test turned significant, instead of only on the two agreeing in the same minute.
+
+    Every stock gets a row id the first time it is seen, and its row holds history_minutes slots in one structured numpy array:
+    the bar minute the slot was written for, the ADF verdict, the crossing flag and the short SMA slope.
+    A minute is written to slot minute % history_minutes, so nothing is ever shifted; a slot whose minute is too old is simply ignored.
+    Queries take an array of row ids and answer for all of them with a few numpy operations, so thousands of stocks cost a few kilobytes
+    and microseconds per minute.
+
+"""
+
+#basic libraries
+import numpy as np
+
+
+SIGNAL_DTYPE = np.dtype([('minute', np.int32), ('adf', np.bool_), ('crossing', np.bool_), ('slope', np.float32)])
+
+#the minute of a slot that was never written, older than any window
+EMPTY_MINUTE = np.iinfo(np.int32).min
+
+
+def get_signal_minute(timestamp):
+    #bar timestamps are epoch seconds
+    return int(timestamp) // 60
+
+
+
+class SignalHistory():
+
+    def __init__(self, new_history_minutes=5, new_capacity=256):
+        self.history_minutes = new_history_minutes
+        self.symbol_ids = {}
+        self.table = self.get_empty_table(new_capacity)
+
+
+    def get_empty_table(self, capacity):
+        table = np.zeros((capacity, self.history_minutes), dtype=SIGNAL_DTYPE)
+        table['minute'] = EMPTY_MINUTE
+        table['slope'] = np.nan
+        return table
+
+
+    #----- symbol ids -----
+
+    def get_id(self, symbol):
+        symbol_id = self.symbol_ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = len(self.symbol_ids)
+            if symbol_id >= len(self.table):
+                #double the rows, amortized O(1) per new stock
+                grown_table = self.get_empty_table(2 * len(self.table))
+                grown_table[:len(self.table)] = self.table
+                self.table = grown_table
+            self.symbol_ids[symbol] = symbol_id
+        return symbol_id
+
+
+    def get_ids(self, symbols):
+        return np.fromiter((self.get_id(symbol) for symbol in symbols), dtype=np.intp, count=len(symbols))
+
+
+    def forget(self, symbols):
+        #drops the rows of stocks that are no longer screened, the rest are renumbered, so ids from before this call are stale
+        forgotten = set(symbols).intersection(self.symbol_ids)
+        if len(forgotten) == 0:
+            return
+        kept = [symbol for symbol in self.symbol_ids if symbol not in forgotten]
+        table = self.get_empty_table(len(self.table))
+        table[:len(kept)] = self.table[np.fromiter((self.symbol_ids[symbol] for symbol in kept), dtype=np.intp, count=len(kept))]
+        self.table = table
+        self.symbol_ids = {symbol: symbol_id for symbol_id, symbol in enumerate(kept)}
+
+
+    #----- writing -----
+
+    def record(self, symbol, minute, adf=False, crossing=False, slope=np.nan):
+        self.table[self.get_id(symbol), minute % self.history_minutes] = (minute, adf, crossing, slope)
+
+
+    def record_many(self, symbol_ids, minutes, adf, crossing, slopes):
+        #every argument is an array (or a scalar for all of them) lined up with symbol_ids
+        minutes = np.broadcast_to(np.asarray(minutes, dtype=np.int64), symbol_ids.shape)
+        slots = minutes % self.history_minutes
+        self.table['minute'][symbol_ids, slots] = minutes
+        self.table['adf'][symbol_ids, slots] = adf
+        self.table['crossing'][symbol_ids, slots] = crossing
+        self.table['slope'][symbol_ids, slots] = slopes
+
+
+    #----- queries -----
+
+    def get_recent_mask(self, symbol_ids, minute, minutes):
+        #the slots written for minute and the minutes before it, one row per symbol id, minute can be one per symbol id too
+        if minutes >= self.history_minutes:
+            raise ValueError(f'only {self.history_minutes} minutes are kept, {minutes} minutes back plus the current one do not fit')
+        if np.ndim(minute) > 0:
+            minute = np.asarray(minute, dtype=np.int64)[:, None]
+        recorded_minutes = self.table['minute'][symbol_ids]
+        return (recorded_minutes >= minute - minutes) & (recorded_minutes <= minute)
+
+
+    def any_within(self, field, symbol_ids, minute, minutes):
+        #for each symbol id, whether field ('adf' or 'crossing') was set at minute or in the minutes before it
+        return (self.table[field][symbol_ids] & self.get_recent_mask(symbol_ids, minute, minutes)).any(axis=1)
+
+
+    def has_within(self, field, symbol, minute, minutes):
+        symbol_id = self.symbol_ids.get(symbol)
+        if symbol_id is None:
+            return False
+        return bool(self.any_within(field, np.array([symbol_id]), minute, minutes)[0])
+
+
+    def get_recent_slopes(self, symbol_ids, minute, minutes):
+        #nan where nothing was recorded, newest minute last
+        slots = (minute - np.arange(minutes, -1, -1)) % self.history_minutes
+        rows = self.table[symbol_ids[:, None], slots[None, :]]
+        expected_minutes = minute - np.arange(minutes, -1, -1)
+        return np.where(rows['minute'] == expected_minutes, rows['slope'], np.nan)
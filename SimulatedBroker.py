@@ -0,0 +1,435 @@
+"""
+    This class stands in for alpaca's REST object during a backtest, so BasicStrategy subclasses and the StrategyCollector run unmodified.
+
+    It keeps cash, positions and orders in memory and fills them against the bars the BacktestEngine replays:
+    market orders (ioc, day or gtc) fill right away at the last close, plus an optional slippage,
+    trailing stops follow the high water mark of every new bar and trigger on its low,
+    and bracket orders fill their entry right away and then leave a take-profit and a stop-loss leg, one cancelling the other.
+
+    An order the account can't cover is rejected instead of raising, so one bad sizing decision doesn't end a multi-year backtest.
+    Every fill goes in the trade log, sells also record their realized profit.
+
+"""
+
+#basic libraries
+import itertools
+import numpy as np
+import pandas as pd
+
+#algo brokerage api
+from alpaca_trade_api.entity import AccountConfigurations, Asset, BarSet, Clock
+from alpaca_trade_api.rest import APIError
+
+from OhlcvBars import aggregate_bars
+
+
+class SimulatedAccount():
+
+    def __init__(self, new_broker):
+        self.broker = new_broker
+        self.trading_blocked = False
+        self.status = 'ACTIVE'
+
+    #alpaca returns numbers as strings, so do the same
+    @property
+    def cash(self):
+        return str(self.broker.cash)
+
+    @property
+    def buying_power(self):
+        return str(self.broker.cash)
+
+    @property
+    def equity(self):
+        return str(self.broker.get_equity())
+
+
+
+class SimulatedPosition():
+
+    def __init__(self, new_broker, new_symbol):
+        self.broker = new_broker
+        self.symbol = new_symbol
+        self.quantity = 0.0
+        self.average_entry_price = 0.0
+
+    @property
+    def qty(self):
+        return str(self.quantity)
+
+    @property
+    def avg_entry_price(self):
+        return str(self.average_entry_price)
+
+    @property
+    def current_price(self):
+        return str(self.broker.get_current_price(self.symbol))
+
+    @property
+    def market_value(self):
+        return str(self.quantity * self.broker.get_current_price(self.symbol))
+
+    @property
+    def unrealized_pl(self):
+        return str((self.broker.get_current_price(self.symbol) - self.average_entry_price) * self.quantity)
+
+    def __repr__(self):
+        return f'SimulatedPosition(symbol={self.symbol}, qty={self.quantity}, avg_entry_price={self.average_entry_price}, unrealized_pl={self.unrealized_pl})'
+
+
+
+class SimulatedOrder():
+
+    def __init__(self, new_id, new_symbol, new_qty, new_side, new_type, new_time_in_force, new_submitted_at, new_client_order_id):
+        self.id = new_id
+        self.client_order_id = new_client_order_id
+        self.symbol = new_symbol
+        self.qty = new_qty
+        self.side = new_side
+        self.type = new_type
+        self.time_in_force = new_time_in_force
+        self.submitted_at = new_submitted_at
+        self.status = 'new'
+        self.filled_qty = 0.0
+        self.filled_avg_price = None
+        self.filled_at = None
+
+        self.order_class = None
+        self.limit_price = None
+        self.stop_price = None
+        self.trail_price = None
+        self.trail_percent = None
+        self.hwm = None
+        self.legs = None
+        self.oco_order = None
+
+    def __repr__(self):
+        return f'SimulatedOrder(id={self.id}, symbol={self.symbol}, side={self.side}, type={self.type}, qty={self.qty}, status={self.status})'
+
+
+
+class SimulatedBroker():
+
+    def __init__(self, new_starting_cash=100000.0, new_slippage_percent=0.0):
+        self.starting_cash = float(new_starting_cash)
+        self.cash = float(new_starting_cash)
+        self.slippage_percent = new_slippage_percent
+
+        self.account = SimulatedAccount(self)
+        self.configurations = {'no_shorting': False, 'dtbp_check': 'entry', 'trade_confirm_email': 'all', 'suspend_trade': False}
+
+        self.positions = {}
+        self.orders = {}
+        self.open_orders = {}
+        self.orders_by_client_order_id = {}
+        self.order_ids = itertools.count(1)
+
+        self.trade_log = []
+        self.realized_pl = 0.0
+        self.rejected_orders = 0
+
+        #filled in by the BacktestEngine every tick
+        self.current_time = 0
+        self.symbol_row = {}
+        self.last_opens = np.empty(0)
+        self.last_highs = np.empty(0)
+        self.last_lows = np.empty(0)
+        self.last_closes = np.empty(0)
+        self.bar_source = None
+
+
+    def set_symbols(self, symbols):
+        self.symbol_row = {stock: row for row, stock in enumerate(symbols)}
+
+
+    def set_last_bars(self, timestamp, opens, highs, lows, closes, has_new_bar):
+        self.current_time = int(timestamp)
+        self.last_opens = opens
+        self.last_highs = highs
+        self.last_lows = lows
+        self.last_closes = closes
+        self.trigger_open_orders(has_new_bar)
+
+
+    def get_current_price(self, symbol):
+        row = self.symbol_row.get(symbol)
+        if row is None:
+            return float('nan')
+        return float(self.last_closes[row])
+
+
+    def get_equity(self):
+        equity = self.cash
+        for position in self.positions.values():
+            equity += position.quantity * self.get_current_price(position.symbol)
+        return equity
+
+
+    def get_timestamp(self):
+        return pd.Timestamp(self.current_time, unit='s', tz='UTC')
+
+
+    #----- order handling -----
+
+    def create_order(self, symbol, qty, side, type, time_in_force, client_order_id):
+        order_id = str(next(self.order_ids))
+        if client_order_id is None:
+            client_order_id = 'simulated-' + order_id
+        elif client_order_id in self.orders_by_client_order_id:
+            #alpaca refuses a reused client order id, the order pipeline relies on that to never double submit
+            raise APIError({'code': 40010001, 'message': 'client_order_id must be unique'})
+
+        order = SimulatedOrder(order_id, symbol, float(qty), side, type, time_in_force, self.get_timestamp(), client_order_id)
+        self.orders[order_id] = order
+        self.orders_by_client_order_id[client_order_id] = order
+        return order
+
+
+    def open_order(self, order):
+        order.status = 'new'
+        self.open_orders[order.id] = order
+
+
+    def finish_order(self, order, status):
+        order.status = status
+        self.open_orders.pop(order.id, None)
+
+
+    def reject_order(self, order, reason):
+        self.rejected_orders += 1
+        order.reject_reason = reason
+        self.finish_order(order, 'rejected')
+
+
+    def fill_order(self, order, price):
+
+        position = self.positions.get(order.symbol)
+
+        if order.side == 'buy':
+            quantity = order.qty
+            cost = quantity * price
+            if cost > self.cash:
+                self.reject_order(order, 'insufficient buying power')
+                return False
+            if position is None:
+                position = self.positions[order.symbol] = SimulatedPosition(self, order.symbol)
+            self.cash -= cost
+            position.average_entry_price = (position.average_entry_price * position.quantity + cost) / (position.quantity + quantity)
+            position.quantity += quantity
+            realized_pl = None
+        else:
+            #short selling is not simulated, a sell can only close what is held
+            if position is None or position.quantity <= 0:
+                self.reject_order(order, 'no position to sell')
+                return False
+            quantity = min(order.qty, position.quantity)
+            self.cash += quantity * price
+            realized_pl = (price - position.average_entry_price) * quantity
+            self.realized_pl += realized_pl
+            position.quantity -= quantity
+            if position.quantity <= 0:
+                del self.positions[order.symbol]
+
+        order.filled_qty = quantity
+        order.filled_avg_price = price
+        order.filled_at = self.get_timestamp()
+        self.finish_order(order, 'filled')
+
+        self.trade_log.append({'time': self.current_time, 'symbol': order.symbol, 'side': order.side, 'qty': quantity, 'price': price,
+                               'type': order.type, 'order_id': order.id, 'client_order_id': order.client_order_id, 'realized_pl': realized_pl})
+
+        #one leg of a bracket filling cancels the other
+        if order.oco_order is not None and order.oco_order.id in self.open_orders:
+            self.finish_order(order.oco_order, 'canceled')
+        return True
+
+
+    def get_market_price(self, symbol, side):
+        price = self.get_current_price(symbol)
+        slippage = price * self.slippage_percent / 100.0
+        return price + slippage if side == 'buy' else price - slippage
+
+
+    def trigger_open_orders(self, has_new_bar):
+
+        for order in list(self.open_orders.values()):
+            row = self.symbol_row.get(order.symbol)
+            if row is None or not has_new_bar[row] or order.id not in self.open_orders:
+                continue
+
+            bar_open = float(self.last_opens[row])
+            bar_high = float(self.last_highs[row])
+            bar_low = float(self.last_lows[row])
+
+            if order.type == 'trailing_stop':
+                #the stop is checked against the high water mark from before this bar, then the mark moves up
+                stop_price = self.get_trailing_stop_price(order)
+                if bar_low <= stop_price:
+                    self.fill_order(order, min(bar_open, stop_price))
+                else:
+                    order.hwm = max(order.hwm, bar_high)
+
+            elif order.type in ('stop', 'stop_limit'):
+                if order.side == 'sell' and bar_low <= order.stop_price:
+                    self.fill_order(order, min(bar_open, order.stop_price))
+                elif order.side == 'buy' and bar_high >= order.stop_price:
+                    self.fill_order(order, max(bar_open, order.stop_price))
+
+            elif order.type == 'limit':
+                if order.side == 'sell' and bar_high >= order.limit_price:
+                    self.fill_order(order, max(bar_open, order.limit_price))
+                elif order.side == 'buy' and bar_low <= order.limit_price:
+                    self.fill_order(order, min(bar_open, order.limit_price))
+
+
+    def get_trailing_stop_price(self, order):
+        if order.trail_price is not None:
+            return order.hwm - order.trail_price
+        return order.hwm * (1 - order.trail_percent / 100.0)
+
+
+    #----- the tradeapi.REST methods the strategies and the collector call -----
+
+    def submit_order(self, symbol, qty=None, side=None, type=None, time_in_force=None, limit_price=None, stop_price=None,
+                     client_order_id=None, order_class=None, take_profit=None, stop_loss=None, trail_price=None, trail_percent=None, **kwargs):
+
+        order = self.create_order(symbol, qty, side, type, time_in_force, client_order_id)
+        order.order_class = order_class
+        order.limit_price = None if limit_price is None else float(limit_price)
+        order.stop_price = None if stop_price is None else float(stop_price)
+        order.trail_price = None if trail_price is None else float(trail_price)
+        order.trail_percent = None if trail_percent is None else float(trail_percent)
+
+        current_price = self.get_current_price(symbol)
+        if current_price != current_price:
+            self.reject_order(order, 'no price for this symbol yet')
+            return order
+
+        if type == 'market':
+            filled = self.fill_order(order, self.get_market_price(symbol, side))
+            if filled and order_class == 'bracket':
+                self.add_bracket_legs(order, take_profit, stop_loss)
+
+        elif type == 'trailing_stop':
+            order.hwm = current_price
+            self.open_order(order)
+
+        elif type in ('limit', 'stop', 'stop_limit'):
+            self.open_order(order)
+
+        else:
+            self.reject_order(order, 'order type is not simulated')
+
+        return order
+
+
+    def add_bracket_legs(self, parent, take_profit, stop_loss):
+        take_profit_order = self.create_order(parent.symbol, parent.qty, 'sell', 'limit', parent.time_in_force, None)
+        take_profit_order.limit_price = float(take_profit['limit_price'])
+
+        stop_loss_order = self.create_order(parent.symbol, parent.qty, 'sell', 'stop', parent.time_in_force, None)
+        stop_loss_order.stop_price = float(stop_loss['stop_price'])
+
+        take_profit_order.oco_order = stop_loss_order
+        stop_loss_order.oco_order = take_profit_order
+        parent.legs = [take_profit_order, stop_loss_order]
+        self.open_order(take_profit_order)
+        self.open_order(stop_loss_order)
+
+
+    def cancel_order(self, order_id):
+        order = self.open_orders.get(order_id)
+        if order is None:
+            raise APIError({'code': 42210000, 'message': 'order is not cancelable'})
+        self.finish_order(order, 'canceled')
+
+
+    def close_position(self, symbol):
+        position = self.positions.get(symbol)
+        if position is None:
+            raise APIError({'code': 40410000, 'message': 'position does not exist'})
+        order = self.create_order(symbol, position.quantity, 'sell', 'market', 'day', None)
+        self.fill_order(order, self.get_market_price(symbol, 'sell'))
+        return order
+
+
+    def list_positions(self):
+        return list(self.positions.values())
+
+
+    def get_position(self, symbol):
+        if symbol not in self.positions:
+            raise APIError({'code': 40410000, 'message': 'position does not exist'})
+        return self.positions[symbol]
+
+
+    def list_orders(self, status=None, limit=None, **kwargs):
+        if status is None or status == 'open':
+            orders = list(self.open_orders.values())
+        elif status == 'closed':
+            orders = [order for order in self.orders.values() if order.id not in self.open_orders]
+        else:
+            orders = list(self.orders.values())
+        if limit is not None:
+            orders = orders[-limit:]
+        return orders
+
+
+    def get_order(self, order_id):
+        return self.orders[order_id]
+
+
+    def get_order_by_client_order_id(self, client_order_id):
+        if client_order_id not in self.orders_by_client_order_id:
+            raise APIError({'code': 40410000, 'message': 'order not found'})
+        return self.orders_by_client_order_id[client_order_id]
+
+
+    def get_account(self):
+        return self.account
+
+
+    def get_account_configurations(self):
+        return AccountConfigurations(dict(self.configurations))
+
+
+    def update_account_configurations(self, no_shorting=None, dtbp_check=None, trade_confirm_email=None, suspend_trade=None):
+        for key, value in (('no_shorting', no_shorting), ('dtbp_check', dtbp_check), ('trade_confirm_email', trade_confirm_email), ('suspend_trade', suspend_trade)):
+            if value is not None:
+                self.configurations[key] = value
+        return self.get_account_configurations()
+
+
+    def get_clock(self):
+        timestamp = self.get_timestamp().isoformat()
+        return Clock({'timestamp': timestamp, 'is_open': True, 'next_open': timestamp, 'next_close': timestamp})
+
+
+    def list_assets(self, status=None, asset_class=None):
+        return [Asset({'symbol': symbol, 'status': 'active', 'tradable': True, 'exchange': 'SIMULATED', 'class': 'us_equity'}) for symbol in self.symbol_row]
+
+
+    #minute bars come from the BacktestEngine, longer timeframes are built from them
+    def get_barset(self, symbols, timeframe, limit=None, start=None, end=None, after=None, until=None):
+        if isinstance(symbols, str):
+            symbols = symbols.split(',')
+        if limit is None:
+            limit = 100
+
+        minutes_per_bar = {'minute': 1, '1Min': 1, '5Min': 5, '15Min': 15, 'day': 390, '1D': 390}[timeframe]
+
+        #after and until narrow the range, the newest bars inside it are returned like alpaca does
+        after_timestamp = None if after is None else pd.Timestamp(after).timestamp()
+        until_timestamp = None if until is None else pd.Timestamp(until).timestamp()
+
+        raw = {}
+        for symbol in symbols:
+            columns = self.bar_source.get_minute_bars(symbol, limit * minutes_per_bar, until_timestamp)
+            if after_timestamp is not None:
+                keep = np.asarray(columns['t']) > after_timestamp
+                columns = {name: np.asarray(values)[keep] for name, values in columns.items()}
+            if minutes_per_bar > 1:
+                columns = aggregate_bars(columns, 86400 if minutes_per_bar == 390 else 60 * minutes_per_bar)
+            raw[symbol] = [{'t': int(columns['t'][i]), 'o': float(columns['o'][i]), 'h': float(columns['h'][i]), 'l': float(columns['l'][i]),
+                            'c': float(columns['c'][i]), 'v': float(columns['v'][i])} for i in range(max(0, len(columns['t']) - limit), len(columns['t']))]
+        return BarSet(raw)
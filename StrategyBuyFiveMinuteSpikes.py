@@ -22,6 +22,7 @@
 
 
 #basic libraries
+import asyncio
 import pandas as pd
 import numpy as np
 import time
@@ -38,6 +39,13 @@ from statsmodels.tsa.stattools import adfuller
 #inherited class
 from BasicStrategy import *
 
+from RollingSmaIndicator import RollingSmaIndicator
+from SignalHistory import SignalHistory, get_signal_minute
+from EventLog import EventLog
+
+
+event_log = EventLog('strategy')
+
 
 class StrategyBuyFiveMinuteSpikes(BasicStrategy):
     
@@ -55,97 +63,312 @@ class StrategyBuyFiveMinuteSpikes(BasicStrategy):
         self.target_profit_per_trade = new_target_profit
 
         #sometimes the mean crossing point can happen a minute or two off from when the spike becomes statistically significant
-        #in the future modify this variable to be an array that keeps track of the last minute data for each stock to capture these near-misses
-        self.previous_adf_bool = False
-        self.previous_crossing_buy_bool = False
+        #each stock's last few minutes of ADF verdicts and crossings are kept, a buy needs both within near_miss_minutes of each other
+        #0 is the same minute rule ParameterSweep replays, set it to 1 or 2 (up to 4) to also buy on near misses
+        self.near_miss_minutes = 0
+        self.signal_history = SignalHistory(5)
+
+        #one incremental SMA/slope indicator per stock, so only the newest bars are added each minute
+        self.sma_indicators = {}
+
+        #screen the whole stock list with a few numpy operations when the bars are in the shared cache
+        self.use_batch_signals = True
+
+
+    def get_sma_indicator(self, stock):
+        if stock not in self.sma_indicators:
+            self.sma_indicators[stock] = RollingSmaIndicator(self.long_duration,self.short_duration,self.short_slope_duration,self.get_number_of_minute_bars_needed())
+        return self.sma_indicators[stock]
+
 
-        self.current_adf_bool = False
-        self.current_crossing_buy_bool = False
+    def get_number_of_minute_bars_needed(self):
+        #the +2 is because the long SMA will need more data to calculate
+        return self.long_duration+2
+
+
+    def get_signal_minutes(self, last_bar_timestamps):
+        #the minute of each stock's last bar, or the current minute when the bars came without times
+        now_minute = get_signal_minute(time.time())
+        return np.array([now_minute if timestamp is None else get_signal_minute(timestamp) for timestamp in last_bar_timestamps], dtype=np.int64)
 
         
     def run_strategy(self):
+
+        #screen every stock at once when the collector's cache already holds this strategy's bars
+        if self.can_screen_in_process_pool():
+            self.run_strategy_on_matrix()
+        else:
+            self.run_strategy_stock_by_stock()
+
+
+    #the StrategyCollector's streaming mode calls this with only the stocks whose bar just closed
+    def run_strategy_on_stocks(self, stocks):
+        if self.use_batch_signals and self.market_data is not None and self.market_data.has_rows(stocks, self.get_number_of_minute_bars_needed()):
+            self.run_strategy_on_matrix(stocks)
+        else:
+            self.run_strategy_stock_by_stock(stocks)
+
+
+    def run_strategy_stock_by_stock(self, stock_list=None):
         
+        if stock_list is None:
+            stock_list = self.stock_list
     
-        for i in range(len(self.stock_list)):
+        for i in range(len(stock_list)):
 
            
-            stock = str(self.stock_list[i])
-            print(f'inside for loop, strategy = {self.strat_name} and stock ticker = {stock}')
+            stock = str(stock_list[i])
+
+            #its bars failed validation, fetching them again on its own would only get the same bars
+            if self.is_stock_rejected(stock):
+                event_log.debug('data_not_usable', strategy=self.strat_name, symbol=stock, reasons='rejected by the bar validator')
+                continue
         
-            #get a np array that contains all of this stock's closing data for the past duration, the +2 is because the long SMA will need more data to calculate
-            this_stocks_close_np_array = self.get_historical_data_close_price_by_minutes(stock,self.long_duration+2)
+            #get a np array that contains all of this stock's closing data for the past duration
+            this_stocks_close_np_array = self.get_historical_data_close_price_by_minutes(stock,self.get_number_of_minute_bars_needed())
           
             #if the data contains zeros or other errors, skip that stock and go to the next stock ticker
-            if self.is_historical_data_clean(this_stocks_close_np_array):
+            with self.metrics.timer('clean', self.strat_name, stock):
+                is_clean = self.is_historical_data_clean(this_stocks_close_np_array)
+            if is_clean:
 
-                #keeping this line for future expansion, see comment above in constructor
-                #self.previous_adf_bool = self.current_adf_bool
-                #self.previous_crossing_buy_bool = self.current_crossing_buy_bool
+                this_stocks_timestamp_np_array = self.get_historical_data_timestamps_by_minutes(stock,self.get_number_of_minute_bars_needed())
+                last_bar_timestamp = self.get_last_timestamp(this_stocks_timestamp_np_array)
 
-                self.current_adf_bool = self.augmented_dickey_fuller_test_on_list(this_stocks_close_np_array)
-                self.current_crossing_buy_bool = self.check_mean_reversion_of_long_and_short_sma_and_sma_slopes(this_stocks_close_np_array,self.long_duration,self.short_duration,self.short_slope_duration,self.short_slope_threshold,self.short_long_slope_diff_threshold)
+                #no new bar since the last tick, the same window gives the same answer
+                signals = self.get_reusable_signals(stock, last_bar_timestamp)
+                if signals is None:
+                    adf_bool = self.augmented_dickey_fuller_test_on_list(this_stocks_close_np_array,stock,last_bar_timestamp)
+                    indicator = self.get_sma_indicator(stock)
+                    with self.metrics.timer('sma', self.strat_name, stock):
+                        crossing_buy_bool = self.check_mean_reversion_of_long_and_short_sma_and_sma_slopes_with_indicator(indicator,this_stocks_close_np_array,this_stocks_timestamp_np_array,self.short_slope_threshold,self.short_long_slope_diff_threshold)
+                    signals = (adf_bool, crossing_buy_bool, indicator.get_short_slope())
+                    self.remember_signals(stock, last_bar_timestamp, signals)
+                adf_bool, crossing_buy_bool, short_slope = signals
 
-                if (self.current_adf_bool or self.previous_adf_bool) and (self.current_crossing_buy_bool or self.previous_crossing_buy_bool):
+                #this minute's signals count together with the ones from the last near_miss_minutes
+                minute = self.get_signal_minutes([last_bar_timestamp])[0]
+                self.signal_history.record(stock, minute, adf_bool, crossing_buy_bool, short_slope)
+                near_adf_bool = self.signal_history.has_within('adf', stock, minute, self.near_miss_minutes)
+                near_crossing_buy_bool = self.signal_history.has_within('crossing', stock, minute, self.near_miss_minutes)
 
-                    #celebrate because an potential opportunity was found
-                    self.found_opportunity()
+                if near_adf_bool and near_crossing_buy_bool:
+                    self.metrics.record_signal(self.strat_name, stock)
+                    self.buy_opportunity(stock, this_stocks_close_np_array)
+                else: #did not find buying opportunity
+                    event_log.debug('no_opportunity', strategy=self.strat_name, symbol=stock, adf=adf_bool, crossing_buy=crossing_buy_bool,
+                                    near_adf=near_adf_bool, near_crossing_buy=near_crossing_buy_bool)
+            else: #data is not clean
+                event_log.debug('data_not_usable', strategy=self.strat_name, symbol=stock)
 
-                    #based on target profit per trade and how the stock's std dev, determine qty to buy
-                    std_dev = this_stocks_close_np_array.std()
-                    half_std_dev = std_dev / 2
-                    qty_to_buy = round( self.target_profit_per_trade / half_std_dev) #round without a second parameter should return an int
 
-                    #figure out costs and balances
-                    current_price = this_stocks_close_np_array[-1] #-1 in the index gets the last element in the np array
-                    current_cash = self.get_account_cash_as_float()
-                    total_cost = current_price * float(qty_to_buy)
-                    new_balance = current_cash - total_cost
+    def run_strategy_on_matrix(self, stock_list=None):
 
-                    #check to see if the strategy is allowed to spend that much of the balance
-                    if new_balance > self.minimum_reserve_balance and total_cost < float(self.money_allocated_to_this_strategy):
-                        #print(f'Found a trade and there is enough to cover this purchase, new balance = {new_balance} and the maximum allocation for this strategy is = ${self.money_allocated_to_this_strategy}')
-                
-                        if(self.check_if_stock_already_has_open_order_or_position(stock)):
-                            print("Future version of this code might lift this limitation, once there is a way to corrolate client id's and positions.")
-                            print("Not allowed to make this purchase since there are already open orders or positions for this stock.")
-                        else:
-                            print("Allowed to purchase this stock since there are no conflicting open orders or positions")
-                            self.buy_market_ioc_and_add_trailing_stop_loss_percent(stock,qty_to_buy,1.0)
+        if stock_list is None:
+            stock_list = self.stock_list
+        stocks = [str(stock) for stock in stock_list]
+        close_price_np_matrix = self.market_data.get_close_matrix(stocks, self.get_number_of_minute_bars_needed())
+        last_bar_timestamps = [self.market_data.get_last_timestamp(stock) for stock in stocks]
 
-                    else: #balances
-                        print('Found a trade, but there is not enough in the account to cover it.')
+        #only the stocks with a new bar are screened, the others keep what their last screen found
+        changed_rows = self.get_changed_rows(stocks, last_bar_timestamps)
+        screened_stocks = []
+        if len(changed_rows) > 0:
+            screened_stocks = self.screen_stocks_on_matrix([stocks[row] for row in changed_rows], close_price_np_matrix[changed_rows],
+                                                           [last_bar_timestamps[row] for row in changed_rows])
+        self.act_on_screened_stocks(self.merge_screened_stocks(stocks, last_bar_timestamps, changed_rows, screened_stocks))
 
-                else: #did not find buying opportunity
-                    print('Inside else statement, did not find buying opportunity')
-            else: #data is not clean
-                print('Data is not usable, check to see if there are zeros or other anomolies in the data')
+
+    def can_screen_in_process_pool(self):
+        return self.use_batch_signals and self.market_data is not None and self.market_data.has_rows(self.stock_list, self.get_number_of_minute_bars_needed())
+
+
+    #only math, no broker calls, so the StrategyCollector can run it on shards of the stock list in worker processes
+    def screen_stocks_on_matrix(self, stocks, close_price_np_matrix, last_bar_timestamps):
+
+        with self.metrics.timer('clean', self.strat_name):
+            is_clean = self.is_historical_data_clean_on_matrix(close_price_np_matrix)
+        with self.metrics.timer('sma', self.strat_name):
+            crossing_buy, metrics = self.check_mean_reversion_of_long_and_short_sma_and_sma_slopes_on_matrix(close_price_np_matrix,self.long_duration,self.short_duration,self.short_slope_duration,self.short_slope_threshold,self.short_long_slope_diff_threshold)
+        event_log.info('stocks_screened', strategy=self.strat_name, stocks=len(stocks), clean=int(is_clean.sum()), crossing_buy=int((is_clean & crossing_buy).sum()))
+
+        #an opportunity needs a crossing, now or in the last near_miss_minutes (the history is only read here, a worker process has a copy of it)
+        minutes = self.get_signal_minutes(last_bar_timestamps)
+        recent_crossing_buy = self.signal_history.any_within('crossing', self.signal_history.get_ids(stocks), minutes, self.near_miss_minutes)
+        has_crossing = is_clean & (crossing_buy | recent_crossing_buy)
+
+        #without near misses the ADF test only has to run on the stocks with a crossing,
+        #with them every clean stock with enough bars for a crossing is tested, a significant test is remembered for a crossing in the next few minutes
+        if self.near_miss_minutes > 0:
+            has_enough_bars = (~np.isnan(close_price_np_matrix)).sum(axis=1) > self.long_duration
+            candidate_rows = np.flatnonzero(has_crossing | (is_clean & has_enough_bars))
+        else:
+            candidate_rows = np.flatnonzero(has_crossing)
+        candidate_stocks = [stocks[row] for row in candidate_rows]
+        candidate_close_np_arrays = [close_price_np_matrix[row][~np.isnan(close_price_np_matrix[row])] for row in candidate_rows]
+        candidate_last_bar_timestamps = [last_bar_timestamps[row] for row in candidate_rows]
+        self.prepare_augmented_dickey_fuller_tests(candidate_close_np_arrays, candidate_stocks, candidate_last_bar_timestamps)
+
+        #only the stocks with a crossing or a significant test go back, the others have nothing worth remembering
+        screened_stocks = []
+        for i, row in enumerate(candidate_rows):
+            adf_bool = self.augmented_dickey_fuller_test_on_list(candidate_close_np_arrays[i],candidate_stocks[i],candidate_last_bar_timestamps[i])
+            if adf_bool or has_crossing[row]:
+                row_metrics = {name: values[row] for name, values in metrics.items()}
+                screened_stocks.append((candidate_stocks[i], adf_bool, bool(crossing_buy[row]), int(minutes[row]), row_metrics))
+
+        return screened_stocks
+
+
+    #runs in the parent process, in stock list order, so the cash and open order/position checks see every earlier purchase
+    def act_on_screened_stocks(self, screened_stocks):
+
+        #this minute's signals go into the history first, then every screened stock's near misses are looked up at once
+        symbol_ids = self.signal_history.get_ids([screened[0] for screened in screened_stocks])
+        minutes = np.array([screened[3] for screened in screened_stocks], dtype=np.int64)
+        self.signal_history.record_many(symbol_ids, minutes, [screened[1] for screened in screened_stocks], [screened[2] for screened in screened_stocks],
+                                        [screened[4]['diff_SHORT'] for screened in screened_stocks])
+        near_adf = self.signal_history.any_within('adf', symbol_ids, minutes, self.near_miss_minutes)
+        near_crossing_buy = self.signal_history.any_within('crossing', symbol_ids, minutes, self.near_miss_minutes)
+        is_opportunity = near_adf & near_crossing_buy
+
+        #every signal in the list was found at once, the later stocks also wait for the earlier stocks' orders
+        self.metrics.record_signals(self.strat_name, [screened[0] for i, screened in enumerate(screened_stocks) if is_opportunity[i]])
+
+        for i, (stock, adf_bool, crossing_buy_bool, minute, row_metrics) in enumerate(screened_stocks):
+
+            event_log.debug('crossing_buy_signal', strategy=self.strat_name, symbol=stock, found=crossing_buy_bool, adf=adf_bool, SMA_LONG=row_metrics['SMA_LONG'],
+                            SMA_SHORT=row_metrics['SMA_SHORT'], diff_SHORT=row_metrics['diff_SHORT'], diff_delta=row_metrics['diff_delta'])
+
+            if is_opportunity[i]:
+                this_stocks_close_np_array = self.get_historical_data_close_price_by_minutes(stock,self.get_number_of_minute_bars_needed())
+                self.buy_opportunity(stock, this_stocks_close_np_array)
+            else: #did not find buying opportunity
+                event_log.debug('no_opportunity', strategy=self.strat_name, symbol=stock, adf=adf_bool, crossing_buy=crossing_buy_bool,
+                                near_adf=bool(near_adf[i]), near_crossing_buy=bool(near_crossing_buy[i]))
+
+
+    def forget_stocks(self, stocks):
+        BasicStrategy.forget_stocks(self, stocks)
+        for stock in stocks:
+            self.sma_indicators.pop(stock, None)
+        self.signal_history.forget(stocks)
+
+
+    #the indicators are only updated in the parent, a worker process gets a copy without them
+    def __getstate__(self):
+        state = BasicStrategy.__getstate__(self)
+        state['sma_indicators'] = {}
+        return state
+
+
+    def buy_opportunity(self, stock, this_stocks_close_np_array):
+
+        #celebrate because an potential opportunity was found
+        self.found_opportunity(stock)
+
+        #based on target profit per trade and how the stock's std dev, determine qty to buy
+        std_dev = this_stocks_close_np_array.std()
+        half_std_dev = std_dev / 2
+        qty_to_buy = round( self.target_profit_per_trade / half_std_dev) #round without a second parameter should return an int
+
+        #figure out costs and balances
+        current_price = this_stocks_close_np_array[-1] #-1 in the index gets the last element in the np array
+        total_cost = current_price * float(qty_to_buy)
+
+        #check to see if the strategy is allowed to spend that much of the balance, and if so hold the cash until the buy is done
+        reservation = self.reserve_cash(stock, total_cost)
+        if reservation is not None:
+            #print(f'Found a trade and there is enough to cover this purchase, new balance = {new_balance} and the maximum allocation for this strategy is = ${self.money_allocated_to_this_strategy}')
+    
+            #future versions might lift this limitation, once there is a way to corrolate client id's and positions
+            if(self.check_if_stock_already_has_open_order_or_position(stock)):
+                self.release_cash(reservation, spent=False)
+                event_log.info('buy_decision', strategy=self.strat_name, symbol=stock, decision='skip', reason='open order or position', qty=qty_to_buy, price=current_price)
+            else:
+                event_log.info('buy_decision', strategy=self.strat_name, symbol=stock, decision='buy', qty=qty_to_buy, price=current_price,
+                               new_balance=self.get_account_cash_as_float())
+                self.buy_market_ioc_and_add_trailing_stop_loss_percent(stock,qty_to_buy,1.0, reservation)
+
+        else: #balances
+            event_log.info('buy_decision', strategy=self.strat_name, symbol=stock, decision='skip', reason='not enough cash', qty=qty_to_buy, price=current_price,
+                           cash=self.get_account_cash_as_float(), allocated=self.money_allocated_to_this_strategy)
         
       
              
 
     def sell_positions_over_threshold(self):
         
-        positions = self.alpaca.list_positions()
+        #the collector's snapshot already holds this loop's positions and open orders, indexed by symbol
+        if self.broker_state is not None:
+            positions = self.broker_state.get_positions()
+        else:
+            positions = self.alpaca.list_positions()
 
         for position in positions:
             
             #makes sure a strategy doesn't sell another strategies position
             if position.symbol in self.stock_list:
 
-                print(f'There is an open position for symbol {position.symbol} that has an unrealized profit of {position.unrealized_pl}')
+                event_log.debug('open_position', strategy=self.strat_name, symbol=position.symbol, unrealized_pl=position.unrealized_pl)
                 
                 if( float(position.unrealized_pl) > self.target_profit_per_trade ):
                 
-                    print("Made a profit! Closing any open orders for this symbol and then closing the position.")
+                    #closing any open orders for this symbol and then closing the position
+                    event_log.info('take_profit', strategy=self.strat_name, symbol=position.symbol, unrealized_pl=position.unrealized_pl, target=self.target_profit_per_trade)
               
                     # Clear any existing orders with the same stock symbol
-                    orders = self.alpaca.list_orders(status="open")
-                    for order in orders:
-                        if order.symbol == position.symbol:
+                    if self.broker_state is not None:
+                        for order in self.broker_state.get_open_orders_for_symbol(position.symbol):
                             self.alpaca.cancel_order(order.id)
+                            self.broker_state.record_cancelled_order(order.id)
+                    else:
+                        orders = self.alpaca.list_orders(status="open")
+                        for order in orders:
+                            if order.symbol == position.symbol:
+                                self.alpaca.cancel_order(order.id)
 
-                    #closing the position
-                    self.alpaca.close_position(position.symbol)
+                    #closing the position, the market sell that closes it keeps the symbol busy until the next refresh
+                    closing_order = self.alpaca.close_position(position.symbol)
+                    if self.broker_state is not None:
+                        self.broker_state.record_closed_position(position.symbol, closing_order)
                 
         
 
+    #same decisions as sell_positions_over_threshold, but the positions and open orders are listed together
+    #and every profitable position is closed at the same time
+    async def sell_positions_over_threshold_async(self, async_rest):
+
+        if self.broker_state is not None:
+            positions = self.broker_state.get_positions()
+        else:
+            positions, orders = await asyncio.gather(async_rest.list_positions(), async_rest.list_orders(status="open"))
+
+        closings = []
+        for position in positions:
+
+            #makes sure a strategy doesn't sell another strategies position
+            if position.symbol in self.stock_list:
+
+                event_log.debug('open_position', strategy=self.strat_name, symbol=position.symbol, unrealized_pl=position.unrealized_pl)
+
+                if( float(position.unrealized_pl) > self.target_profit_per_trade ):
+                    #closing any open orders for this symbol and then closing the position
+                    event_log.info('take_profit', strategy=self.strat_name, symbol=position.symbol, unrealized_pl=position.unrealized_pl, target=self.target_profit_per_trade)
+                    if self.broker_state is not None:
+                        symbol_orders = self.broker_state.get_open_orders_for_symbol(position.symbol)
+                    else:
+                        symbol_orders = [order for order in orders if order.symbol == position.symbol]
+                    closings.append(self.close_position_and_its_orders_async(async_rest, position.symbol, symbol_orders))
+
+        await asyncio.gather(*closings)
+
+
+    async def close_position_and_its_orders_async(self, async_rest, symbol, orders):
+        #the trailing stop has to be cancelled before the position can be closed
+        await asyncio.gather(*[async_rest.cancel_order(order.id) for order in orders])
+        closing_order = await async_rest.close_position(symbol)
+        if self.broker_state is not None:
+            for order in orders:
+                self.broker_state.record_cancelled_order(order.id)
+            self.broker_state.record_closed_position(symbol, closing_order)
@@ -1,13 +1,23 @@
 """
     This class is organizes and operates all strategies.
-    In future improvements, this would be the place to implement multi-threading to improve performance. 
+    enable_metrics turns on the TickMetrics stage timings and REST call counts (optionally served at /metrics), profile_next_tick runs one tick under cProfile.
+    The loop is driven by a TickScheduler: a tick runs right after each bar closes, and only the strategies whose cadence_minutes is due screen their stocks in it.
+    Every strategy's take-profit check runs on every tick, whatever its cadence.
+    With more than one process, the CPU bound signal math (SMA/ADF per stock) of every strategy is split into shards of stocks
+    and spread across a process pool, while orders are still placed one at a time in this process.
    
 """
 
 import pandas as pd
 import numpy as np
+import asyncio
 import time
 import datetime
+import math
+import multiprocessing
+import concurrent.futures
+import cProfile
+import pstats
 from pytz import timezone
 
 from alpaca_trade_api.rest import TimeFrame
@@ -15,73 +25,459 @@ from alpaca_trade_api.rest import TimeFrame
 import alpaca_trade_api as tradeapi
 from statsmodels.tsa.stattools import adfuller
 
+from MarketDataCache import MarketDataCache
+from BarValidator import BarValidator
+from FastAdf import FastAdf
+from BrokerStateSnapshot import BrokerStateSnapshot
+from BarStore import BarStore
+from TickScheduler import TickScheduler
+from TickMetrics import TickMetrics, CountingRest, MetricsServer
+from EventLog import EventLog
+from OrderPipeline import OrderPipeline
+from RateLimitGovernor import RateLimitGovernor
+from AccountLedger import AccountLedger
+from UniverseScreener import get_tradable_symbols
+
+
+event_log = EventLog('collector')
+
+
+#each worker process keeps its own FastAdf, so its LRU is reused across the shards that land on it
+worker_adf_test = None
+
+def screen_stock_shard(strat, stocks, close_price_np_matrix, last_bar_timestamps):
+    global worker_adf_test
+    if worker_adf_test is None:
+        worker_adf_test = FastAdf()
+    strat.adf_test = worker_adf_test
+    #the worker's timings would be lost with the process, the parent times the whole shard instead
+    strat.metrics = TickMetrics()
+    return strat.screen_stocks_on_matrix(stocks, close_price_np_matrix, last_bar_timestamps)
+
 
 
 class StrategyCollector():
   
 
-    def __init__(self, trade_api_rest):
+    def __init__(self, trade_api_rest, new_number_of_processes=1, new_bar_store_directory=None, new_settle_seconds=2.0, new_use_order_pipeline=False,
+                 new_requests_per_minute=None, new_account_ttl_seconds=60.0):
         
         self.strat_list = []
-        self.alpaca = trade_api_rest
-        self.account = self.alpaca.get_account()
+        self.number_of_processes = new_number_of_processes
+        self.process_pool = None
+        #with a quota, every request from the collector and its strategies shares one token bucket, orders first
+        self.rate_limit_governor = RateLimitGovernor(trade_api_rest, new_requests_per_minute) if new_requests_per_minute is not None else None
+        self.alpaca = self.rate_limit_governor if self.rate_limit_governor is not None else trade_api_rest
+        #with a directory, every fetched bar is kept on disk and only newer bars are fetched, even after a restart
+        self.bar_store = BarStore(new_bar_store_directory, self.alpaca) if new_bar_store_directory is not None else None
+        self.market_data = MarketDataCache(self.alpaca, new_bar_store=self.bar_store)
+        #every refresh's bars are checked in one pass, stocks that keep failing are left out of the fetches for a while
+        self.bar_validator = BarValidator()
+        self.market_data.bar_validator = self.bar_validator
+        self.adf_test = FastAdf()
+        self.broker_state = BrokerStateSnapshot(self.alpaca)
+        #ticks start settle_seconds after each bar close, see TickScheduler
+        self.scheduler = TickScheduler(self.alpaca, new_settle_seconds)
+        #buys are placed on the pipeline's threads and their stops only go in once the fill is known
+        #the fill polls of every buy share 60 get_order calls a tick, so they can't crowd out the data reads under the rate limit
+        self.order_pipeline = OrderPipeline(self.alpaca, new_max_polls_per_tick=60) if new_use_order_pipeline else None
+        #stage timings and REST call counts, off until enable_metrics is called
+        self.metrics = TickMetrics()
+        self.print_tick_summary = False
+        self.metrics_server = None
+        self.profile_next_tick_requested = False
+        self.profile_path = None
+        #picks the strategies' stocks from the whole tradable universe, off until set_universe_screener is called
+        self.universe_screener = None
+        #one view of the account's cash for every strategy, fetched again after ttl_seconds or once a buy fills
+        self.account_ledger = AccountLedger(self.alpaca, new_account_ttl_seconds)
+        self.account = self.account_ledger.get_account()
         self.disable_shorting()
         self.print_my_account_configurations()
 
 
     def append_strat(self, new_strat):
+        new_strat.market_data = self.market_data
+        new_strat.adf_test = self.adf_test
+        new_strat.broker_state = self.broker_state
+        new_strat.bar_store = self.bar_store
+        new_strat.metrics = self.metrics
+        new_strat.order_pipeline = self.order_pipeline
+        new_strat.account_ledger = self.account_ledger
+        if self.rate_limit_governor is not None and new_strat.alpaca is self.rate_limit_governor.rest:
+            new_strat.alpaca = self.rate_limit_governor
+        if self.metrics.enabled and not isinstance(new_strat.alpaca, CountingRest):
+            new_strat.alpaca = CountingRest(new_strat.alpaca, self.metrics)
         self.strat_list.append(new_strat)
-        print("Inside Strat Collector, appended new strategy.\n")
+        event_log.info('strategy_appended', strategy=new_strat.strat_name, stocks=len(new_strat.stock_list))
 
 
     def run_strat_collector(self):
-                        
+
+      #one get_clock for the whole day, the scheduler keeps the broker's time from the local clock
+      self.scheduler.sync()
+
       #begin looping until the market closes
-      while self.alpaca.get_clock().is_open:
-                
-        self.start_time_of_loop = self.alpaca.get_clock().timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
-      
-        print("\n\nRunning Strategies:")
+      while self.scheduler.is_market_open():
+
+        #wakes up right after each bar closes, a tick that overran skips the bar closes it missed
+        bar_close = self.scheduler.wait_for_next_tick()
+        if not self.scheduler.is_market_open():
+            break
+
+        #the due strategies screen their stocks, every strategy checks its positions
+        due_strats = self.scheduler.get_due_strategies(self.strat_list, bar_close)
+        self.scheduler.start_tick()
+        self.run_tick(due_strats)
+        self.scheduler.end_tick()
+
+      self.close_process_pool()
+      self.close_order_pipeline()
+
+
+
+    #streaming version of run_strat_collector, each stock is evaluated as soon as its bar arrives from the feed (see BarStream)
+    #positions are still checked once every housekeeping_seconds, and when no bar has arrived for stale_seconds or the feed failed,
+    #the loop polls with run_tick instead and tries to start the feed again every reconnect_seconds
+    async def run_strat_collector_streaming(self, feed, new_stale_seconds=90, new_housekeeping_seconds=60, new_reconnect_seconds=300):
+
+      #the history comes from one normal fetch (or the bar store), the stream only adds the new bars to it
+      self.market_data.refresh_for_strategies(self.strat_list)
+      self.broker_state.refresh()
+      symbols = list(self.market_data.symbols)
+
+      self.pending_stocks = set()
+      self.bar_arrived = asyncio.Event()
+      self.last_bar_received = time.monotonic()
+      self.bars_received = 0
+      self.polling_ticks = 0
+
+      evaluator = asyncio.ensure_future(self.evaluate_streamed_stocks())
+      feed_task = asyncio.ensure_future(feed.run(symbols, self.receive_streamed_bar))
+      feed_started = time.monotonic()
+
+      try:
+        while self.alpaca.get_clock().is_open:
+
+          if feed_task.done():
+              await asyncio.sleep(new_housekeeping_seconds)
+          else:
+              await asyncio.wait([feed_task], timeout=new_housekeeping_seconds)
+
+          #a replay that ran out of bars ends the loop, a live feed never finishes on its own
+          if feed_task.done() and not feed_task.cancelled() and feed_task.exception() is None:
+              break
+
+          if feed_task.done() or time.monotonic() - self.last_bar_received > new_stale_seconds:
+              event_log.warning('bar_stream_down', seconds_since_last_bar=time.monotonic() - self.last_bar_received, feed_failed=feed_task.done())
+              self.run_tick()
+              self.polling_ticks += 1
+
+              if time.monotonic() - feed_started > new_reconnect_seconds:
+                  event_log.info('bar_stream_restart')
+                  feed_task.cancel()
+                  await feed.stop()
+                  self.last_bar_received = time.monotonic()
+                  feed_task = asyncio.ensure_future(feed.run(symbols, self.receive_streamed_bar))
+                  feed_started = time.monotonic()
+          else:
+              if self.order_pipeline is not None:
+                  self.order_pipeline.start_tick()
+              self.broker_state.refresh()
+
+              for strat in self.strat_list:
+                  strat.sell_positions_over_threshold()
+
+              for strat in self.strat_list:
+                  strat.print_opportunities_found_this_run()
+
+      finally:
+        await feed.stop()
+        feed_task.cancel()
+        evaluator.cancel()
+        #bars that arrived after the last evaluation still get looked at
+        self.run_strategies_on_stocks(self.pending_stocks)
+        self.pending_stocks = set()
+        self.close_process_pool()
+        self.close_order_pipeline()
+
+
+    def receive_streamed_bar(self, stock, bar):
+      if self.market_data.append_bar(stock, bar):
+          self.pending_stocks.add(stock)
+          self.bars_received += 1
+      self.last_bar_received = time.monotonic()
+      self.bar_arrived.set()
+
+
+    async def evaluate_streamed_stocks(self):
+      while True:
+          await self.bar_arrived.wait()
+          self.bar_arrived.clear()
+          #a minute's bars arrive in a burst, the stocks that came in together are evaluated together
+          stocks = self.pending_stocks
+          self.pending_stocks = set()
+          self.run_strategies_on_stocks(stocks)
+
+
+    def run_strategies_on_stocks(self, stocks):
         for strat in self.strat_list:
-            strat.run_strategy()
+            strat_stocks = [stock for stock in strat.stock_list if str(stock) in stocks]
+            if len(strat_stocks) > 0:
+                strat.run_strategy_on_stocks(strat_stocks)
+
+
+    #one pass of every strategy (or only the ones that are due), without the clock checks and the wait, so a backtest can drive it too
+    #strat_list only decides which strategies screen their stocks, the take-profit check of every strategy runs on every tick
+    def run_tick(self, strat_list=None):
+
+        if strat_list is None:
+            strat_list = self.strat_list
+
+        #a universe screen that finished in the background changes the stock lists here, between ticks
+        if self.universe_screener is not None:
+            self.universe_screener.update()
+
+        if self.profile_next_tick_requested:
+            self.profile_next_tick_requested = False
+            self.run_tick_with_profiler(strat_list)
+            return
+
+        self.metrics.start_tick()
+        if self.rate_limit_governor is not None:
+            self.rate_limit_governor.start_tick()
+        if self.order_pipeline is not None:
+            self.order_pipeline.start_tick()
+
+        #one batched fetch of every strategy's stocks, the strategies read their bars from this cache
+        for strat in strat_list:
+            strat.start_tick()
+        if len(strat_list) > 0:
+            with self.metrics.timer('bar_fetch'):
+                self.market_data.refresh_for_strategies(strat_list)
+
+        #one listing of positions and open orders shared by every strategy's entry and exit checks
+        with self.metrics.timer('broker_state'):
+            self.broker_state.refresh()
+
+        if len(strat_list) > 0:
+            self.run_strategies(strat_list)
 
-        print("\n\nPositions:")
         for strat in self.strat_list:
-            strat.sell_positions_over_threshold()
+            with self.metrics.timer('sell_check', strat.strat_name):
+                strat.sell_positions_over_threshold()
         
-        print("\n\nOpportunities Found Today:")
-        for strat in self.strat_list:
+        for strat in strat_list:
             strat.print_opportunities_found_this_run()
+            self.metrics.count_skipped_stocks(strat.strat_name, strat.unchanged_stocks_skipped)
+
+        self.metrics.end_tick(self.print_tick_summary)
+        if self.rate_limit_governor is not None:
+            event_log.info('rate_limit_budget', **self.rate_limit_governor.get_tick_counters())
+
+
+    #----- instrumentation -----
+
+    def enable_metrics(self, new_print_tick_summary=True, new_metrics_port=None, new_per_symbol=True):
+        #from here on every stage is timed and every REST call made by the collector or its strategies is counted
+        self.metrics.enabled = True
+        self.metrics.per_symbol = new_per_symbol
+        self.print_tick_summary = new_print_tick_summary
+
+        if not isinstance(self.alpaca, CountingRest):
+            self.alpaca = CountingRest(self.alpaca, self.metrics)
+        for owner in (self.market_data, self.broker_state, self.scheduler, self.bar_store, self.order_pipeline, self.account_ledger, self.universe_screener):
+            if owner is not None:
+                owner.alpaca = self.alpaca
+        for strat in self.strat_list:
+            strat.metrics = self.metrics
+            if not isinstance(strat.alpaca, CountingRest):
+                strat.alpaca = CountingRest(strat.alpaca, self.metrics)
+
+        if new_metrics_port is not None and self.metrics_server is None:
+            self.metrics_server = MetricsServer(self.metrics, new_port=new_metrics_port)
+            self.metrics_server.start()
+
+
+    def disable_metrics(self):
+        self.metrics.enabled = False
+        self.print_tick_summary = False
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+
+    #the next tick runs under cProfile, its stats are printed or written to new_profile_path for pstats/snakeviz
+    def profile_next_tick(self, new_profile_path=None):
+        self.profile_next_tick_requested = True
+        self.profile_path = new_profile_path
+
+
+    def run_tick_with_profiler(self, strat_list):
+        profiler = cProfile.Profile()
+        profiler.runcall(self.run_tick, strat_list)
+        if self.profile_path is not None:
+            profiler.dump_stats(self.profile_path)
+            event_log.info('tick_profile_written', path=self.profile_path)
+        else:
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+
+
+    #asyncio version of run_strat_collector, the bars, clock and selling requests go through an AsyncAlpacaRest
+    #and independent requests are awaited together instead of one after another
+    #the strategies' signal math and buys still use their blocking REST client, they run on the loop's executor so the loop is never held up
+    async def run_strat_collector_async(self, async_rest):
+
+      loop = asyncio.get_running_loop()
+
+      async with async_rest:
+        self.scheduler.sync(await async_rest.get_clock())
+
+        while self.scheduler.is_market_open():
+
+          bar_close = await self.scheduler.wait_for_next_tick_async()
+          if not self.scheduler.is_market_open():
+              break
+
+          #a universe screen that finished in the background changes the stock lists here, between ticks
+          if self.universe_screener is not None:
+              self.universe_screener.update()
+
+          #the due strategies screen their stocks, every strategy checks its positions
+          due_strats = self.scheduler.get_due_strategies(self.strat_list, bar_close)
+          self.scheduler.start_tick()
+          if self.order_pipeline is not None:
+              self.order_pipeline.start_tick()
+          if len(due_strats) > 0:
+              for strat in due_strats:
+                  strat.start_tick()
+              await asyncio.gather(self.market_data.refresh_for_strategies_async(async_rest, due_strats), self.broker_state.refresh_async(async_rest))
+
+              await loop.run_in_executor(None, self.run_strategies, due_strats)
+          else:
+              await self.broker_state.refresh_async(async_rest)
+
+          await asyncio.gather(*[self.sell_positions_over_threshold_async(strat, async_rest) for strat in self.strat_list])
+
+          for strat in due_strats:
+              strat.print_opportunities_found_this_run()
+              self.metrics.count_skipped_stocks(strat.strat_name, strat.unchanged_stocks_skipped)
+          self.scheduler.end_tick()
+
+      self.close_process_pool()
+      self.close_order_pipeline()
+
+
+    async def sell_positions_over_threshold_async(self, strat, async_rest):
+        #a strategy with its own asyncio take-profit check closes its positions through async_rest,
+        #any other strategy's blocking check runs on the loop's executor
+        if hasattr(strat, 'sell_positions_over_threshold_async'):
+            await strat.sell_positions_over_threshold_async(async_rest)
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, strat.sell_positions_over_threshold)
+
+
+    def run_strategies(self, strat_list=None):
+        if strat_list is None:
+            strat_list = self.strat_list
+        if self.number_of_processes > 1:
+            self.run_strategies_in_process_pool(strat_list)
+        else:
+            for strat in strat_list:
+                with self.metrics.timer('strategy', strat.strat_name):
+                    strat.run_strategy()
+
+
+    def get_process_pool(self):
+        if self.process_pool is None:
+            #fork keeps the workers from re-running the main script on import
+            if 'fork' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('fork')
+            else:
+                context = multiprocessing.get_context()
+            self.process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.number_of_processes, mp_context=context)
+        return self.process_pool
+
+
+    def close_process_pool(self):
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+            self.process_pool = None
+
+
+    #waits for the orders still being placed, the loops call this when the market closes
+    def close_order_pipeline(self):
+        if self.order_pipeline is not None:
+            self.order_pipeline.shutdown()
+            event_log.info('order_pipeline_closed', states=self.order_pipeline.get_state_counts(), retries=self.order_pipeline.retries,
+                           duplicates_avoided=self.order_pipeline.duplicates_avoided, polls=self.order_pipeline.polls,
+                           polls_deferred=self.order_pipeline.polls_deferred)
+
+
+    def run_strategies_in_process_pool(self, strat_list=None):
 
+        if strat_list is None:
+            strat_list = self.strat_list
+        pool = self.get_process_pool()
 
-        self.end_time_of_loop = self.alpaca.get_clock().timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
-       
-        #slows down loop to once a minute
-        while_loop_difference = int((self.end_time_of_loop - self.start_time_of_loop))
-        print(f"\nWaiting inside the function run_start_collector: time = {self.end_time_of_loop} and time difference = {while_loop_difference} in seconds")
+        #submit every strategy's shards before waiting on any, so all strategies' signal math runs at the same time
+        submitted = []
+        for strat in strat_list:
+            if not strat.can_screen_in_process_pool():
+                submitted.append((strat, None))
+                continue
 
-        if while_loop_difference < 60:
-            time.sleep(59-while_loop_difference)
-                
-        print("\n\n\n")
+            stocks = [str(stock) for stock in strat.stock_list]
+            close_price_np_matrix = self.market_data.get_close_matrix(stocks, strat.get_number_of_minute_bars_needed())
+            last_bar_timestamps = [self.market_data.get_last_timestamp(stock) for stock in stocks]
+
+            #only the stocks with a new bar are sent to the workers, the strategy remembers what the others came to
+            changed_rows = strat.get_changed_rows(stocks, last_bar_timestamps)
+            changed_stocks = [stocks[row] for row in changed_rows]
+            changed_close_price_np_matrix = close_price_np_matrix[changed_rows]
+            changed_last_bar_timestamps = [last_bar_timestamps[row] for row in changed_rows]
+
+            shard_size = max(1, math.ceil(len(changed_stocks) / self.number_of_processes))
+            futures = []
+            for shard_start in range(0, len(changed_stocks), shard_size):
+                shard_end = shard_start + shard_size
+                futures.append(pool.submit(screen_stock_shard, strat, changed_stocks[shard_start:shard_end],
+                                           changed_close_price_np_matrix[shard_start:shard_end], changed_last_bar_timestamps[shard_start:shard_end]))
+            submitted.append((strat, (stocks, last_bar_timestamps, changed_rows, futures)))
+
+        #orders are placed here one strategy and one stock at a time, in stock list order
+        for strat, screen in submitted:
+            if screen is None:
+                with self.metrics.timer('strategy', strat.strat_name):
+                    strat.run_strategy()
+                continue
+
+            #waiting on the shards is the pool's share of the strategy's time
+            stocks, last_bar_timestamps, changed_rows, futures = screen
+            with self.metrics.timer('screen_wait', strat.strat_name):
+                screened_stocks = []
+                for future in futures:
+                    screened_stocks.extend(future.result())
+            with self.metrics.timer('strategy', strat.strat_name):
+                strat.act_on_screened_stocks(strat.merge_screened_stocks(stocks, last_bar_timestamps, changed_rows, screened_stocks))
 
 
 
     def check_if_account_is_blocked(self):
         # Check if our account is restricted from trading.
         if self.account.trading_blocked:
-            print('Account is currently restricted from trading.')
+            event_log.warning('account_blocked')
             return True
         else:
-            print('Account is not blocked.')
+            event_log.info('account_not_blocked')
             return False
 
     def print_my_account_configurations(self):
-        print(self.alpaca.get_account_configurations())
+        event_log.info('account_configurations', configurations=getattr(self.alpaca.get_account_configurations(), '_raw', None))
 
     def disable_shorting(self):
         self.alpaca.update_account_configurations(True,None,None,None)
-        print('Short selling is now disabled on this account.')
+        event_log.info('short_selling_disabled')
         return False
 
 
@@ -89,36 +485,18 @@ class StrategyCollector():
 
     
     def get_list_of_all_tradable_stock_tickers(self):
-        
-        tradable_stocks = []
+        return get_tradable_symbols(self.alpaca)
+
 
-        active_assets = self.alpaca.list_assets(status='active')
-        for asset in active_assets:
-            if asset.tradable:
-                tradeable_stocks.append[asset.symbol]            
-                #print('The stock {} is being sold on the {} exchange'.format(asset.symbol,asset.exchange))
-            #ends if
-        #ends for
-        return tradable_stocks
+    #the screener's tiers replace their strategies' stock lists, it is run once here so the first tick already trades the screened stocks
+    def set_universe_screener(self, new_universe_screener, new_screen_now=True):
+        self.universe_screener = new_universe_screener
+        if new_screen_now:
+            self.universe_screener.refresh()
+            self.universe_screener.apply_pending_selections()
 
 
 
     # Wait for market to open.
     def awaitMarketOpen(self):
-        isOpen = self.alpaca.get_clock().is_open
-    
-        if isOpen:
-            print('Market is already open.')
-        else:
-            print('Market is not yet open, waiting for it to open.')
-            while(not isOpen):
-                clock = self.alpaca.get_clock()
-                openingTime = clock.next_open.replace(tzinfo=datetime.timezone.utc).timestamp()
-                currTime = clock.timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
-                timeToOpen = int((openingTime - currTime) / 60)
-                print(str(timeToOpen) + " minutes til market open.")
-                time.sleep(60)        
-                isOpen = self.alpaca.get_clock().is_open
-
-
-
+        self.scheduler.await_market_open()
@@ -0,0 +1,328 @@
+"""
+    These classes time the hot path of a tick, so it's clear where each minute's time goes.
+
+    TickMetrics keeps a latency histogram per stage (bar_fetch, clean, adf, sma, broker_state, order_submit, signal_to_order, rest_<method>, tick),
+    per strategy and, for the per-stock stages, per symbol, plus a count of REST calls by method and of the stocks skipped because no new bar had arrived.
+    Disabled (the default), timer() hands back one shared do-nothing context manager, so the instrumented code only pays for a method call.
+
+    get_metrics_text() writes every histogram and counter in the Prometheus text format, and MetricsServer serves it at /metrics
+    from a background thread for anything that wants to pull it.
+    CountingRest wraps a trade_api_rest to count and time every call made through it.
+
+"""
+
+#basic libraries
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from EventLog import EventLog
+
+
+event_log = EventLog('metrics')
+
+
+#upper bounds in seconds, from 50 microseconds for a cache lookup up to 30 seconds for a tick that overran
+BUCKET_BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+
+class LatencyHistogram():
+
+    def __init__(self):
+        #one count per bucket plus one for everything over the last bound
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+    def get_quantile(self, quantile):
+        #upper bound of the bucket the quantile falls in, good enough to tell 1ms from 100ms
+        if self.count == 0:
+            return 0.0
+        target = quantile * self.count
+        running = 0
+        for i, count in enumerate(self.counts):
+            running += count
+            if running >= target:
+                return BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else float('inf')
+        return float('inf')
+
+
+
+class NullTimer():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+
+class StageTimer():
+
+    def __init__(self, new_metrics, new_stage, new_strategy, new_symbol):
+        self.metrics = new_metrics
+        self.stage = new_stage
+        self.strategy = new_strategy
+        self.symbol = new_symbol
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started, self.strategy, self.symbol)
+        return False
+
+
+
+class TickMetrics():
+
+    def __init__(self, new_enabled=False, new_per_symbol=True):
+        self.enabled = new_enabled
+        #per symbol histograms are the detailed ones, a strategy with thousands of stocks may want to turn them off
+        self.per_symbol = new_per_symbol
+
+        #(stage, strategy, symbol) -> LatencyHistogram, strategy and symbol are None when the stage isn't tied to one
+        self.histograms = {}
+        self.rest_calls = {}
+        self.signal_times = {}
+        #stocks whose signals were reused because no new bar had arrived, per strategy over the run and for the current tick
+        self.skipped_stocks = {}
+        self.tick_skipped_stocks = 0
+
+        #seconds spent in each stage during the current tick, for the per-tick summary
+        self.tick_totals = {}
+        self.tick_started = None
+        self.ticks_recorded = 0
+
+        #the metrics server reads while the loop writes
+        self.lock = threading.Lock()
+
+
+    def timer(self, stage, strategy=None, symbol=None):
+        if not self.enabled:
+            return NULL_TIMER
+        return StageTimer(self, stage, strategy, symbol)
+
+
+    def observe(self, stage, seconds, strategy=None, symbol=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.get_histogram(stage, strategy, None).observe(seconds)
+            if symbol is not None and self.per_symbol:
+                self.get_histogram(stage, strategy, symbol).observe(seconds)
+            self.tick_totals[stage] = self.tick_totals.get(stage, 0.0) + seconds
+
+
+    def get_histogram(self, stage, strategy, symbol):
+        key = (stage, strategy, symbol)
+        if key not in self.histograms:
+            self.histograms[key] = LatencyHistogram()
+        return self.histograms[key]
+
+
+    def count_rest_call(self, method):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.rest_calls[method] = self.rest_calls.get(method, 0) + 1
+
+
+    def count_skipped_stocks(self, strategy, number_of_stocks):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.skipped_stocks[strategy] = self.skipped_stocks.get(strategy, 0) + number_of_stocks
+            self.tick_skipped_stocks += number_of_stocks
+
+
+    #signal_to_order is the time from a strategy deciding to buy a stock to the broker accepting the buy order
+    def record_signal(self, strategy, symbol):
+        if self.enabled:
+            self.signal_times[(strategy, symbol)] = time.perf_counter()
+
+
+    def record_signals(self, strategy, symbols):
+        if self.enabled:
+            now = time.perf_counter()
+            for symbol in symbols:
+                self.signal_times[(strategy, symbol)] = now
+
+
+    def record_order(self, strategy, symbol):
+        if not self.enabled:
+            return
+        signal_time = self.signal_times.pop((strategy, symbol), None)
+        if signal_time is not None:
+            self.observe('signal_to_order', time.perf_counter() - signal_time, strategy, symbol)
+
+
+    #----- ticks -----
+
+    def start_tick(self):
+        if not self.enabled:
+            return
+        self.tick_totals = {}
+        self.signal_times = {}
+        self.tick_skipped_stocks = 0
+        self.tick_started = time.perf_counter()
+
+
+    def end_tick(self, print_summary=True):
+        if not self.enabled or self.tick_started is None:
+            return
+        tick_seconds = time.perf_counter() - self.tick_started
+        self.observe('tick', tick_seconds)
+        self.ticks_recorded += 1
+        self.tick_started = None
+        if print_summary:
+            self.print_tick_summary(tick_seconds)
+
+
+    def print_tick_summary(self, tick_seconds):
+        #one event per tick with the milliseconds spent in every stage
+        stage_ms = {stage: seconds * 1000 for stage, seconds in sorted(self.tick_totals.items(), key=lambda item: -item[1]) if stage != 'tick'}
+        event_log.info('tick_summary', tick_ms=tick_seconds * 1000, stage_ms=stage_ms, unchanged_stocks_skipped=self.tick_skipped_stocks)
+
+
+    def get_stage_summary(self):
+        #one row per stage and strategy, what the per-tick summary totals up over the whole run
+        rows = []
+        with self.lock:
+            for (stage, strategy, symbol), histogram in self.histograms.items():
+                if symbol is None:
+                    rows.append({'stage': stage, 'strategy': strategy, 'count': histogram.count, 'total_seconds': histogram.sum,
+                                 'p50_seconds': histogram.get_quantile(0.5), 'p99_seconds': histogram.get_quantile(0.99)})
+        return rows
+
+
+    #----- Prometheus text format -----
+
+    def get_metrics_text(self):
+        lines = ['# HELP algo_stage_seconds Time spent in each stage of a tick.', '# TYPE algo_stage_seconds histogram']
+        with self.lock:
+            for (stage, strategy, symbol), histogram in sorted(self.histograms.items(), key=lambda item: tuple(str(part) for part in item[0])):
+                labels = get_labels(stage=stage, strategy=strategy, symbol=symbol)
+                running = 0
+                for bound, count in zip(BUCKET_BOUNDS + ('+Inf',), histogram.counts):
+                    running += count
+                    lines.append(f'algo_stage_seconds_bucket{{{labels},le="{bound}"}} {running}')
+                lines.append(f'algo_stage_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'algo_stage_seconds_count{{{labels}}} {histogram.count}')
+
+            lines.append('# HELP algo_rest_calls_total REST calls made to the broker, by method.')
+            lines.append('# TYPE algo_rest_calls_total counter')
+            for method, count in sorted(self.rest_calls.items()):
+                lines.append(f'algo_rest_calls_total{{{get_labels(method=method)}}} {count}')
+
+            lines.append('# HELP algo_unchanged_stocks_skipped_total Stocks whose signals were reused because no new bar had arrived.')
+            lines.append('# TYPE algo_unchanged_stocks_skipped_total counter')
+            for strategy, count in sorted(self.skipped_stocks.items()):
+                lines.append(f'algo_unchanged_stocks_skipped_total{{{get_labels(strategy=strategy)}}} {count}')
+
+            lines.append('# TYPE algo_ticks_total counter')
+            lines.append(f'algo_ticks_total {self.ticks_recorded}')
+        return '\n'.join(lines) + '\n'
+
+
+
+def get_labels(**labels):
+    #labels that are None are left out, quotes and backslashes in names are escaped
+    return ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for name, value in labels.items() if value is not None)
+
+
+
+class CountingRest():
+
+    #stands in for a trade_api_rest, every method call is counted and timed under a rest_<method> stage
+    def __init__(self, new_trade_api_rest, new_metrics):
+        self.rest = new_trade_api_rest
+        self.metrics = new_metrics
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self.rest, name)
+        if not callable(attribute):
+            return attribute
+
+        metrics = self.metrics
+        def counted(*args, **kwargs):
+            metrics.count_rest_call(name)
+            with metrics.timer('rest_' + name):
+                return attribute(*args, **kwargs)
+
+        #cached on the instance, so the next call skips __getattr__
+        self.__dict__[name] = counted
+        return counted
+
+
+
+class MetricsServer():
+
+    def __init__(self, new_metrics, new_host='127.0.0.1', new_port=0):
+        self.metrics = new_metrics
+        self.host = new_host
+        self.port = new_port
+        self.base_url = None
+        self.server = None
+        self.thread = None
+
+
+    def start(self):
+        metrics = self.metrics
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.get_metrics_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            #the loop's own prints are enough, no line per scrape
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), MetricsRequestHandler)
+        self.port = self.server.server_address[1]
+        self.base_url = f'http://{self.host}:{self.port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        event_log.info('metrics_server_started', url=self.base_url + '/metrics')
+        return self.base_url
+
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
@@ -0,0 +1,164 @@
+"""
+    This class decides when the StrategyCollector's loop runs, so a tick starts right after a bar closes instead of 59 seconds after the last tick ended.
+
+    The broker's clock is read once and kept as an offset from the local monotonic clock, so the loop itself makes no get_clock calls
+    (the offset is read again every resync_seconds in case the two clocks drift apart).
+    A tick fires settle_seconds after every bar close, which gives the broker time to publish the bar that just closed.
+    Each strategy has a cadence_minutes: a strategy with a cadence of 15 only screens its stocks on the ticks whose bar close is on a 15 minute boundary,
+    its positions are still checked for take-profit on every tick.
+    A tick that runs past the next bar close is an overrun; the bar closes it ran through are skipped and counted, not run late one after another.
+
+"""
+
+#basic libraries
+import time
+import asyncio
+import pandas as pd
+
+from EventLog import EventLog
+
+
+event_log = EventLog('scheduler')
+
+
+def get_clock_timestamp(clock_time):
+    #the clock's times carry the exchange's offset, replacing it with utc would shift them by hours
+    timestamp = pd.Timestamp(clock_time)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return timestamp.timestamp()
+
+
+
+class TickScheduler():
+
+    def __init__(self, new_trade_api_rest, new_settle_seconds=2.0, new_bar_seconds=60, new_resync_seconds=3600,
+                 new_monotonic_function=time.monotonic, new_sleep_function=time.sleep):
+        self.alpaca = new_trade_api_rest
+        self.settle_seconds = new_settle_seconds
+        self.bar_seconds = new_bar_seconds
+        self.resync_seconds = new_resync_seconds
+        #a backtest or a check can swap in its own clock and sleep
+        self.monotonic = new_monotonic_function
+        self.sleep = new_sleep_function
+
+        self.clock_offset = None
+        self.synced_at = None
+        self.is_open_at_sync = False
+        self.next_open = None
+        self.next_close = None
+
+        self.last_bar_close = None
+        self.tick_started = None
+        self.last_tick_seconds = 0.0
+        self.ticks_run = 0
+        self.overruns = 0
+        self.ticks_skipped = 0
+
+
+    #----- broker clock -----
+
+    def sync(self, clock=None):
+        #pass a clock that was already fetched (e.g. by an AsyncAlpacaRest) to skip the request
+        if clock is None:
+            clock = self.alpaca.get_clock()
+        self.synced_at = self.monotonic()
+        self.clock_offset = get_clock_timestamp(clock.timestamp) - self.synced_at
+        self.is_open_at_sync = clock.is_open
+        self.next_open = get_clock_timestamp(clock.next_open)
+        self.next_close = get_clock_timestamp(clock.next_close)
+
+
+    def get_broker_time(self):
+        if self.clock_offset is None:
+            self.sync()
+        return self.monotonic() + self.clock_offset
+
+
+    def is_market_open(self):
+        if self.clock_offset is None:
+            self.sync()
+        return self.is_open_at_sync and self.get_broker_time() < self.next_close
+
+
+    def resync_if_due(self):
+        if self.resync_seconds is not None and self.monotonic() - self.synced_at >= self.resync_seconds:
+            self.sync()
+
+
+    #----- tick timing -----
+
+    def get_next_tick(self):
+        #the next bar close whose tick hasn't started yet, and how long until its tick should start
+        now = self.get_broker_time()
+        bar_close = (int((now - self.settle_seconds) // self.bar_seconds) + 1) * self.bar_seconds
+        if self.last_bar_close is not None and bar_close <= self.last_bar_close:
+            bar_close = self.last_bar_close + self.bar_seconds
+
+        if self.last_bar_close is not None:
+            skipped = int((bar_close - self.last_bar_close) // self.bar_seconds) - 1
+            if skipped > 0:
+                self.overruns += 1
+                self.ticks_skipped += skipped
+                event_log.warning('tick_overrun', last_tick_seconds=self.last_tick_seconds, bar_closes_skipped=skipped, bar_close=bar_close)
+
+        return bar_close, max(0.0, bar_close + self.settle_seconds - now)
+
+
+    def wait_for_next_tick(self):
+        self.resync_if_due()
+        bar_close, delay = self.get_next_tick()
+        event_log.debug('waiting_for_bar_close', bar_close=bar_close, delay_seconds=delay)
+        self.sleep(delay)
+        self.last_bar_close = bar_close
+        return bar_close
+
+
+    async def wait_for_next_tick_async(self):
+        bar_close, delay = self.get_next_tick()
+        event_log.debug('waiting_for_bar_close', bar_close=bar_close, delay_seconds=delay)
+        await asyncio.sleep(delay)
+        self.last_bar_close = bar_close
+        return bar_close
+
+
+    def start_tick(self):
+        self.tick_started = self.monotonic()
+
+
+    def end_tick(self):
+        self.last_tick_seconds = self.monotonic() - self.tick_started
+        self.ticks_run += 1
+        event_log.info('tick_finished', bar_close=self.last_bar_close, tick_seconds=self.last_tick_seconds)
+
+
+    def get_due_strategies(self, strat_list, bar_close):
+        #bar closes are on whole minutes of epoch time, and so are the market's 15 and 30 minute boundaries
+        minute = int(bar_close // 60)
+        return [strat for strat in strat_list if minute % max(1, int(strat.cadence_minutes)) == 0]
+
+
+    #----- market open -----
+
+    def get_seconds_until_open(self):
+        clock = self.alpaca.get_clock()
+        if clock.is_open:
+            return 0.0
+        #a closed market whose next open has already passed is checked again a second later
+        return max(1.0, get_clock_timestamp(clock.next_open) - get_clock_timestamp(clock.timestamp))
+
+
+    def await_market_open(self):
+        seconds_until_open = self.get_seconds_until_open()
+        if seconds_until_open == 0.0:
+            event_log.info('market_open', waited_seconds=0.0)
+            return
+
+        waited_seconds = 0.0
+        #one sleep until the open, the loop only goes around again if the broker isn't open yet when it ends
+        while seconds_until_open > 0.0:
+            event_log.info('waiting_for_market_open', minutes_until_open=int(seconds_until_open / 60))
+            self.sleep(seconds_until_open + self.settle_seconds)
+            waited_seconds += seconds_until_open + self.settle_seconds
+            seconds_until_open = self.get_seconds_until_open()
+        event_log.info('market_open', waited_seconds=waited_seconds)
@@ -0,0 +1,210 @@
+"""
+    This class picks the strategies' stocks from every active tradable asset, instead of hand-typed ticker lists.
+
+    Screening goes from cheap to expensive. First the asset list: one list_assets call keeps the tradable US equities.
+    Then one batched fetch of the last number_of_data_points minute bars for all of them, through a MarketDataCache of its own.
+    From those bars three numbers are computed per stock for the whole universe at once: last price, average minute volume and
+    the volatility of the minute returns.
+    Each UniverseTier is a band over those numbers (a price range, a volume range, a volatility range) plus the strategies it feeds.
+    It keeps the most traded stocks that fall inside its band, up to max_symbols. Only those survivors reach the strategies' ADF and SMA screens.
+    A strategy keeps the stocks it had when it was added to the tier (its hand-picked list) on top of the screen's,
+    and a stock the screen drops stays on its list while it still has a position or an open order, so its take-profit keeps being checked.
+    The per stock state of the stocks that do leave the list is dropped with them.
+
+    The universe is screened again every refresh_seconds on a background thread, so the trading loop never waits on the ~50 bar requests.
+    The loop calls update() at the start of a tick; a finished screen is applied there, between ticks, by replacing the strategies' stock lists.
+
+"""
+
+#basic libraries
+import math
+import time
+import threading
+import numpy as np
+
+from MarketDataCache import MarketDataCache
+from EventLog import EventLog
+
+
+event_log = EventLog('universe')
+
+
+def get_tradable_symbols(trade_api_rest):
+    #every active US equity the broker will take orders for
+    return [asset.symbol for asset in trade_api_rest.list_assets(status='active', asset_class='us_equity') if asset.tradable]
+
+
+def get_universe_features(close_price_np_matrix, volume_np_matrix):
+    #one value per row, nan for a stock without enough bars
+    with np.errstate(invalid='ignore', divide='ignore'):
+        has_close = ~np.isnan(close_price_np_matrix)
+        last_column = close_price_np_matrix.shape[1] - 1 - np.argmax(has_close[:, ::-1], axis=1)
+        last_price = close_price_np_matrix[np.arange(len(close_price_np_matrix)), last_column]
+        last_price[~has_close.any(axis=1)] = np.nan
+
+        average_volume = np.nanmean(volume_np_matrix, axis=1) if volume_np_matrix.shape[1] > 0 else np.full(len(volume_np_matrix), np.nan)
+
+        #standard deviation of the minute log returns, in percent
+        returns = np.diff(np.log(close_price_np_matrix), axis=1)
+        volatility = np.nanstd(returns, axis=1) * 100 if returns.shape[1] > 0 else np.full(len(close_price_np_matrix), np.nan)
+    return {'price': last_price, 'volume': average_volume, 'volatility': volatility}
+
+
+
+class UniverseTier():
+
+    def __init__(self, new_name, new_min_price=0.0, new_max_price=math.inf, new_min_average_volume=0.0, new_max_average_volume=math.inf,
+                 new_min_volatility=0.0, new_max_volatility=math.inf, new_max_symbols=None):
+        self.name = new_name
+        self.min_price = new_min_price
+        self.max_price = new_max_price
+        self.min_average_volume = new_min_average_volume
+        self.max_average_volume = new_max_average_volume
+        self.min_volatility = new_min_volatility
+        self.max_volatility = new_max_volatility
+        self.max_symbols = new_max_symbols
+
+        #the strategies whose stock lists this tier replaces, and the stocks each of them had when it was added, which it always keeps
+        self.strat_list = []
+        self.pinned_stock_lists = []
+
+
+    def add_strategy(self, strat):
+        self.strat_list.append(strat)
+        self.pinned_stock_lists.append(list(strat.stock_list))
+
+
+    def get_stock_list(self, strat_index, selected):
+        #the strategy's own stocks first, then the screen's, no stock twice
+        pinned = self.pinned_stock_lists[strat_index]
+        listed = set(pinned)
+        return pinned + [symbol for symbol in selected if symbol not in listed]
+
+
+    def select(self, symbols, features):
+        #nan fails every comparison, so stocks without bars never pass
+        with np.errstate(invalid='ignore'):
+            passed = ((features['price'] >= self.min_price) & (features['price'] <= self.max_price) &
+                      (features['volume'] >= self.min_average_volume) & (features['volume'] <= self.max_average_volume) &
+                      (features['volatility'] >= self.min_volatility) & (features['volatility'] <= self.max_volatility))
+        rows = np.flatnonzero(passed)
+        #most traded first, they fill first and leave the smallest footprint
+        rows = rows[np.argsort(-features['volume'][rows], kind='stable')]
+        if self.max_symbols is not None:
+            rows = rows[:self.max_symbols]
+        return [symbols[row] for row in rows]
+
+
+
+class UniverseScreener():
+
+    def __init__(self, new_trade_api_rest, new_number_of_data_points=30, new_refresh_seconds=3600, new_symbols_per_request=200,
+                 new_monotonic_function=time.monotonic):
+        self.alpaca = new_trade_api_rest
+        self.number_of_data_points = new_number_of_data_points
+        self.refresh_seconds = new_refresh_seconds
+        self.symbols_per_request = new_symbols_per_request
+        self.monotonic = new_monotonic_function
+
+        self.tiers = []
+        self.last_screen_started = None
+        self.screens_run = 0
+
+        #the background screen hands its result to the loop's thread through pending_selections
+        self.thread = None
+        self.lock = threading.Lock()
+        self.pending_selections = None
+        self.last_error = None
+
+
+    def add_tier(self, tier, strat_list=()):
+        for strat in strat_list:
+            tier.add_strategy(strat)
+        self.tiers.append(tier)
+        return tier
+
+
+    #----- screening -----
+
+    def screen(self):
+        #returns {tier name: symbols}, every REST call happens here
+        started = time.perf_counter()
+        symbols = get_tradable_symbols(self.alpaca)
+
+        market_data = MarketDataCache(self.alpaca, new_symbols_per_request=self.symbols_per_request)
+        market_data.refresh(symbols, self.number_of_data_points)
+        features = get_universe_features(market_data.close_matrix, market_data.volume_matrix)
+
+        selections = {tier.name: tier.select(symbols, features) for tier in self.tiers}
+        self.screens_run += 1
+        event_log.info('universe_screened', assets=len(symbols), with_bars=int((~np.isnan(features['price'])).sum()), requests=market_data.requests_made_last_refresh,
+                       tiers={name: len(selected) for name, selected in selections.items()}, seconds=time.perf_counter() - started)
+        return selections
+
+
+    def refresh(self):
+        #screens on the calling thread, the result is applied by the next update() or apply_pending_selections()
+        self.last_screen_started = self.monotonic()
+        try:
+            selections = self.screen()
+        except Exception as error:
+            #the strategies keep their current stocks until a later screen works
+            self.last_error = repr(error)
+            event_log.error('universe_screen_failed', error=self.last_error)
+            return None
+        with self.lock:
+            self.pending_selections = selections
+        return selections
+
+
+    def is_refresh_due(self):
+        return self.last_screen_started is None or self.monotonic() - self.last_screen_started >= self.refresh_seconds
+
+
+    def is_refreshing(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+    def start_background_refresh(self):
+        if self.is_refreshing():
+            return False
+        #marked as started here, so a slow screen isn't started a second time by the next tick
+        self.last_screen_started = self.monotonic()
+        self.thread = threading.Thread(target=self.refresh, name='universe-screener', daemon=True)
+        self.thread.start()
+        return True
+
+
+    #----- applying -----
+
+    def apply_pending_selections(self):
+        with self.lock:
+            selections = self.pending_selections
+            self.pending_selections = None
+        if selections is None:
+            return False
+
+        for tier in self.tiers:
+            selected = selections.get(tier.name)
+            #an empty band more likely means missing bars than a market with nothing to trade, keep the old stocks
+            if not selected:
+                event_log.warning('universe_tier_empty', tier=tier.name)
+                continue
+            for strat_index, strat in enumerate(tier.strat_list):
+                kept = strat.set_stock_list(tier.get_stock_list(strat_index, selected))
+                event_log.info('universe_applied', tier=tier.name, strategy=strat.strat_name, stocks=len(strat.stock_list), selected=len(selected),
+                               kept_with_positions=len(kept))
+        return True
+
+
+    def update(self):
+        #called by the loop between ticks: apply a finished screen, and start the next one when it is due
+        applied = self.apply_pending_selections()
+        if self.is_refresh_due():
+            self.start_background_refresh()
+        return applied
+
+
+    def wait(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
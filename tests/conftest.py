@@ -0,0 +1,5 @@
+#the modules live flat in the repository root, make them importable when pytest is run from anywhere
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
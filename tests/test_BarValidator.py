@@ -0,0 +1,148 @@
+import numpy as np
+import pytest
+
+from BarValidator import (BarValidator, validate_bar_block, get_reason_names, NO_BARS, TRUNCATED, NAN_PRICE, ZERO_PRICE, UNORDERED,
+                          MISSING_MINUTES, STALE, QUARANTINED, REJECTIONS)
+
+
+START = 1609770600
+WIDTH = 10
+
+
+def get_block(number_of_rows=1, now=START + 60 * WIDTH):
+    #right aligned rows of WIDTH one minute bars ending at now, all usable
+    timestamp_matrix = np.tile(now - 60 * np.arange(WIDTH)[::-1], (number_of_rows, 1)).astype(np.int64)
+    close_matrix = np.full((number_of_rows, WIDTH), 10.0)
+    bar_counts = np.full(number_of_rows, WIDTH)
+    return close_matrix, timestamp_matrix, bar_counts
+
+
+def validate_row(close_matrix, timestamp_matrix, bar_counts, **kwargs):
+    return int(validate_bar_block(close_matrix, timestamp_matrix, bar_counts, WIDTH, **kwargs)[0])
+
+
+def test_usable_bars_get_no_reason():
+    assert validate_row(*get_block()) == 0
+
+
+def test_no_bars():
+    close_matrix, timestamp_matrix, bar_counts = get_block(2)
+    close_matrix[0] = np.nan
+    timestamp_matrix[0] = 0
+    bar_counts[0] = 0
+    assert validate_bar_block(close_matrix, timestamp_matrix, bar_counts, WIDTH)[0] == NO_BARS
+
+
+def test_truncated_ignores_the_nan_padding():
+    close_matrix, timestamp_matrix, bar_counts = get_block()
+    close_matrix[0, :4] = np.nan
+    bar_counts[0] = WIDTH - 4
+    assert validate_row(close_matrix, timestamp_matrix, bar_counts) == TRUNCATED
+
+
+@pytest.mark.parametrize('price, reason', [(np.nan, NAN_PRICE), (0.0, ZERO_PRICE), (-1.0, ZERO_PRICE)])
+def test_bad_close_prices(price, reason):
+    close_matrix, timestamp_matrix, bar_counts = get_block()
+    close_matrix[0, 5] = price
+    assert validate_row(close_matrix, timestamp_matrix, bar_counts) == reason
+
+
+def test_bad_price_in_another_column():
+    close_matrix, timestamp_matrix, bar_counts = get_block()
+    high_matrix = close_matrix.copy()
+    high_matrix[0, 2] = 0.0
+    assert validate_row(close_matrix, timestamp_matrix, bar_counts, price_matrices=(high_matrix,)) == ZERO_PRICE
+
+
+def test_repeated_timestamps_are_unordered():
+    close_matrix, timestamp_matrix, bar_counts = get_block()
+    timestamp_matrix[0, 4] = timestamp_matrix[0, 3]
+    assert validate_row(close_matrix, timestamp_matrix, bar_counts) & UNORDERED
+
+
+def test_missing_minutes_only_past_the_allowed_fraction():
+    close_matrix, timestamp_matrix, bar_counts = get_block()
+    #a thin stock missing half of its ten minute window is still fine, one more missing minute is not
+    last = timestamp_matrix[0, -1]
+    timestamp_matrix[0] = last - 60 * np.array([14, 13, 12, 11, 10, 9, 8, 4, 2, 0])
+    assert validate_row(close_matrix, timestamp_matrix, bar_counts) == 0
+    timestamp_matrix[0] = last - 60 * np.array([15, 13, 12, 11, 10, 9, 8, 4, 2, 0])
+    assert validate_row(close_matrix, timestamp_matrix, bar_counts) == MISSING_MINUTES
+
+
+def test_overnight_gap_is_not_missing_minutes():
+    close_matrix, timestamp_matrix, bar_counts = get_block()
+    timestamp_matrix[0, :5] -= 17 * 3600
+    assert validate_row(close_matrix, timestamp_matrix, bar_counts) == 0
+
+
+def test_stale_against_the_newest_bar_in_the_block():
+    close_matrix, timestamp_matrix, bar_counts = get_block(2)
+    timestamp_matrix[1] -= 6 * 60
+    codes = validate_bar_block(close_matrix, timestamp_matrix, bar_counts, WIDTH)
+    assert list(codes) == [0, STALE]
+    assert get_reason_names(codes[1]) == ['stale']
+
+
+def test_reasons_combine():
+    close_matrix, timestamp_matrix, bar_counts = get_block()
+    close_matrix[0, -1] = 0.0
+    timestamp_matrix[0, -1] = timestamp_matrix[0, -2]
+    code = validate_row(close_matrix, timestamp_matrix, bar_counts)
+    assert code == ZERO_PRICE | UNORDERED
+    assert get_reason_names(code) == ['zero_price', 'unordered']
+
+
+def test_only_data_faults_are_rejections():
+    for code in (NO_BARS, TRUNCATED, NAN_PRICE, ZERO_PRICE, UNORDERED, QUARANTINED):
+        assert code & REJECTIONS
+    for code in (MISSING_MINUTES, STALE):
+        assert not code & REJECTIONS
+
+
+def run_refreshes(validator, faults):
+    #one refresh per entry, the stock's last close is zero when the entry is True
+    codes = []
+    for refresh, is_fault in enumerate(faults):
+        close_matrix, timestamp_matrix, bar_counts = get_block(now=START + 60 * (WIDTH + refresh))
+        if is_fault:
+            close_matrix[0, -1] = 0.0
+        validator.start_refresh()
+        codes.append(int(validator.validate(['AAA'], close_matrix, timestamp_matrix, bar_counts, WIDTH)[0]))
+    return codes
+
+
+def test_quarantine_after_failures_in_a_row_and_release():
+    validator = BarValidator(new_failures_to_quarantine=3, new_quarantine_refreshes=2)
+    codes = run_refreshes(validator, [True, True, True, False, False, False])
+    assert codes[:3] == [ZERO_PRICE, ZERO_PRICE, ZERO_PRICE]
+    assert codes[3:5] == [QUARANTINED, QUARANTINED]
+    assert codes[5] == 0
+    assert not validator.is_quarantined('AAA')
+
+
+def test_probation_doubles_the_next_quarantine():
+    validator = BarValidator(new_failures_to_quarantine=3, new_quarantine_refreshes=2)
+    codes = run_refreshes(validator, [True, True, True, False, False, True, False, False, False, False, False])
+    #released on probation, one more fault quarantines it for four refreshes
+    assert codes[5] == ZERO_PRICE
+    assert codes[6:10] == [QUARANTINED] * 4
+    assert codes[10] == 0
+
+
+def test_a_clean_refresh_forgives_the_streak():
+    validator = BarValidator(new_failures_to_quarantine=3)
+    run_refreshes(validator, [True, True, False, True, True])
+    assert not validator.is_quarantined('AAA')
+
+
+def test_stale_does_not_count_toward_quarantine():
+    validator = BarValidator(new_failures_to_quarantine=2)
+    for refresh in range(5):
+        close_matrix, timestamp_matrix, bar_counts = get_block(2, now=START + 60 * (WIDTH + refresh))
+        timestamp_matrix[1] -= 10 * 60
+        validator.start_refresh()
+        codes = validator.validate(['LIQ', 'THIN'], close_matrix, timestamp_matrix, bar_counts, WIDTH)
+        assert list(codes) == [0, STALE]
+    assert not validator.is_quarantined('THIN')
+    assert validator.get_reasons('THIN') == ['stale']
@@ -0,0 +1,104 @@
+import warnings
+
+import numpy as np
+import pytest
+from statsmodels.tsa.stattools import adfuller
+
+from FastAdf import FastAdf, is_stationary, check_parity_with_statsmodels
+from StrategyBuyFiveMinuteSpikes import StrategyBuyFiveMinuteSpikes
+
+
+@pytest.fixture(autouse=True)
+def quiet_statsmodels():
+    #statsmodels warns about rank deficient designs and its future return type, neither matters here
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        yield
+
+
+def get_series(number_of_series, length=27, seed=0):
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(0, 0.05, (number_of_series, length))
+    steps[::2] -= 0.5 * np.cumsum(steps[::2], axis=1)
+    return np.round(20 + np.cumsum(steps, axis=1), 2)
+
+
+def assert_same_as_adfuller(fast_result, close_price_np_array, **kwargs):
+    result = adfuller(close_price_np_array, **kwargs)
+    assert is_stationary(fast_result) == is_stationary(result)
+    assert fast_result[2] == result[2]
+    assert fast_result[3] == result[3]
+    assert fast_result[0] == pytest.approx(result[0], rel=1e-6)
+    assert fast_result[1] == pytest.approx(result[1], rel=1e-6)
+    assert fast_result[4] == pytest.approx(result[4], rel=1e-9)
+
+
+@pytest.mark.parametrize('autolag', ['AIC', None])
+def test_matches_adfuller(autolag):
+    close_price_np_matrix = get_series(200)
+    fast_results = FastAdf(new_autolag=autolag).test_on_matrix(close_price_np_matrix)
+    for row, fast_result in enumerate(fast_results):
+        assert_same_as_adfuller(fast_result, close_price_np_matrix[row], autolag=autolag)
+
+
+def test_rank_deficient_window_is_answered_by_statsmodels():
+    flat_with_jump = np.array([10.0] * 26 + [10.5])
+    fast_adf = FastAdf()
+    fast_result = fast_adf.test_on_list(flat_with_jump)
+    assert_same_as_adfuller(fast_result, flat_with_jump)
+    assert fast_result[:4] == pytest.approx((1.0, 0.994, 0, 26), abs=1e-3)
+    assert fast_adf.statsmodels_fallbacks == 1
+
+
+def test_rank_deficient_window_does_not_fail_the_batch():
+    close_price_np_matrix = get_series(10)
+    close_price_np_arrays = list(close_price_np_matrix) + [np.array([10.0] * 26 + [10.5])]
+    fast_results = FastAdf().test_on_lists(close_price_np_arrays)
+    for close_price_np_array, fast_result in zip(close_price_np_arrays, fast_results):
+        assert_same_as_adfuller(fast_result, close_price_np_array)
+
+
+def test_constant_window_raises_only_for_itself():
+    constant = np.full(27, 10.0)
+    close_price_np_arrays = list(get_series(4)) + [constant]
+    fast_adf = FastAdf()
+
+    fast_results = fast_adf.test_on_lists(close_price_np_arrays)
+    assert isinstance(fast_results[-1], ValueError)
+    assert not is_stationary(fast_results[-1])
+    for close_price_np_array, fast_result in zip(close_price_np_arrays[:-1], fast_results[:-1]):
+        assert_same_as_adfuller(fast_result, close_price_np_array)
+
+    with pytest.raises(ValueError):
+        adfuller(constant)
+    with pytest.raises(ValueError):
+        fast_adf.test_on_list(constant)
+
+
+def test_strategy_verdict_on_singular_and_constant_windows():
+    strat = StrategyBuyFiveMinuteSpikes('test', None, ['FLAT', 'JUMP'], 1000, 20, 5, 3, 0.01, 0.01, 5)
+    strat.adf_test = FastAdf()
+    flat_with_jump = np.array([10.0] * 26 + [10.5])
+
+    assert strat.augmented_dickey_fuller_test_on_list(flat_with_jump, 'JUMP', 60) == is_stationary(adfuller(flat_with_jump))
+    assert strat.augmented_dickey_fuller_test_on_list(np.full(27, 10.0), 'FLAT', 60) is False
+
+
+def test_cache_reuses_result_until_last_bar_changes():
+    close_price_np_array = get_series(1)[0]
+    fast_adf = FastAdf()
+    first = fast_adf.test_on_list(close_price_np_array, 'AAA', 60)
+    assert fast_adf.test_on_list(close_price_np_array, 'AAA', 60) is first
+    fast_adf.test_on_list(close_price_np_array, 'AAA', 120)
+    assert (fast_adf.cache_hits, fast_adf.cache_misses) == (1, 2)
+
+
+def test_cache_is_bounded():
+    fast_adf = FastAdf(new_cache_size=3)
+    for timestamp, close_price_np_array in enumerate(get_series(5)):
+        fast_adf.test_on_list(close_price_np_array, 'AAA', timestamp)
+    assert len(fast_adf.cache) == 3
+
+
+def test_parity_check_passes():
+    assert check_parity_with_statsmodels(number_of_series=200)
@@ -0,0 +1,115 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from RollingSmaIndicator import RollingMean, RollingSmaIndicator
+from StrategyBuyFiveMinuteSpikes import StrategyBuyFiveMinuteSpikes
+
+
+def get_closes(length, seed=0):
+    rng = np.random.default_rng(seed)
+    #rounded to cents like real prices, so equal averages and exact ties show up
+    return np.round(20 + np.cumsum(rng.normal(0, 0.05, length)) + 0.3 * np.sin(np.arange(length) / 4.0), 2)
+
+
+def assert_same_as_pandas(value, expected):
+    if math.isnan(expected):
+        assert math.isnan(value)
+    else:
+        assert value == pytest.approx(expected, rel=1e-12, abs=1e-12)
+
+
+@pytest.mark.parametrize('window', [1, 5, 25])
+def test_rolling_mean_matches_pandas(window):
+    closes = get_closes(300)
+    expected = pd.Series(closes).rolling(window=window).mean().values
+    rolling_mean = RollingMean(window)
+    for i, close in enumerate(closes):
+        rolling_mean.add(close)
+        if i >= window:
+            rolling_mean.remove(closes[i - window])
+        assert_same_as_pandas(rolling_mean.mean(), expected[i])
+
+
+def test_rolling_mean_of_a_flat_window_is_exactly_its_value():
+    rolling_mean = RollingMean(5)
+    for close in [10.1, 10.3, 10.7, 10.7, 10.7, 10.7, 10.7]:
+        rolling_mean.add(close)
+    for close in [10.1, 10.3]:
+        rolling_mean.remove(close)
+    assert rolling_mean.mean() == 10.7
+
+
+def test_indicator_averages_and_slopes_match_pandas():
+    long, short, delta_t = 25, 5, 2
+    closes = get_closes(200)
+    sma_long = pd.Series(closes).rolling(window=long).mean()
+    sma_short = pd.Series(closes).rolling(window=short).mean()
+    short_slope = (sma_short.diff(delta_t) / delta_t).values
+    long_slope = (sma_long.diff(delta_t) / delta_t).values
+
+    indicator = RollingSmaIndicator(long, short, delta_t)
+    for i, close in enumerate(closes):
+        indicator.update(close)
+        assert_same_as_pandas(indicator.get_sma_long(), sma_long.values[i])
+        assert_same_as_pandas(indicator.get_sma_short(), sma_short.values[i])
+        assert_same_as_pandas(indicator.get_sma_short(1), sma_short.values[i - 1] if i > 0 else math.nan)
+        assert_same_as_pandas(indicator.get_short_slope(), short_slope[i])
+        assert_same_as_pandas(indicator.get_long_slope(), long_slope[i])
+
+
+def test_history_length_reports_nan_for_averages_outside_the_window():
+    indicator = RollingSmaIndicator(5, 2, 3, new_history_length=6)
+    indicator.seed(get_closes(50))
+    assert not math.isnan(indicator.get_sma_long(1))
+    #the long average three bars back would need bars before the six bar window
+    assert math.isnan(indicator.get_sma_long(3))
+    assert math.isnan(indicator.get_long_slope())
+
+
+def test_update_from_window_only_feeds_new_bars():
+    closes = get_closes(100)
+    timestamps = 60 * np.arange(100)
+    window = 27
+
+    streamed = RollingSmaIndicator(25, 5, 2, window)
+    streamed.update_from_window(closes[:window], timestamps[:window])
+    for end in range(window + 1, 101):
+        streamed.update_from_window(closes[end - window:end], timestamps[end - window:end])
+        assert streamed.number_of_bars == end
+
+    fresh = RollingSmaIndicator(25, 5, 2, window)
+    fresh.seed(closes[100 - window:], timestamps[100 - window:])
+    assert streamed.get_sma_long() == pytest.approx(fresh.get_sma_long(), rel=1e-12)
+    assert streamed.get_sma_short(1) == pytest.approx(fresh.get_sma_short(1), rel=1e-12)
+
+
+def test_update_from_window_reseeds_when_the_last_bar_seen_is_gone():
+    closes = get_closes(100)
+    timestamps = 60 * np.arange(100)
+    indicator = RollingSmaIndicator(25, 5, 2, 27)
+    indicator.update_from_window(closes[:27], timestamps[:27])
+    indicator.update_from_window(closes[60:87], timestamps[60:87])
+    assert indicator.number_of_bars == 27
+    assert indicator.last_timestamp == timestamps[86]
+
+
+@pytest.mark.parametrize('slope_min, slope_diff_min', [(0.0, 0.0), (0.01, 0.005)])
+def test_crossing_decisions_match_the_pandas_version(slope_min, slope_diff_min):
+    long, short, delta_t = 20, 4, 2
+    window = long + 2
+    closes = get_closes(600, seed=3)
+    timestamps = 60 * np.arange(len(closes))
+    strat = StrategyBuyFiveMinuteSpikes('test', None, ['AAA'], 1000, long, short, delta_t, slope_min, slope_diff_min, 5)
+    indicator = RollingSmaIndicator(long, short, delta_t, window)
+
+    crossings = 0
+    for end in range(window, len(closes) + 1):
+        close_window = closes[end - window:end]
+        expected = strat.check_mean_reversion_of_long_and_short_sma_and_sma_slopes(close_window, long, short, delta_t, slope_min, slope_diff_min)
+        found = indicator.check_crossing_buy_with_slopes(close_window, timestamps[end - window:end], slope_min, slope_diff_min)
+        assert found == expected
+        crossings += expected
+    assert crossings > 0